@@ -0,0 +1,56 @@
+'''Benchmark of the schema4chem to CKAN converter.
+
+    python benchmarks/bench_converter.py [--records 100000] [--repeat 5]
+
+Reports the records converted per second by ``package`` (one record at a
+time) and ``packages`` (a batch) on synthetic MassBank-style records.
+
+'''
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ckanext.datapackager.logic.action import schema4chem_ckan_mapper as converter  # noqa: E402
+
+import massbank  # noqa: E402
+
+
+def _best_rate(run, count, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    records = list(massbank.records(args.records))
+
+    def one_at_a_time():
+        for record in records:
+            converter.package(record)
+
+    def batch():
+        for dataset_dict in converter.packages(records):
+            pass
+
+    print('{0} records, best of {1}'.format(args.records, args.repeat))
+    for name, run in (('package', one_at_a_time), ('packages', batch)):
+        rate = _best_rate(run, args.records, args.repeat)
+        print('{0:>10}: {1:>12,.0f} records/s'.format(name, rate))
+
+
+if __name__ == '__main__':
+    main()
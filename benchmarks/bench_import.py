@@ -0,0 +1,340 @@
+'''Benchmark of the Data Package and CIF import pipeline.
+
+    python benchmarks/bench_import.py [--kind json|cif] [--records 10000]
+        [--molecules N] [--images off|inline|pool] [--ckan-ini test.ini]
+        [--save-baseline NAME] [--compare NAME]
+
+Imports a synthetic corpus (MassBank-style JSON records, or CIF data blocks)
+with ``package_create_from_datapackage_or_cif`` and reports the throughput,
+the latency percentiles of each stage of the pipeline and the peak memory
+used.
+
+The import runs against an in-process stand-in of CKAN and its database
+(see ``standin.py``) unless ``--ckan-ini`` is given, in which case it
+creates real datasets on the site configured by that file (use a throwaway
+one). The identifiers of the datasets are deterministic, so running again
+against the same site measures the import of existing datasets; give a new
+``--prefix`` to create new ones.
+
+Results can be saved as a baseline (``--save-baseline``), and compared to
+one (``--compare``): the script exits with status 1 if the throughput,
+peak memory or a stage latency got worse by more than ``--tolerance``.
+
+'''
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cif_corpus  # noqa: E402
+import massbank  # noqa: E402
+import stats  # noqa: E402
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'baselines')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--kind', choices=('json', 'cif'), default='json')
+    parser.add_argument('--records', type=int, default=10000,
+                        help='the number of records (or CIF data blocks)')
+    parser.add_argument('--molecules', type=int, default=None,
+                        help='the number of distinct molecules the records '
+                        'share (default: one per record)')
+    parser.add_argument('--corpus', default=None,
+                        help='import this file instead of a synthetic '
+                        'corpus')
+    parser.add_argument('--cif-archive', action='store_true',
+                        help='upload the CIF blocks as a zip of CIF files '
+                        'rather than as a single multi-block CIF file')
+    parser.add_argument('--blocks-per-file', type=int, default=1)
+    parser.add_argument('--prefix', default=None,
+                        help='the prefix of the identifiers of the records')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--images', choices=('off', 'inline', 'pool'),
+                        default='off')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='the number of image (and CIF) worker '
+                        'processes')
+    parser.add_argument('--ckan-ini', default=None,
+                        help='import into the CKAN site configured by this '
+                        'file instead of the in-process stand-in')
+    parser.add_argument('--owner-org', default=None)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run the import this many times (against a '
+                        'fresh stand-in each time) and keep the fastest')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--baseline-dir', default=BASELINE_DIR)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def write_corpus(args, directory):
+    if args.kind == 'json':
+        path = os.path.join(directory, 'records.json')
+        size = massbank.write_corpus(
+            path, args.records, molecules=args.molecules,
+            prefix=args.prefix or 'MSBNK-Synthetic')
+    else:
+        path = os.path.join(directory, 'structures.zip' if args.cif_archive
+                            else 'structures.cif')
+        size = cif_corpus.write_corpus(
+            path, args.records, blocks_per_file=args.blocks_per_file,
+            molecules=args.molecules, prefix=args.prefix or 'synthetic')
+    return path, size
+
+
+class _NoImages(object):
+    rendered = failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, packages):
+        pass
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def instrumented(timer, args, images_dir):
+    '''Time the stages of the pipeline, and apply the benchmark settings,
+    within the context.'''
+    import ckan.plugins.toolkit as toolkit
+    from ckanext.datapackager.lib import cif
+    from ckanext.datapackager.lib.image_store import ImageStore
+    from ckanext.datapackager.logic.action import create
+    from ckanext.datapackager.logic.action import schema4chem_ckan_mapper
+
+    config = {
+        'ckanext.datapackager.import_chunk_size': str(args.chunk_size),
+        'ckanext.datapackager.image_rendering':
+            'inline' if args.images == 'inline' else 'pool',
+    }
+    if args.processes is not None:
+        config['ckanext.datapackager.image_processes'] = str(args.processes)
+        config['ckanext.datapackager.cif_processes'] = str(args.processes)
+
+    make_renderer = create._molecule_image_renderer
+    make_cif_processor = create._cif_processor
+
+    def molecule_image_renderer():
+        if args.images == 'off':
+            return _NoImages()
+        renderer = make_renderer()
+        renderer.submit = timer.wrap('images', renderer.submit)
+        renderer.close = timer.wrap('images', renderer.close)
+        return renderer
+
+    def cif_processor():
+        processor = make_cif_processor()
+        if args.images == 'off':
+            processor.store = None
+        processor.process = timer.wrap_iterator('structures',
+                                                processor.process)
+        return processor
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.dict(toolkit.config, config))
+        for target, attribute, value in (
+                (create, '_load_and_validate_datapackage',
+                 timer.wrap_iterator(
+                     'parse', create._load_and_validate_datapackage)),
+                (schema4chem_ckan_mapper, 'packages', timer.wrap_iterator(
+                    'convert', schema4chem_ckan_mapper.packages)),
+                (cif, 'iter_cif_files', timer.wrap_iterator(
+                    'read', cif.iter_cif_files)),
+                (create, '_cif_dataset_dict', timer.wrap(
+                    'convert', create._cif_dataset_dict)),
+                (create, '_find_existing_packages', timer.wrap(
+                    'lookup', create._find_existing_packages)),
+                (create, '_package_create_with_unique_name', timer.wrap(
+                    'create', create._package_create_with_unique_name)),
+                (create, '_send_chunk_to_db', timer.wrap(
+                    'molecules', create._send_chunk_to_db)),
+                (create, '_molecule_image_renderer', molecule_image_renderer),
+                (create, '_cif_processor', cif_processor)):
+            stack.enter_context(mock.patch.object(target, attribute, value))
+        if images_dir:
+            store = ImageStore(images_dir)
+            stack.enter_context(mock.patch.object(
+                create, 'get_image_store', lambda: store))
+        yield
+
+
+def run_import(args, path, images_dir):
+    '''Import the corpus at ``path`` once. Returns the wall time, the stage
+    timer and the import counts.'''
+    from werkzeug.datastructures import FileStorage
+    from ckanext.datapackager.lib import molecules as molecule_registry
+    from ckanext.datapackager.lib.progress import ImportProgress
+    from ckanext.datapackager.logic.action import create
+
+    timer = stats.StageTimer()
+    progress = ImportProgress()
+    molecule_registry.molecule_id_cache.invalidate()
+
+    with contextlib.ExitStack() as stack:
+        if args.ckan_ini:
+            user = _site_user()
+        else:
+            import standin
+            user = None
+            stack.enter_context(standin.installed(standin.InMemoryCkan()))
+        stack.enter_context(instrumented(timer, args, images_dir))
+
+        data_dict = {}
+        if args.owner_org:
+            data_dict['owner_org'] = args.owner_org
+        with open(path, 'rb') as f:
+            data_dict['upload'] = FileStorage(f, os.path.basename(path))
+            start = time.perf_counter()
+            create.package_create_from_datapackage_or_cif(
+                {'user': user, 'import_progress': progress}, data_dict)
+            wall_time = time.perf_counter() - start
+
+    return wall_time, timer, progress.as_dict()
+
+
+def _site_user():
+    import ckan.plugins.toolkit as toolkit
+    return toolkit.get_action('get_site_user')({'ignore_auth': True}, {})['name']
+
+
+@contextlib.contextmanager
+def ckan_app(ini):
+    '''Load the CKAN site configured by ``ini``, within the context.'''
+    from ckan.cli import load_config
+    from ckan.config.middleware import make_app
+
+    app = make_app(load_config(ini))
+    flask_app = getattr(app, '_wsgi_app', app)
+    with flask_app.test_request_context():
+        yield
+
+
+def benchmark(args):
+    with contextlib.ExitStack() as stack:
+        directory = stack.enter_context(
+            tempfile.TemporaryDirectory(prefix='datapackager-bench-'))
+        if args.ckan_ini:
+            stack.enter_context(ckan_app(args.ckan_ini))
+        if args.corpus:
+            path, size = args.corpus, os.path.getsize(args.corpus)
+        else:
+            path, size = write_corpus(args, directory)
+
+        best = None
+        for i in range(args.repeat):
+            # A fresh image directory per run, unless images go where the
+            # CKAN site keeps them.
+            images_dir = None
+            if args.images != 'off' and not args.ckan_ini:
+                images_dir = tempfile.mkdtemp(prefix='images-', dir=directory)
+            run = run_import(args, path, images_dir)
+            if best is None or run[0] < best[0]:
+                best = run
+
+    wall_time, timer, counts = best
+    records = counts['created'] + counts['skipped'] + counts['failed']
+    self_rss, children_rss = stats.peak_rss()
+    result = {
+        'kind': args.kind,
+        'records': records,
+        'corpus_bytes': size,
+        'settings': {
+            'corpus': args.corpus,
+            'molecules': args.molecules,
+            'cif_archive': args.cif_archive,
+            'blocks_per_file': args.blocks_per_file,
+            'chunk_size': args.chunk_size,
+            'images': args.images,
+            'processes': args.processes,
+            'backend': 'ckan' if args.ckan_ini else 'stand-in',
+        },
+        'counts': {key: counts[key]
+                   for key in ('created', 'skipped', 'failed')},
+        'wall_s': wall_time,
+        'throughput': records / wall_time if wall_time else 0.0,
+        'peak_rss_mib': self_rss,
+        'peak_rss_children_mib': children_rss,
+        'stages': timer.summary(wall_time),
+        'environment': stats.environment(),
+    }
+    return result
+
+
+def report(result, repeat):
+    counts = result['counts']
+    print('{0} import of {1:,} records ({2:.1f} MiB, {3}), best of {4}'.format(
+        result['kind'], result['records'],
+        result['corpus_bytes'] / (1024.0 * 1024.0),
+        result['settings']['backend'], repeat))
+    print('  wall     {0:10.3f} s   {1:,.0f} records/s   created {2}, '
+          'skipped {3}, failed {4}'.format(
+              result['wall_s'], result['throughput'], counts['created'],
+              counts['skipped'], counts['failed']))
+    print('  peak RSS {0:10.1f} MiB (worker processes: {1:.1f} MiB)'.format(
+        result['peak_rss_mib'], result['peak_rss_children_mib']))
+    print()
+    print('  {0:<12} {1:>8} {2:>10} {3:>7} {4:>9} {5:>9} {6:>9} {7:>9}'.format(
+        'stage', 'calls', 'total s', 'share', 'p50 ms', 'p90 ms', 'p99 ms',
+        'max ms'))
+    stages = result['stages']
+    names = sorted((name for name in stages if name != 'other'),
+                   key=lambda name: -stages[name]['total_s']) + ['other']
+    for name in names:
+        stage = stages[name]
+        line = '  {0:<12} {1:>8} {2:>10.3f} {3:>7.1%}'.format(
+            name, stage['calls'] or '', stage['total_s'], stage['share'])
+        if 'p50_ms' in stage:
+            line += ' {0:>9.3f} {1:>9.3f} {2:>9.3f} {3:>9.3f}'.format(
+                stage['p50_ms'], stage['p90_ms'], stage['p99_ms'],
+                stage['max_ms'])
+        print(line)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    result = benchmark(args)
+    report(result, args.repeat)
+
+    status = 0
+    if args.compare:
+        baseline = stats.load_baseline(
+            os.path.join(args.baseline_dir, args.compare + '.json'))
+        print()
+        print('compared to baseline {0}:'.format(args.compare))
+        for line, regressed in stats.compare(result, baseline,
+                                             args.tolerance):
+            print('  {0}{1}'.format(line, '  REGRESSION' if regressed
+                                    else ''))
+            status = status or int(regressed)
+    if args.save_baseline:
+        path = os.path.join(args.baseline_dir, args.save_baseline + '.json')
+        stats.save_baseline(path, result)
+        print()
+        print('saved baseline {0}'.format(path))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+'''Benchmark of the validation of the records of a Data Package import.
+
+    python benchmarks/bench_validation.py [--records 5000] [--repeat 3]
+
+Compares the cost per record of building a ``datapackage.DataPackage`` for
+each record (as imports used to) with the cached profile validation of
+``ckanext.datapackager.lib.validation``, in ``full`` and ``structural``
+mode, on synthetic MassBank-style records.
+
+'''
+import argparse
+import copy
+import logging
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datapackage  # noqa: E402
+
+from ckanext.datapackager.lib import validation  # noqa: E402
+
+import massbank  # noqa: E402
+
+
+def _best_time(run, records, repeat):
+    best = None
+    for i in range(repeat):
+        batch = copy.deepcopy(records)
+        start = time.perf_counter()
+        run(batch)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--records', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    warnings.simplefilter('ignore')
+    records = list(massbank.records(args.records))
+
+    def per_record_datapackage(batch):
+        for record in batch:
+            datapackage.DataPackage(record).to_dict()
+
+    def full(batch):
+        for descriptor in validation.iter_validated(batch):
+            pass
+
+    def structural(batch):
+        for descriptor in validation.iter_validated(
+                batch, mode=validation.STRUCTURAL):
+            pass
+
+    print('{0} records, best of {1}'.format(args.records, args.repeat))
+    for name, run in (('DataPackage per record', per_record_datapackage),
+                      ('full', full), ('structural', structural)):
+        elapsed = _best_time(run, records, args.repeat)
+        print('{0:>24}: {1:>10.1f} us/record {2:>12,.0f} records/s'.format(
+            name, elapsed / args.records * 1e6, args.records / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''Synthetic CIF corpora, as imported by
+``package_create_from_datapackage_or_cif``: small-molecule crystal
+structures (P 1 cells with a few dozen atoms) with the citation, formula and
+space group items the importer reads.
+
+'''
+import io
+import random
+import zipfile
+
+_ELEMENTS = ('C', 'H', 'N', 'O', 'S')
+
+_BLOCK = '''data_{name}
+_audit_creation_method 'synthetic benchmark structure'
+_citation_title
+;Synthetic crystal structure {i}
+;
+loop_
+_citation_author_citation_id
+_citation_author_name
+primary 'Doe, J.'
+primary 'Roe, R.'
+_chemical_name_common 'synthetic compound {molecule}'
+_chemical_formula_structural '{formula}'
+_space_group_name_H-M_alt 'P 1'
+_space_group_IT_number 1
+_cell_length_a {a:.4f}
+_cell_length_b {b:.4f}
+_cell_length_c {c:.4f}
+_cell_angle_alpha 90
+_cell_angle_beta {beta:.3f}
+_cell_angle_gamma 90
+loop_
+_atom_site_label
+_atom_site_type_symbol
+_atom_site_fract_x
+_atom_site_fract_y
+_atom_site_fract_z
+{atoms}
+'''
+
+
+def block(i, molecules=None, prefix='synthetic'):
+    '''Return the text of the ``i``-th synthetic data block. Blocks share
+    ``molecules`` distinct structures (default: each block has its own).'''
+    molecule = i % molecules if molecules else i
+    rnd = random.Random(molecule)
+    symbols = [rnd.choice(_ELEMENTS) for j in range(rnd.randint(8, 40))]
+    counts = dict((element, symbols.count(element)) for element in _ELEMENTS)
+    formula = ' '.join('{0}{1}'.format(element, count)
+                       for element, count in sorted(counts.items()) if count)
+    atoms = '\n'.join(
+        '{0}{1} {0} {2:.5f} {3:.5f} {4:.5f}'.format(
+            symbol, j + 1, rnd.random(), rnd.random(), rnd.random())
+        for j, symbol in enumerate(symbols))
+    return _BLOCK.format(
+        name='{0}_{1:08d}'.format(prefix, i), i=i, molecule=molecule,
+        formula=formula, a=rnd.uniform(4, 20), b=rnd.uniform(4, 20),
+        c=rnd.uniform(4, 20), beta=rnd.uniform(90, 120), atoms=atoms)
+
+
+def write_corpus(path, count, blocks_per_file=1, molecules=None,
+                 prefix='synthetic'):
+    '''Write ``count`` synthetic data blocks to ``path``.
+
+    If ``path`` ends with ``.zip`` the blocks are written to CIF files of
+    ``blocks_per_file`` blocks each in a zip archive, otherwise they are all
+    written to a single (multi-block) CIF file. Returns the size of the
+    file in bytes.
+
+    '''
+    if not path.endswith('.zip'):
+        with open(path, 'w', encoding='utf-8') as f:
+            for i in range(count):
+                f.write(block(i, molecules=molecules, prefix=prefix))
+            return f.tell()
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for start in range(0, count, blocks_per_file):
+            text = io.StringIO()
+            for i in range(start, min(start + blocks_per_file, count)):
+                text.write(block(i, molecules=molecules, prefix=prefix))
+            archive.writestr('{0}_{1:08d}.cif'.format(prefix, start),
+                             text.getvalue())
+    with open(path, 'rb') as f:
+        return f.seek(0, 2)
@@ -0,0 +1,84 @@
+'''Synthetic MassBank-style records (schema4chem Data Packages, as found in
+the JSON uploads imported by ``package_create_from_datapackage``).
+
+The InChIs of the records are well-formed but don't describe real
+molecules, so RDKit fails to draw them.
+
+'''
+import json
+import random
+import string
+
+_ELEMENTS = ('C', 'H', 'N', 'O', 'S', 'P', 'Cl')
+_TECHNIQUES = (
+    ('LC-ESI-QTOF', 'http://purl.obolibrary.org/obo/MS_1000075'),
+    ('GC-EI-TOF', 'http://purl.obolibrary.org/obo/MS_1000389'),
+)
+
+
+def _inchi_key(rnd):
+    letters = string.ascii_uppercase
+    return '{0}-{1}-N'.format(
+        ''.join(rnd.choice(letters) for i in range(14)),
+        ''.join(rnd.choice(letters) for i in range(10)))
+
+
+def record(i, rnd=random, molecules=None, prefix='MSBNK-Synthetic'):
+    '''Return the ``i``-th synthetic record. Records share ``molecules``
+    distinct molecules (default: each record has its own), and their
+    identifiers start with ``prefix``.'''
+    molecule = i % molecules if molecules else i
+    mrnd = random.Random(molecule)
+    formula = ''.join('{0}{1}'.format(element, mrnd.randint(1, 20))
+                      for element in _ELEMENTS[:mrnd.randint(2, 5)])
+    technique = _TECHNIQUES[i % len(_TECHNIQUES)]
+    identifier = '{0}-{1:08d}'.format(prefix, i)
+    return {
+        'identifier': identifier,
+        'name': 'Synthetic spectrum {0}'.format(i),
+        'description': 'A synthetic mass spectrum of molecule {0}.'.format(
+            molecule),
+        'url': 'https://massbank.example.org/RecordDisplay?id={0}'.format(
+            identifier),
+        'format': ['text/plain'],
+        'license': 'CC BY 4.0',
+        'datePublished': '2024-01-{0:02d}'.format(1 + i % 28),
+        'inChI': 'InChI=1S/{0}/c1-2-{1}'.format(formula, molecule),
+        'inChIKey': _inchi_key(mrnd),
+        'smiles': 'C' * mrnd.randint(1, 30),
+        'molecularFormula': formula,
+        'chemicalComposition': formula,
+        'monoisotopicMolecularWeight': '{0:.4f}'.format(
+            mrnd.uniform(50, 1500)),
+        'measurementTechnique': [
+            {'name': technique[0], 'url': technique[1]}],
+        'contributors': [
+            {'title': 'MassBank Consortium', 'role': 'author',
+             'email': 'info@massbank.example.org'}],
+        'alternateNames': ['molecule-{0}'.format(molecule)],
+        'keywords': ['synthetic', technique[0]],
+        'peaks': [[round(rnd.uniform(50, 1500), 4), rnd.randint(1, 999)]
+                  for j in range(rnd.randint(5, 40))],
+    }
+
+
+def records(count, seed=0, molecules=None, prefix='MSBNK-Synthetic'):
+    '''Yield ``count`` synthetic records.'''
+    rnd = random.Random(seed)
+    for i in range(count):
+        yield record(i, rnd, molecules=molecules, prefix=prefix)
+
+
+def write_corpus(path, count, seed=0, molecules=None,
+                 prefix='MSBNK-Synthetic'):
+    '''Write ``count`` synthetic records to ``path`` as a JSON array (the
+    format of the uploads of ``package_create_from_datapackage``), one
+    record at a time. Returns the size of the file in bytes.'''
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for i, each in enumerate(records(count, seed=seed,
+                                         molecules=molecules, prefix=prefix)):
+            f.write(',\n' if i else '\n')
+            json.dump(each, f)
+        f.write('\n]\n')
+        return f.tell()
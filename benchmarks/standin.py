@@ -0,0 +1,195 @@
+'''An in-process stand-in for the parts of CKAN and its database the import
+pipeline talks to.
+
+:py:class:`InMemoryCkan` keeps datasets and molecules in dicts and answers
+the actions the import calls (``package_create``, ``package_show`` and
+``package_update``), the lookup of existing datasets and the molecule
+registration the way CKAN, PostgreSQL and the ckanext-rdkit_visuals models
+would, including their errors on duplicate names and ids. Uploaded
+resource files are read to the end, as the uploader would.
+
+It is meant to measure the import code itself: the costs of validation,
+indexing and SQL are left out.
+
+'''
+import contextlib
+import copy
+import datetime
+import itertools
+import uuid
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.datapackager.lib import molecules as molecule_registry
+from ckanext.datapackager.logic.action import create
+
+
+class InMemoryCkan(object):
+
+    def __init__(self):
+        self.packages = {}
+        self.names = {}
+        self.molecules = {}
+        self.relations = {}
+        self.uploaded_bytes = 0
+        self._molecule_ids = itertools.count(1)
+        self._actions = {
+            'package_create': self.package_create,
+            'package_show': self.package_show,
+            'package_update': self.package_update,
+        }
+
+    def get_action(self, name):
+        try:
+            return self._actions[name]
+        except KeyError:
+            raise AssertionError(
+                'The CKAN stand-in has no {0} action'.format(name))
+
+    def package_create(self, context, data_dict):
+        errors = {}
+        if data_dict.get('name') in self.names:
+            errors['name'] = ['That URL is already in use.']
+        if data_dict.get('id') in self.packages:
+            errors['id'] = ['Dataset id already exists']
+        if errors:
+            raise toolkit.ValidationError(errors)
+        package = self._store(data_dict, id=data_dict.get('id') or
+                              str(uuid.uuid4()))
+        return copy.deepcopy(package)
+
+    def package_show(self, context, data_dict):
+        package_id = self.names.get(data_dict['id'], data_dict['id'])
+        if package_id not in self.packages:
+            raise toolkit.ObjectNotFound('Dataset not found')
+        return copy.deepcopy(self.packages[package_id])
+
+    def package_update(self, context, data_dict):
+        existing = self.package_show(context, data_dict)
+        del self.names[existing['name']]
+        package = self._store(data_dict, id=existing['id'])
+        return copy.deepcopy(package)
+
+    def _store(self, data_dict, id):
+        package = dict(data_dict, id=id)
+        package.setdefault('state', 'active')
+        package['metadata_modified'] = datetime.datetime.utcnow().isoformat()
+        package['resources'] = [self._resource(resource, id)
+                                for resource in data_dict.get('resources', [])]
+        self.packages[id] = package
+        self.names[package['name']] = id
+        return package
+
+    def _resource(self, resource, package_id):
+        resource = dict(resource, package_id=package_id)
+        resource.setdefault('id', str(uuid.uuid4()))
+        upload = resource.pop('upload', None)
+        if upload is not None:
+            stream = getattr(upload, 'stream', None) or upload
+            while True:
+                chunk = stream.read(1024 * 1024)
+                if not chunk:
+                    break
+                self.uploaded_bytes += len(chunk)
+        return resource
+
+    def find_existing_packages(self, dataset_dicts):
+        '''Answers like ``create._find_existing_packages``.'''
+        existing = {}
+        for id_ in set(dataset_dict['id'] for dataset_dict in dataset_dicts):
+            package_id = id_ if id_ in self.packages else self.names.get(id_)
+            if package_id is not None:
+                existing[id_] = create._existing_package_summary(
+                    self.packages[package_id])
+        return existing
+
+    def upsert_molecules(self, rows, session=None):
+        '''Registers molecules like ``molecules.upsert_molecules``.'''
+        cache = molecule_registry.molecule_id_cache
+        molecule_ids = {}
+        for row in rows:
+            if not row or not row[1]:
+                continue
+            inchi_key, package_id = row[1], row[5]
+            molecule_id = cache.get(inchi_key)
+            if molecule_id is None:
+                molecule_id = self._molecule_id(row)
+                cache.set(inchi_key, molecule_id)
+            molecule_ids[inchi_key] = molecule_id
+            self.relations.setdefault(package_id, molecule_id)
+        return molecule_ids
+
+    def _molecule_id(self, row):
+        inchi_key = row[1]
+        if inchi_key not in self.molecules:
+            self.molecules[inchi_key] = (next(self._molecule_ids),) + row[:5]
+        return self.molecules[inchi_key][0]
+
+    def models(self):
+        '''Return stand-ins for the ``Molecules`` and
+        ``MolecularRelationData`` models.'''
+        return _Molecules(self), _MolecularRelationData(self)
+
+
+class _Molecules(object):
+
+    def __init__(self, ckan):
+        self._ckan = ckan
+
+    def _get_inchi_from_db(self, inchi_key):
+        row = self._ckan.molecules.get(inchi_key)
+        return (row[0],) if row else None
+
+    def create(self, standard_inchi, smiles, inchi_key, exact_mass,
+               mol_formula):
+        self._ckan._molecule_id(
+            (standard_inchi, inchi_key, smiles, exact_mass, mol_formula))
+
+
+class _MolecularRelationData(object):
+
+    def __init__(self, ckan):
+        self._ckan = ckan
+
+    def get_mol_formula_by_package_id(self, package_id):
+        return self._ckan.relations.get(package_id)
+
+    def create(self, molecule_id, package_id):
+        self._ckan.relations.setdefault(package_id, molecule_id)
+
+
+class _Session(object):
+
+    def begin_nested(self):
+        return contextlib.nullcontext()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def remove(self):
+        pass
+
+
+@contextlib.contextmanager
+def installed(ckan):
+    '''Run the import pipeline against ``ckan`` (an
+    :py:class:`InMemoryCkan`) within the context.'''
+    with contextlib.ExitStack() as stack:
+        for target, attribute, value in (
+                (toolkit, 'get_action', ckan.get_action),
+                (create, 'Session', _Session()),
+                (create, '_find_existing_packages',
+                 ckan.find_existing_packages),
+                (molecule_registry, 'upsert_molecules',
+                 ckan.upsert_molecules),
+                (molecule_registry, 'models', ckan.models)):
+            stack.enter_context(mock.patch.object(target, attribute, value))
+        yield ckan
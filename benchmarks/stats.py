@@ -0,0 +1,174 @@
+'''Per-stage timings, peak memory and baselines of benchmark runs.
+
+'''
+import collections
+import contextlib
+import functools
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+
+class StageTimer(object):
+    '''Collects the latency of every call to the stages of a pipeline.
+
+    Stages nest (a stage pulling records from an upstream generator runs the
+    upstream stage within its own), so the time of a call excludes that of
+    the stages it calls: the stage totals add up to the time spent in all of
+    them.
+
+    '''
+
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self._stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            self.samples[name].append(elapsed - nested)
+
+    def wrap(self, name, function):
+        '''Return ``function`` timing its calls as ``name``.'''
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed
+
+    def wrap_iterator(self, name, function):
+        '''Return ``function`` (which returns an iterable) timing the
+        production of every item of what it returns as ``name``.'''
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            return self.iterate(name, function(*args, **kwargs))
+        return timed
+
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self, wall_time):
+        '''Return the number of calls, total and share of ``wall_time`` and
+        latency percentiles (in milliseconds) of each stage, plus the time
+        spent outside of them as ``other``.'''
+        stages = {}
+        staged = 0.0
+        for name, samples in self.samples.items():
+            total = sum(samples)
+            staged += total
+            ordered = sorted(samples)
+            stages[name] = {
+                'calls': len(samples),
+                'total_s': total,
+                'share': total / wall_time if wall_time else 0.0,
+                'p50_ms': percentile(ordered, 50) * 1000,
+                'p90_ms': percentile(ordered, 90) * 1000,
+                'p99_ms': percentile(ordered, 99) * 1000,
+                'max_ms': ordered[-1] * 1000 if ordered else 0.0,
+            }
+        other = max(0.0, wall_time - staged)
+        stages['other'] = {
+            'calls': 0,
+            'total_s': other,
+            'share': other / wall_time if wall_time else 0.0,
+        }
+        return stages
+
+
+def percentile(ordered, p):
+    '''Return the ``p``-th percentile of the sorted ``ordered`` values,
+    interpolating between the closest ranks.'''
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def peak_rss():
+    '''Return the peak resident set size of this process and of its
+    (waited for) child processes, e.g. pool workers, in MiB.'''
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return tuple(
+        resource.getrusage(who).ru_maxrss * unit / (1024.0 * 1024.0)
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def save_baseline(path, result):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(result, baseline, tolerance=0.1, min_delta_ms=0.05):
+    '''Compare a benchmark result to a baseline.
+
+    Returns ``(line, regressed)`` tuples: the throughput, peak memory and
+    median and p90 latency of each stage, and whether they got worse than
+    the baseline by more than ``tolerance`` (a fraction). Latencies also
+    need to grow by ``min_delta_ms`` to count, so that sub-microsecond
+    noise on cheap stages isn't reported.
+
+    '''
+    lines = []
+
+    def check(label, current, previous, higher_is_better, unit,
+              min_delta=0.0):
+        if previous is None or current is None:
+            return
+        change = (current - previous) / previous if previous else 0.0
+        worse = -change if higher_is_better else change
+        regressed = (worse > tolerance and
+                     abs(current - previous) >= min_delta)
+        lines.append(('{0:<22} {1:>12.3f} -> {2:>12.3f} {3:<10} {4:+7.1%}'
+                      .format(label, previous, current, unit, change),
+                      regressed))
+
+    check('throughput', result['throughput'], baseline.get('throughput'),
+          True, 'records/s')
+    check('peak RSS', result['peak_rss_mib'], baseline.get('peak_rss_mib'),
+          False, 'MiB')
+    stages = baseline.get('stages', {})
+    for name, stage in sorted(result['stages'].items()):
+        previous = stages.get(name)
+        if not previous or 'p50_ms' not in stage:
+            continue
+        for key in ('p50_ms', 'p90_ms'):
+            check('{0} {1}'.format(name, key[:3]), stage[key],
+                  previous.get(key), False, 'ms', min_delta_ms)
+    return lines
@@ -0,0 +1,134 @@
+# encoding: utf-8
+'''``ckan datapackager`` commands.
+
+'''
+import click
+
+from ckanext.datapackager.lib.blobs import get_blob_store
+from ckanext.datapackager.lib.image_store import get_image_store
+
+
+@click.group(short_help='Data Packager commands.')
+def datapackager():
+    pass
+
+
+@datapackager.command('migrate-images')
+@click.argument('source', required=False)
+@click.option('--dry-run', is_flag=True,
+              help='Only count the images that would be moved.')
+def migrate_images(source, dry_run):
+    '''Move the images of a flat image directory (default: the configured
+    ``ckanext.datapackager.images_dir``) to their place in the sharded image
+    store, and index them.'''
+    store = get_image_store()
+    source = source or store.root
+    moved = store.migrate(source, dry_run=dry_run)
+    if dry_run:
+        click.echo(f'{moved} images would be moved from {source}')
+    else:
+        click.echo(f'{moved} images moved from {source} to {store.root}')
+
+
+@datapackager.command('rebuild-image-index')
+def rebuild_image_index():
+    '''Rebuild the index of the image store from the images on disk.'''
+    store = get_image_store()
+    count = store.rebuild_index()
+    click.echo(f'{count} images indexed in {store.root}')
+
+
+@datapackager.command('prune-blobs')
+@click.option('--dry-run', is_flag=True,
+              help='Only count the blobs that would be deleted.')
+def prune_blobs(dry_run):
+    '''Delete the deduplicated resource files (blobs) that no resource
+    uses any more.'''
+    store = get_blob_store()
+    count, size = store.prune(dry_run=dry_run)
+    if dry_run:
+        click.echo(f'{count} blobs ({size} bytes) would be deleted from {store.root}')
+    else:
+        click.echo(f'{count} blobs ({size} bytes) deleted from {store.root}')
+
+
+@datapackager.command('purge-datasets')
+@click.argument('ids', nargs=-1)
+@click.option('-q', '--query', help='Purge the datasets matching this Solr query.')
+@click.option('--chunk-size', type=int,
+              help='The number of datasets purged per transaction.')
+@click.confirmation_option(prompt='The datasets will be permanently deleted. Continue?')
+def purge_datasets(ids, query, chunk_size):
+    '''Purge the datasets with the given names or ids (or matching a
+    query), along with their molecule relations and related resources.'''
+    import ckan.model as model
+    import ckan.plugins.toolkit as toolkit
+
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+
+    def progress(done, total):
+        click.echo(f'{done} of {total} datasets processed')
+
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': site_user['name'],
+        'ignore_auth': True,
+        'purge_progress': progress,
+    }
+    try:
+        result = toolkit.get_action('purge_datasets_foreignkeys')(context, {
+            'ids': list(ids),
+            'q': query,
+            'chunk_size': chunk_size,
+        })
+    except toolkit.ValidationError as e:
+        if 'ids' in e.error_dict:
+            raise click.UsageError('Give the ids of the datasets, or a --query')
+        raise click.UsageError(str(e.error_dict))
+    click.echo(f"{result['purged']} datasets purged")
+    for name_or_id in result['not_found']:
+        click.echo(f'Not found: {name_or_id}', err=True)
+
+
+@datapackager.command('purge-orphaned-molecules')
+@click.option('--batch-size', type=int,
+              help='The number of molecules scanned per batch.')
+@click.option('--max-batches', type=int,
+              help='Stop after this many batches (the next run carries on '
+                   'from there).')
+@click.option('--remove-images', is_flag=True,
+              help='Also delete the images of the molecules.')
+@click.option('--restart', is_flag=True,
+              help='Scan from the first molecule, not from where the last '
+                   'run stopped.')
+@click.option('--dry-run', is_flag=True,
+              help='Only count the molecules that would be deleted.')
+def purge_orphaned_molecules(batch_size, max_batches, remove_images, restart,
+                             dry_run):
+    '''Delete the molecules no dataset is related to any more.'''
+    import ckan.model as model
+    import ckan.plugins.toolkit as toolkit
+
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': site_user['name'],
+        'ignore_auth': True,
+    }
+    result = toolkit.get_action('purge_orphaned_molecules')(context, {
+        'batch_size': batch_size,
+        'max_batches': max_batches,
+        'remove_images': remove_images,
+        'restart': restart,
+        'dry_run': dry_run,
+    })
+    if dry_run:
+        click.echo(f"{result['purged']} of {result['scanned']} molecules would be deleted")
+    else:
+        click.echo(f"{result['purged']} of {result['scanned']} molecules deleted, "
+                   f"{result['images_removed']} images removed")
+    if not result['completed'] and not dry_run:
+        click.echo(f"Stopped after molecule {result['watermark']}; "
+                   f"run again to carry on")
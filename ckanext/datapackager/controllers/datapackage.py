@@ -1,8 +1,14 @@
+import datetime
 import json
 
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
-from flask import make_response
+from flask import Response, make_response, stream_with_context
+
+from ckanext.datapackager.lib import export
+from ckanext.datapackager.lib import export_cache
+from ckanext.datapackager.lib import metrics as import_metrics
+from ckanext.datapackager.lib import zipstream
 
 
 def _authorize_or_abort(context):
@@ -62,6 +68,11 @@ def import_datapackage():
             params,
         )
 
+        if toolkit.asbool(params.get('background')):
+            toolkit.h.flash_notice(toolkit._(
+                'The Data Package is being imported in the background. '
+                'Import id: {0}').format(dataset['id']))
+
         if toolkit.check_ckan_version(min_version="2.9"):
             return toolkit.redirect_to('dataset.search')
         else:
@@ -78,6 +89,11 @@ def import_datapackage():
 def export_datapackage(package_id):
     '''Return the given dataset as a Data Package JSON file.
 
+    The rendered file is cached (see
+    :py:mod:`~ckanext.datapackager.lib.export_cache`) and sent with ``ETag``
+    and ``Last-Modified`` headers, and conditional requests for an unchanged
+    dataset are answered with a 304 without rendering it again.
+
     '''
     context = {
         'model': model,
@@ -85,24 +101,162 @@ def export_datapackage(package_id):
         'user': toolkit.c.user,
     }
 
-    r = make_response() if toolkit.check_ckan_version(min_version="2.9") else toolkit.response
+    pkg = model.Package.get(package_id)
+    if pkg is None:
+        return toolkit.abort(404, 'Dataset not found')
+    try:
+        toolkit.check_access('package_show', context, {'id': pkg.id})
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, 'Unauthorized to read dataset')
+
+    metadata_modified = pkg.metadata_modified
+    etag = export_cache.etag(pkg.id, metadata_modified)
+    flask = toolkit.check_ckan_version(min_version="2.9")
+
+    if flask and _not_modified(toolkit.request, etag, metadata_modified):
+        r = make_response('', 304)
+        _set_cache_headers(r, pkg, etag, metadata_modified)
+        return r
+
+    body = export_cache.get_export(pkg.id, metadata_modified)
+    if body is None:
+        try:
+            datapackage_dict = toolkit.get_action(
+                'package_show_as_datapackage')(
+                context,
+                {'id': pkg.id}
+            )
+        except toolkit.ObjectNotFound:
+            return toolkit.abort(404, 'Dataset not found')
+        body = json.dumps(datapackage_dict, indent=2)
+        export_cache.cache_export(pkg.id, metadata_modified, body)
+
+    r = make_response() if flask else toolkit.response
     r.content_disposition = 'attachment; filename=datapackage.json'.format(
         package_id)
     r.content_type = 'application/json'
+    if flask:
+        r.data = body
+        _set_cache_headers(r, pkg, etag, metadata_modified)
+        return r
+    else:
+        return body
+
+
+def export_datapackage_zip(package_id):
+    '''Stream the given dataset as a zip of its ``datapackage.json`` and
+    the files of its uploaded resources.
+
+    '''
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': toolkit.c.user,
+    }
     try:
-        datapackage_dict = toolkit.get_action(
-            'package_show_as_datapackage')(
-            context,
-            {'id': package_id}
-        )
+        dataset_dict = toolkit.get_action('package_show')(
+            context, {'id': package_id})
     except toolkit.ObjectNotFound:
         return toolkit.abort(404, 'Dataset not found')
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, 'Unauthorized to read dataset')
 
-    if toolkit.check_ckan_version(min_version="2.9"):
-        r.data = json.dumps(datapackage_dict, indent=2)
-        return r
+    r = Response(
+        stream_with_context(export.iter_datapackage_archive(dataset_dict)),
+        content_type='application/zip')
+    r.headers['Content-Disposition'] = \
+        'attachment; filename={0}.zip'.format(dataset_dict['name'])
+    return r
+
+
+def export_datapackages(format):
+    '''Stream the Data Packages of all the datasets matching a search (the
+    ``q`` and ``organization`` parameters), as NDJSON (one descriptor per
+    line) or as a zip of ``<dataset name>/datapackage.json`` files.
+
+    '''
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': toolkit.c.user,
+    }
+    if format not in ('ndjson', 'zip'):
+        return toolkit.abort(404, 'Unknown export format')
+    try:
+        toolkit.check_access('package_search', context)
+        organization = export.organization_name(
+            toolkit.request.args.get('organization'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, 'Unauthorized to search datasets')
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, 'Organization not found')
+
+    datapackages = export.iter_datapackages(
+        context, q=toolkit.request.args.get('q'), organization=organization)
+
+    if format == 'ndjson':
+        body = (json.dumps(datapackage_dict, separators=(',', ':')) + '\n'
+                for datapackage_dict in datapackages)
+        content_type = 'application/x-ndjson'
     else:
-        return json.dumps(datapackage_dict, indent=2)
+        body = zipstream.iter_zip(
+            ('{0}/datapackage.json'.format(datapackage_dict['name']),
+             json.dumps(datapackage_dict, indent=2).encode('utf-8'))
+            for datapackage_dict in datapackages)
+        content_type = 'application/zip'
+
+    r = Response(stream_with_context(body), content_type=content_type)
+    r.headers['Content-Disposition'] = \
+        'attachment; filename=datapackages.{0}'.format(format)
+    return r
+
+
+def metrics():
+    '''Return the metrics of the imports (see the ``datapackager_metrics``
+    action) in the Prometheus text format.'''
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': toolkit.c.user,
+    }
+    try:
+        result = toolkit.get_action('datapackager_metrics')(context, {})
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, 'Unauthorized to see the metrics')
+    return Response(import_metrics.prometheus_text(result),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _not_modified(request, etag, last_modified):
+    '''Return whether a conditional request is for the current version of
+    the export.'''
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since.
+        return request.if_none_match.contains_weak(etag.strip('"'))
+    if request.if_modified_since and last_modified:
+        return _http_date(last_modified) <= _utc(request.if_modified_since)
+    return False
+
+
+def _set_cache_headers(response, pkg, etag, last_modified):
+    response.headers['ETag'] = etag
+    if last_modified:
+        response.last_modified = _http_date(last_modified)
+    # Clients may keep the export, but must check it is still current.
+    response.headers['Cache-Control'] = \
+        'private, no-cache' if pkg.private else 'public, no-cache'
+
+
+def _utc(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def _http_date(value):
+    # CKAN stores naive UTC datetimes, and HTTP dates have no fractions of
+    # a second.
+    return _utc(value).replace(microsecond=0)
 
 
 if not toolkit.check_ckan_version(u'2.9'):
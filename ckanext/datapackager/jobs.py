@@ -0,0 +1,64 @@
+'''Background jobs run by the CKAN worker (``ckan jobs worker``).
+
+'''
+import logging
+import os
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from werkzeug.datastructures import FileStorage
+
+from ckanext.datapackager.lib.image_store import get_image_store
+from ckanext.datapackager.lib.images import render_molecule_images
+from ckanext.datapackager.lib.progress import ImportProgress
+
+log = logging.getLogger(__name__)
+
+
+def import_datapackage_job(job_id, data_dict, user, spool_path=None,
+                           filename=None, queued_at=None):
+    '''Import a spooled upload (or a URL) the same way
+    ``package_create_from_datapackage`` does, publishing progress as it goes.
+
+    The spooled file is removed once the import is done, whatever its
+    outcome.
+
+    '''
+    progress = ImportProgress(job_id, queued_at=queued_at, user=user,
+                              filename=filename)
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': user,
+        'import_progress': progress,
+        'background_import': True,
+    }
+    data_dict = dict(data_dict)
+    data_dict.pop('background', None)
+
+    progress.start()
+    try:
+        if spool_path:
+            with open(spool_path, 'rb') as f:
+                data_dict['upload'] = FileStorage(f, filename=filename)
+                toolkit.get_action('package_create_from_datapackage')(
+                    context, data_dict)
+        else:
+            toolkit.get_action('package_create_from_datapackage')(
+                context, data_dict)
+    except Exception as e:
+        log.error(f'Import {job_id} failed: {e}')
+        progress.finish(error=str(e) or e.__class__.__name__)
+        raise
+    else:
+        progress.finish()
+    finally:
+        if spool_path and os.path.exists(spool_path):
+            os.remove(spool_path)
+
+
+def render_molecule_images_job(items):
+    '''Render the images of ``(inchi_key, inchi)`` molecules queued by an
+    import.'''
+    rendered = render_molecule_images(items, get_image_store())
+    log.info(f'Rendered {rendered} of {len(items)} molecule images')
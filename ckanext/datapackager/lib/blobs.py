@@ -0,0 +1,149 @@
+'''Content-addressed storage of resource files.
+
+With ``ckanext.datapackager.deduplicate_resources`` on, the files the
+importer uploads as resources are stored once per distinct content, as
+``<blobs_dir>/<sha256[0:2]>/<sha256[2:4]>/<sha256>``, and the file of each
+resource is a hard link to its blob (see
+:py:mod:`~ckanext.datapackager.lib.ingest`). The SHA-256 is computed while
+the file is written, and is set as the ``hash`` of the resource.
+
+CKAN replaces the file of a resource (rather than writing over it) when a
+new one is uploaded, and only unlinks it when the resource is deleted, so
+the blobs shared with other resources are never modified. Blobs no
+resource links to any more are deleted by :py:meth:`BlobStore.prune`, once
+they are older than a grace period: an import links its resources to the
+blobs it adds only after creating its dataset.
+
+'''
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+# How long a blob no resource links to is kept, in hours.
+DEFAULT_GRACE_HOURS = 24
+
+
+class BlobStore(object):
+    '''A directory of files addressed by the SHA-256 of their content.
+
+    :param root: the directory the blobs are stored in
+    :type root: string
+    :param grace_hours: how long (since it was last added) a blob no
+        resource links to is kept by :py:meth:`prune`
+    :type grace_hours: float
+
+    '''
+
+    def __init__(self, root, grace_hours=DEFAULT_GRACE_HOURS):
+        self.root = root
+        self.grace_hours = grace_hours
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def add(self, fileobj):
+        '''Store the content of the binary file object ``fileobj``, read a
+        chunk at a time, unless a blob with the same content exists.
+
+        Returns the SHA-256 (hex digest), size and path of the blob, and
+        whether it was created.
+
+        '''
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+        sha256 = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.root, prefix='.blob-',
+                                         delete=False) as f:
+            temporary = f.name
+            try:
+                while True:
+                    chunk = fileobj.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            except Exception:
+                _remove(temporary)
+                raise
+
+        digest = sha256.hexdigest()
+        path = self.path_for(digest)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        try:
+            # A link (unlike a rename) never replaces an existing blob, which
+            # resources may be linked to, e.g. when another import stored
+            # the same content meanwhile.
+            os.link(temporary, path)
+            created = True
+        except FileExistsError:
+            created = False
+            # Restart the grace period of the blob, which may be about to
+            # be linked to again.
+            os.utime(path)
+        finally:
+            _remove(temporary)
+        return digest, size, path, created
+
+    def iter_blobs(self):
+        '''Yield the paths of the blobs.'''
+        for directory, subdirectories, filenames in os.walk(self.root):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                if not filename.startswith('.'):
+                    yield os.path.join(directory, filename)
+
+    def prune(self, dry_run=False):
+        '''Delete the blobs that no resource file is linked to any more,
+        and that were last added more than ``grace_hours`` ago. Returns the
+        number of blobs (that would be) deleted and their total size.'''
+        count = size = 0
+        cutoff = time.time() - self.grace_hours * 60 * 60
+        for path in self.iter_blobs():
+            stat = os.stat(path)
+            if stat.st_nlink > 1 or stat.st_mtime > cutoff:
+                continue
+            count += 1
+            size += stat.st_size
+            if not dry_run:
+                _remove(path)
+        return count, size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def deduplication_enabled():
+    import ckan.plugins.toolkit as toolkit
+    return toolkit.asbool(toolkit.config.get(
+        'ckanext.datapackager.deduplicate_resources', False))
+
+
+def get_blob_store():
+    '''Return the blob store configured with
+    ``ckanext.datapackager.blobs_dir`` (default:
+    ``<ckan.storage_path>/datapackager/blobs``) and
+    ``ckanext.datapackager.blob_prune_grace_hours`` (default:
+    :py:data:`DEFAULT_GRACE_HOURS`).'''
+    import ckan.plugins.toolkit as toolkit
+    config = toolkit.config
+    root = config.get('ckanext.datapackager.blobs_dir')
+    if not root:
+        root = os.path.join(config.get('ckan.storage_path') or
+                            tempfile.gettempdir(), 'datapackager', 'blobs')
+    grace_hours = float(config.get(
+        'ckanext.datapackager.blob_prune_grace_hours', DEFAULT_GRACE_HOURS))
+    return BlobStore(root, grace_hours=grace_hours)
@@ -0,0 +1,592 @@
+'''Single-pass parsing of CIF (Crystallographic Information File) data.
+
+:py:func:`iter_cif_blocks` tokenizes CIF text in memory, in one pass over
+its lines, into :py:class:`CifBlock` objects. Their metadata is read with
+:py:func:`cif_metadata`, and :py:func:`cif_atoms` hands their structure to
+ASE without writing (and re-reading) the CIF to disk.
+
+:py:class:`CifProcessor` processes the structures of many CIF files (e.g.
+the members of a zip or tar archive, see :py:func:`iter_cif_files`) in a
+pool of worker processes. Like :py:mod:`~ckanext.datapackager.lib.images`,
+this module must not import CKAN at module level.
+
+'''
+import itertools
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+log = logging.getLogger(__name__)
+
+_DATA = 'data'
+_LOOP = 'loop'
+_TAG = 'tag'
+_VALUE = 'value'
+
+# Comments, quoted strings (which end at a matching quote followed by
+# whitespace) and bare words.
+_TOKEN = re.compile(r'''(#.*)|'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)''')
+
+# Values marking an unknown (?) or inapplicable (.) item.
+_NULL_VALUES = ('?', '.')
+
+_ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2',
+                       '.tbz2', '.tar.xz', '.txz')
+
+
+class CifBlock(object):
+    '''A data block of a CIF file.
+
+    :ivar name: the name of the block (what follows ``data_``)
+    :ivar items: the values of the tags outside of loops, by tag
+    :ivar loops: the loops of the block, as ``(tags, rows)`` tuples
+
+    Tags are kept as found in the file; :py:meth:`get` and
+    :py:meth:`column` look them up ignoring case, and the difference
+    between the CIF 1 (``_cell_length_a``) and the mmCIF
+    (``_cell.length_a``) spellings.
+
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.items = {}
+        self.loops = []
+        self._index = {}
+        self._text = None
+        self._span = (0, 0)
+
+    def __getstate__(self):
+        # The text of the whole file isn't sent along with a block.
+        state = dict(self.__dict__)
+        state['_text'] = None
+        return state
+
+    @property
+    def source(self):
+        '''The text of the block in its CIF file (``None`` once the block
+        has been pickled).'''
+        if self._text is None:
+            return None
+        return self._text[self._span[0]:self._span[1]]
+
+    def get(self, *tags, **kwargs):
+        '''Return the value of the first of ``tags`` that the block has (the
+        first value of a loop column), or ``default``.'''
+        default = kwargs.get('default')
+        for tag in tags:
+            found = self._index.get(_normalize_tag(tag))
+            if found is None:
+                continue
+            if found[0] == _TAG:
+                value = self.items[found[1]]
+            else:
+                rows = self.loops[found[1]][1]
+                value = rows[0][found[2]] if rows else None
+            if value is not None and value not in _NULL_VALUES:
+                return value
+        return default
+
+    def column(self, tag):
+        '''Return the values of a loop column (a list with the value of
+        ``tag`` if it is not in a loop, or an empty one if the block has no
+        such tag).'''
+        found = self._index.get(_normalize_tag(tag))
+        if found is None:
+            return []
+        if found[0] == _TAG:
+            return [self.items[found[1]]]
+        return [row[found[2]] for row in self.loops[found[1]][1]]
+
+    def _set(self, tag, value):
+        self.items[tag] = value
+        self._index[_normalize_tag(tag)] = (_TAG, tag)
+
+    def _add_loop(self, tags, values):
+        width = len(tags)
+        if not width:
+            return
+        if len(values) % width:
+            log.warning(f'CIF block {self.name}: loop of {", ".join(tags)} '
+                        f'has an incomplete row, which is ignored')
+        rows = [values[i:i + width]
+                for i in range(0, len(values) - width + 1, width)]
+        loop_index = len(self.loops)
+        self.loops.append((tags, rows))
+        for column, tag in enumerate(tags):
+            self._index[_normalize_tag(tag)] = (_LOOP, loop_index, column)
+
+
+def _normalize_tag(tag):
+    return tag.lower().replace('.', '_')
+
+
+def iter_cif_blocks(text):
+    '''Parse CIF text, yielding its data blocks in order.
+
+    :param text: the content of a CIF file
+    :type text: string
+
+    :rtype: iterator of :py:class:`CifBlock`
+
+    '''
+    block = None
+    tag = None
+    loop_tags = None
+    loop_values = None
+    reading_loop_tags = False
+
+    for kind, token in _tokens(text):
+        if kind == _VALUE:
+            if tag is not None:
+                block._set(tag, token)
+                tag = None
+            elif loop_tags is not None:
+                reading_loop_tags = False
+                loop_values.append(token)
+            continue
+
+        if tag is not None:
+            log.warning(f'CIF tag {tag} has no value')
+            tag = None
+
+        if kind == _TAG and reading_loop_tags:
+            loop_tags.append(token)
+            continue
+
+        if loop_tags is not None:
+            block._add_loop(loop_tags, loop_values)
+            loop_tags = loop_values = None
+            reading_loop_tags = False
+
+        if kind == _DATA:
+            name, offset = token
+            if block is not None:
+                block._span = (block._span[0], offset)
+                yield block
+            block = CifBlock(name)
+            block._text = text
+            block._span = (offset, len(text))
+            continue
+
+        if block is None:
+            # Tags before the first data block (or in a global block).
+            block = CifBlock('')
+            block._text = text
+            block._span = (0, len(text))
+        if kind == _TAG:
+            tag = token
+        elif kind == _LOOP:
+            loop_tags = []
+            loop_values = []
+            reading_loop_tags = True
+
+    if loop_tags is not None:
+        block._add_loop(loop_tags, loop_values)
+    if block is not None:
+        yield block
+
+
+def _tokens(text):
+    '''Yield the ``(kind, token)`` tokens of CIF text. The token of a data
+    block header is its name and its offset in ``text``.'''
+    lines = iter(text.splitlines(True))
+    offset = 0
+    for raw_line in lines:
+        line_offset = offset
+        offset += len(raw_line)
+        line = raw_line.rstrip('\r\n')
+        if line.startswith(';'):
+            # A text field, which runs until a line starting with ';'.
+            field = [line[1:]]
+            for raw_line in lines:
+                offset += len(raw_line)
+                if raw_line.startswith(';'):
+                    break
+                field.append(raw_line.rstrip('\r\n'))
+            yield _VALUE, '\n'.join(field).strip()
+            continue
+
+        for match in _TOKEN.finditer(line):
+            comment, single_quoted, double_quoted, word = match.groups()
+            if comment is not None:
+                break
+            if single_quoted is not None:
+                yield _VALUE, single_quoted
+                continue
+            if double_quoted is not None:
+                yield _VALUE, double_quoted
+                continue
+            if word[0] == '_':
+                yield _TAG, word
+                continue
+            lower = word.lower()
+            if lower.startswith('data_'):
+                yield _DATA, (word[len('data_'):], line_offset + match.start())
+            elif lower == 'loop_':
+                yield _LOOP, None
+            elif lower.startswith('save_') or lower in ('global_', 'stop_'):
+                # Save frames are not used by crystal structures.
+                continue
+            else:
+                yield _VALUE, word
+
+
+def cif_metadata(block):
+    '''Return the metadata of a CIF data block needed for its dataset.
+
+    :returns: a dict with the ``identifier`` (``data_<name>``),
+        ``citation_title``, ``mol_formula``, ``molecule_name``, ``authors``
+        (a list) and ``extras`` (the space group) of the block, the missing
+        ones being ``'N/A'``
+    :rtype: dict
+
+    '''
+    authors = block.column('_citation_author_name')
+    citation_ids = block.column('_citation_author_citation_id')
+    if citation_ids and len(citation_ids) == len(authors):
+        # mmCIF lists the authors of every cited publication; keep the ones
+        # of the structure's own.
+        authors = [author for author, citation_id in zip(authors, citation_ids)
+                   if citation_id == 'primary']
+    if not authors:
+        authors = block.column('_publ_author_name')
+
+    extras = {}
+    space_group = block.get('_space_group_name_H-M_alt',
+                            '_symmetry_space_group_name_H-M')
+    if space_group:
+        extras['space_group_name_H-M'] = space_group
+    space_group_number = block.get('_space_group_IT_number',
+                                   '_symmetry_Int_Tables_number')
+    if space_group_number:
+        extras['space_group_IT_number'] = space_group_number
+
+    citation_title = block.get('_citation_title', '_publ_section_title')
+    return {
+        'identifier': 'data_' + block.name,
+        'citation_title': (' '.join(citation_title.split())
+                           if citation_title else 'N/A'),
+        'mol_formula': block.get('_chemical_formula_structural',
+                                 default='N/A'),
+        'molecule_name': block.get('_chemical_name_common', default='N/A'),
+        'authors': [author for author in authors
+                    if author and author not in _NULL_VALUES],
+        'extras': extras,
+    }
+
+
+def cif_atoms(block):
+    '''Return the structure of a CIF data block as an ASE ``Atoms`` object.
+
+    The tokenized block is handed to ASE as is, so the CIF is not parsed
+    a second time.
+
+    '''
+    from ase.io.cif import CIFBlock, convert_value
+
+    tags = {}
+    for tag, value in block.items.items():
+        tags[tag.lower()] = convert_value(value)
+    for loop_tags, rows in block.loops:
+        for column, tag in enumerate(loop_tags):
+            tags[tag.lower()] = [convert_value(row[column]) for row in rows]
+    return CIFBlock(block.name, tags).get_atoms()
+
+
+def is_cif_file(filename):
+    return filename.lower().endswith('.cif')
+
+
+def is_cif_archive(filename):
+    '''Return whether ``filename`` is that of a zip or tar archive (which
+    may hold CIF files).'''
+    return filename.lower().endswith(_ARCHIVE_EXTENSIONS)
+
+
+def is_cif_upload(fileobj, filename):
+    '''Return whether an upload is a CIF file, or an archive of CIF files.
+
+    Zip archives are only considered archives of CIF files if they contain
+    one (and no ``datapackage.json``), as Data Packages are zipped too.
+
+    '''
+    lower = filename.lower()
+    if is_cif_file(lower):
+        return True
+    if not is_cif_archive(lower):
+        return False
+    if not lower.endswith('.zip'):
+        return True
+    try:
+        position = fileobj.tell()
+        try:
+            with zipfile.ZipFile(fileobj) as archive:
+                names = archive.namelist()
+        finally:
+            fileobj.seek(position)
+    except (AttributeError, OSError, zipfile.BadZipFile):
+        return False
+    return (any(_is_cif_member(name) for name in names) and
+            not any(os.path.basename(name) == 'datapackage.json'
+                    for name in names))
+
+
+def iter_cif_files(fileobj, filename):
+    '''Yield the ``(filename, data)`` of the CIF files of an upload: the
+    upload itself if it is a CIF file, or the CIF members of a zip or tar
+    archive.
+
+    Archive members are read one at a time.
+
+    :raises ValueError: if ``fileobj`` is not a valid archive
+
+    '''
+    lower = filename.lower()
+    if not is_cif_archive(lower):
+        yield os.path.basename(filename), fileobj.read()
+        return
+
+    if lower.endswith('.zip'):
+        with _seekable(fileobj) as seekable:
+            try:
+                archive = zipfile.ZipFile(seekable)
+            except zipfile.BadZipFile as e:
+                raise ValueError(f'Invalid zip archive: {e}')
+            with archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and _is_cif_member(info.filename):
+                        yield (os.path.basename(info.filename),
+                               archive.read(info))
+        return
+
+    try:
+        # A stream, so that the archive doesn't need to be seekable.
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and _is_cif_member(member.name):
+                    yield (os.path.basename(member.name),
+                           archive.extractfile(member).read())
+    except tarfile.TarError as e:
+        raise ValueError(f'Invalid tar archive: {e}')
+
+
+def _is_cif_member(name):
+    basename = os.path.basename(name)
+    return (is_cif_file(basename) and not basename.startswith('.') and
+            not name.startswith('__MACOSX/'))
+
+
+class _seekable(object):
+    '''Context manager returning ``fileobj`` if it is seekable, or a
+    seekable (temporary) copy of it.'''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.copy = None
+
+    def __enter__(self):
+        try:
+            if self.fileobj.seekable():
+                return self.fileobj
+        except AttributeError:
+            pass
+        self.copy = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+        shutil.copyfileobj(self.fileobj, self.copy)
+        self.copy.seek(0)
+        return self.copy
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.copy is not None:
+            self.copy.close()
+
+
+def decode_cif(data):
+    '''Decode the bytes of a CIF file (UTF-8, or failing that Latin-1,
+    which older CIFs may be written in).'''
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def process_cif_structure(item):
+    '''Compute the mass and render the image of a CIF data block. Meant to
+    be run in the worker processes of a :py:class:`CifProcessor`.
+
+    :param item: ``(block, store)``, ``store`` being the
+        :py:class:`~ckanext.datapackager.lib.image_store.ImageStore` to write
+        the image to (or ``None`` not to render it)
+    :type item: tuple
+
+    :returns: a dict with the :py:func:`cif_metadata` of the block, its
+        ``exactmass`` and whether its image was rendered (``image``, ``None``
+        if it failed), or with the ``error`` that prevented processing it
+    :rtype: dict
+
+    '''
+    block, store = item
+    try:
+        structure = cif_metadata(block)
+        atoms = cif_atoms(block)
+        exact_mass = atoms.get_masses().sum() if atoms else 'N/A'
+        structure['exactmass'] = str(exact_mass) if exact_mass else 'N/A'
+    except Exception as e:
+        return {'identifier': 'data_' + block.name, 'error': str(e)}
+
+    structure['image'] = False
+    if store is not None and not store.contains(structure['identifier']):
+        try:
+            render_structure_image(
+                atoms, store.path_for(structure['identifier'],
+                                      create_dirs=True))
+            structure['image'] = True
+        except Exception as e:
+            log.error(f'3D CIF image for {structure["identifier"]} '
+                      f'not possible: {e}')
+            structure['image'] = None
+    return structure
+
+
+def render_structure_image(atoms, path):
+    '''Save a 300x300 px image of ``atoms`` to ``path``.'''
+    # A Figure of its own rather than pyplot, which keeps global state and
+    # needs a GUI backend.
+    from ase.visualize.plot import plot_atoms
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(1, 1), dpi=100)
+    ax = fig.add_subplot()
+    plot_atoms(atoms, ax, rotation=('45x,45y,0z'), radii=0.4, scale=0.8,
+               show_unit_cell=0)
+    ax.axis('off')
+    fig.savefig(path, dpi=300, transparent=True)
+
+
+class CifProcessor(object):
+    '''Processes the structures of CIF files in a pool of worker processes,
+    a batch at a time.
+
+    Use it as a context manager, which shuts the pool down when left.
+
+    :param store: the store the images of the structures are written to
+        (optional, images are not rendered if ``None``)
+    :type store: :py:class:`~ckanext.datapackager.lib.image_store.ImageStore`
+    :param processes: the maximum number of worker processes (default: the
+        number of CPUs, ``0`` processes the structures in the current
+        process); the pool is never larger than the first batch it
+        processes
+    :type processes: int
+    :param batch_size: the number of structures per batch
+    :type batch_size: int
+    :param maxtasksperchild: the number of structures a worker process
+        handles before it is replaced
+    :type maxtasksperchild: int
+    :param inline_threshold: batches of fewer structures are processed in
+        the current process as long as no pool has been started
+    :type inline_threshold: int
+
+    '''
+
+    def __init__(self, store=None, processes=None, batch_size=500,
+                 maxtasksperchild=100, inline_threshold=8):
+        self.store = store
+        self.processes = processes
+        self.batch_size = batch_size
+        self.maxtasksperchild = maxtasksperchild
+        self.inline_threshold = inline_threshold
+        self._pool = None
+        self._pool_processes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def process(self, files):
+        '''Yield the processed structures of the ``(filename, data)`` CIF
+        files, as lists of ``(structure, resource)`` tuples, one list per
+        batch.
+
+        ``structure`` is as returned by :py:func:`process_cif_structure`,
+        and ``resource`` is the ``(filename, data)`` of the CIF of the
+        structure: the whole file if it has a single data block, or the
+        text of the block otherwise. The next batch is processed while the
+        current one is being consumed.
+
+        '''
+        batches = self._batches(files)
+        pending = None
+        for batch in batches:
+            if self.processes == 0 or (
+                    pending is None and self._pool is None and
+                    len(batch) < self.inline_threshold):
+                # Not worth starting worker processes for.
+                yield self._collect(batch, [
+                    process_cif_structure((block, self.store))
+                    for block, resource in batch])
+                continue
+            pool = self._get_pool(len(batch))
+            submitted = (batch, pool.map_async(
+                process_cif_structure,
+                [(block, self.store) for block, resource in batch],
+                chunksize=max(1, len(batch) // (4 * self._pool_processes))))
+            if pending is not None:
+                yield self._collect(pending[0], pending[1].get())
+            pending = submitted
+        if pending is not None:
+            yield self._collect(pending[0], pending[1].get())
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _batches(self, files):
+        blocks = self._iter_blocks(files)
+        while True:
+            batch = list(itertools.islice(blocks, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def _iter_blocks(self, files):
+        for filename, data in files:
+            try:
+                blocks = list(iter_cif_blocks(decode_cif(data)))
+            except Exception as e:
+                log.error(f'CIF file {filename} could not be parsed: {e}')
+                continue
+            if len(blocks) == 1:
+                yield blocks[0], (filename, data)
+                continue
+            for block in blocks:
+                yield block, (f'{block.name}.cif',
+                              block.source.encode('utf-8'))
+
+    def _collect(self, batch, structures):
+        if self.store is not None:
+            self.store.add([structure['identifier']
+                            for structure in structures
+                            if structure.get('image') is not None and
+                            not structure.get('error')])
+        return [(structure, resource)
+                for structure, (block, resource) in zip(structures, batch)]
+
+    def _pool_size(self, items):
+        return max(1, min(self.processes or os.cpu_count() or 1, items))
+
+    def _get_pool(self, items):
+        if self._pool is None:
+            context = multiprocessing.get_context('spawn')
+            self._pool_processes = self._pool_size(items)
+            self._pool = context.Pool(self._pool_processes,
+                                      maxtasksperchild=self.maxtasksperchild)
+        return self._pool
@@ -0,0 +1,154 @@
+'''Export of many datasets as Data Packages.
+
+Datasets are fetched from the search index a page at a time, already
+dictized (``package_search`` returns the dataset dicts stored in the index,
+without a ``package_show`` per dataset), and paged by id so that exporting
+the whole catalog never needs deep offsets into the search results.
+
+'''
+import json
+import os.path
+import zipfile
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from frictionless_ckan_mapper import ckan_to_frictionless as converter
+
+import ckanext.datapackager.exceptions as exceptions
+from ckanext.datapackager.lib import zipstream
+from ckanext.datapackager.lib.util import get_path_to_resource_file
+
+DEFAULT_PAGE_SIZE = 500
+
+
+def page_size(rows=None):
+    '''Return the number of datasets fetched per page: ``rows`` (or
+    ``ckanext.datapackager.export_page_size``), capped to the maximum number
+    of rows a search may return.'''
+    config = toolkit.config
+    rows = toolkit.asint(rows or config.get(
+        'ckanext.datapackager.export_page_size', DEFAULT_PAGE_SIZE))
+    rows_max = toolkit.asint(config.get('ckan.search.rows_max', 1000))
+    return max(1, min(rows, rows_max))
+
+
+def search_datapackages(context, q=None, organization=None, rows=None,
+                        after=None):
+    '''Return a page of the datasets matching a search, as Data Packages.
+
+    :param q: the Solr query (default: all datasets)
+    :param organization: the name of the organization the datasets must
+        belong to (optional)
+    :param rows: the size of the page (default: :py:func:`page_size`)
+    :param after: the id of the last dataset of the previous page (optional,
+        default: return the first page)
+
+    :returns: the number of datasets matching the search from ``after`` on,
+        the Data Packages of the page and the id to pass as ``after`` to get
+        the next page (``None`` if this is the last one)
+    :rtype: tuple
+
+    '''
+    rows = page_size(rows)
+    fq = []
+    if organization:
+        fq.append('+organization:{0}'.format(_quote(organization)))
+    if after:
+        fq.append('+id:{{{0} TO *]'.format(_quote(after)))
+
+    result = toolkit.get_action('package_search')(dict(context), {
+        'q': q or '*:*',
+        'fq': ' '.join(fq),
+        'sort': 'id asc',
+        'rows': rows,
+        'include_private': True,
+    })
+    packages = result['results']
+    next_after = packages[-1]['id'] if len(packages) == rows else None
+    return (result['count'],
+            [converter.dataset(package) for package in packages],
+            next_after)
+
+
+def iter_datapackages(context, q=None, organization=None, rows=None):
+    '''Yield the Data Packages of all the datasets matching a search.
+
+    Only one page of datasets is held in memory at a time.
+
+    '''
+    after = None
+    while True:
+        count, datapackages, after = search_datapackages(
+            context, q=q, organization=organization, rows=rows, after=after)
+        for datapackage in datapackages:
+            yield datapackage
+        if after is None:
+            return
+
+
+def organization_name(organization):
+    '''Return the name of the organization with the given name or id (or
+    ``None`` if no organization is given).
+
+    :raises ckan.plugins.toolkit.ObjectNotFound: if there is no such
+        organization
+
+    '''
+    if not organization:
+        return None
+    group = model.Group.get(organization)
+    if group is None or not group.is_organization:
+        raise toolkit.ObjectNotFound('Organization not found')
+    return group.name
+
+
+def iter_datapackage_archive(dataset_dict):
+    '''Yield the bytes of a zip of a dataset as a Data Package: its
+    ``datapackage.json`` and the files of its uploaded resources (under
+    ``data/``, where the ``path`` of their resources in the descriptor
+    points to).
+
+    The files are read and sent a chunk at a time, and stored in the zip as
+    they are (they are often compressed already).
+
+    '''
+    descriptor = converter.dataset(dataset_dict)
+    descriptor_resources = descriptor.get('resources', [])
+
+    files = []
+    names = set()
+    for i, resource in enumerate(dataset_dict.get('resources', [])):
+        if resource.get('url_type') != 'upload':
+            continue
+        try:
+            path = get_path_to_resource_file(resource)
+        except exceptions.ResourceFileDoesNotExistException:
+            continue
+        name = _archive_name(resource, names)
+        files.append((name, path))
+        if i < len(descriptor_resources):
+            descriptor_resources[i]['path'] = name
+
+    return zipstream.iter_zip(_archive_members(descriptor, files))
+
+
+def _archive_members(descriptor, files):
+    yield 'datapackage.json', json.dumps(descriptor, indent=2).encode('utf-8')
+    for name, path in files:
+        with open(path, 'rb') as f:
+            yield name, f, zipfile.ZIP_STORED
+
+
+def _archive_name(resource, names):
+    filename = os.path.basename(resource.get('url') or '').split('?')[0]
+    filename = filename or resource['id']
+    name = 'data/' + filename
+    if name in names:
+        name = 'data/{0}-{1}'.format(resource['id'], filename)
+    names.add(name)
+    return name
+
+
+def _quote(value):
+    return '"{0}"'.format(
+        str(value).replace('\\', '\\\\').replace('"', '\\"'))
@@ -0,0 +1,92 @@
+'''Caching of the ``datapackage.json`` exports of datasets.
+
+Exports are stored in Redis, so they are shared by all the CKAN processes,
+keyed by dataset id and tagged with the ``metadata_modified`` of the
+dataset they were rendered from: an export rendered before the dataset was
+last modified is never served. The plugin also drops the export of a
+dataset when it is updated or deleted.
+
+'''
+import datetime
+import hashlib
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+# How long an export is kept (in seconds) if the dataset isn't modified.
+DEFAULT_TTL = 24 * 60 * 60
+
+# Changes whenever the rendering of exports does, so that neither this
+# cache nor the HTTP caches of clients keep exports rendered the old way.
+_FORMAT_VERSION = '1'
+
+
+def _redis_key(package_id):
+    return 'ckanext-datapackager:export:{0}'.format(package_id)
+
+
+def _connect():
+    # Imported here so that this module can be used without a CKAN config.
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def _ttl():
+    import ckan.plugins.toolkit as toolkit
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.export_cache_ttl', DEFAULT_TTL))
+
+
+def _version(metadata_modified):
+    if isinstance(metadata_modified, datetime.datetime):
+        return metadata_modified.isoformat()
+    return str(metadata_modified)
+
+
+def etag(package_id, metadata_modified):
+    '''Return the (quoted) ETag of the export of a dataset.'''
+    digest = hashlib.sha1('{0}|{1}|{2}'.format(
+        package_id, _version(metadata_modified), _FORMAT_VERSION
+    ).encode('utf-8')).hexdigest()
+    return '"{0}"'.format(digest)
+
+
+def get_export(package_id, metadata_modified):
+    '''Return the cached export of a dataset, or ``None`` if there is none
+    for its current version.'''
+    if _ttl() <= 0:
+        return None
+    try:
+        value = _connect().get(_redis_key(package_id))
+    except Exception as e:
+        log.warning(f'Could not read the cached export of {package_id}: {e}')
+        return None
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    cached = json.loads(value)
+    if cached.get('version') != _version(metadata_modified):
+        return None
+    return cached['body']
+
+
+def cache_export(package_id, metadata_modified, body):
+    '''Cache the export ``body`` of the given version of a dataset.'''
+    ttl = _ttl()
+    if ttl <= 0:
+        return
+    value = json.dumps({'version': _version(metadata_modified), 'body': body})
+    try:
+        _connect().setex(_redis_key(package_id), ttl, value)
+    except Exception as e:
+        log.warning(f'Could not cache the export of {package_id}: {e}')
+
+
+def invalidate(package_id):
+    '''Drop the cached export of a dataset.'''
+    try:
+        _connect().delete(_redis_key(package_id))
+    except Exception as e:
+        log.warning(f'Could not drop the cached export of {package_id}: {e}')
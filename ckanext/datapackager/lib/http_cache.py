@@ -0,0 +1,208 @@
+'''Fetching of remote Data Package descriptors, with an HTTP cache.
+
+URL imports fetch their descriptor through a pooled ``requests`` session
+(one per thread), so that the connections to an upstream server are reused
+from one import to the next. Responses carrying an ``ETag`` or a
+``Last-Modified`` header are kept on disk, and fetching their URL again is a
+conditional request: an unchanged descriptor costs a ``304 Not Modified``
+and is read from the cache.
+
+Each cached response is a ``<sha1 of url>.json`` file holding the
+validators of the response next to a ``<sha1 of url>.body`` file with its
+content. Both are replaced atomically.
+
+'''
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 60
+# The number of connections kept open per host.
+POOL_SIZE = 10
+
+_local = threading.local()
+
+
+def get_session():
+    '''Return the ``requests`` session of the current thread.'''
+    session = getattr(_local, 'session', None)
+    if session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                              pool_maxsize=POOL_SIZE, max_retries=3)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return session
+
+
+class CachedResponse(object):
+    '''The content of a fetched URL.
+
+    :ivar content: the body of the response
+    :ivar from_cache: whether it was read from the cache (after a ``304``)
+    :ivar status_code: the status of the response (``304`` if
+        ``from_cache``)
+
+    '''
+
+    def __init__(self, url, content, headers, status_code, from_cache):
+        self.url = url
+        self.content = content
+        self.headers = headers
+        self.status_code = status_code
+        self.from_cache = from_cache
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class HttpCache(object):
+    '''An on-disk cache of HTTP responses, revalidated with conditional
+    requests.
+
+    :param directory: the directory the responses are stored in (``None``
+        fetches without a cache)
+    :type directory: string
+    :param session: the ``requests`` session to fetch with (default: the
+        pooled session of the thread, see :py:func:`get_session`)
+    :param timeout: the timeout of requests, in seconds
+    :type timeout: float
+
+    '''
+
+    def __init__(self, directory=None, session=None, timeout=DEFAULT_TIMEOUT):
+        self.directory = directory
+        self.session = session
+        self.timeout = timeout
+
+    def fetch(self, url):
+        '''Fetch ``url``, or revalidate its cached response.
+
+        :rtype: :py:class:`CachedResponse`
+
+        :raises requests.RequestException: if the request fails, or its
+            response has an error status
+
+        '''
+        cached = self._read_meta(url)
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        session = self.session or get_session()
+        response = session.get(url, headers=headers, timeout=self.timeout)
+
+        if response.status_code == 304 and cached:
+            content = self._read_body(url)
+            if content is not None:
+                log.debug(f'{url} not modified, read from the cache')
+                return CachedResponse(url, content, cached.get('headers', {}),
+                                      304, True)
+            # The body is gone: fetch it again, unconditionally.
+            self.invalidate(url)
+            return self.fetch(url)
+
+        response.raise_for_status()
+        content = response.content
+        self._store(url, response, content)
+        return CachedResponse(url, content, dict(response.headers),
+                              response.status_code, False)
+
+    def invalidate(self, url):
+        for path in self._paths(url):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _store(self, url, response, content):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not self.directory:
+            return
+        if not (etag or last_modified) or \
+                'no-store' in response.headers.get('Cache-Control', ''):
+            # Nothing to revalidate it with (or not to be stored).
+            self.invalidate(url)
+            return
+
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'headers': {
+                'Content-Type': response.headers.get('Content-Type'),
+            },
+            'fetched_at': time.time(),
+        }
+        meta_path, body_path = self._paths(url)
+        try:
+            # The body goes first: a validator is never stored without it.
+            _write_atomically(body_path, content)
+            _write_atomically(meta_path,
+                              json.dumps(meta).encode('utf-8'))
+        except OSError as e:
+            log.warning(f'Could not cache the response of {url}: {e}')
+
+    def _read_meta(self, url):
+        if not self.directory:
+            return None
+        try:
+            with open(self._paths(url)[0]) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('url') == url else None
+
+    def _read_body(self, url):
+        try:
+            with open(self._paths(url)[1], 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return (os.path.join(self.directory, key + '.json'),
+                os.path.join(self.directory, key + '.body'))
+
+
+def _write_atomically(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+
+def get_http_cache():
+    '''Return the HTTP cache configured with
+    ``ckanext.datapackager.http_cache_dir`` (default:
+    ``<ckan.storage_path>/datapackager/http-cache``; set it to an empty value
+    to disable the cache) and ``ckanext.datapackager.http_timeout``.'''
+    import ckan.plugins.toolkit as toolkit
+    config = toolkit.config
+    directory = config.get('ckanext.datapackager.http_cache_dir')
+    if directory is None:
+        storage_path = config.get('ckan.storage_path')
+        directory = os.path.join(storage_path, 'datapackager', 'http-cache') \
+            if storage_path else None
+    return HttpCache(
+        directory=directory or None,
+        timeout=float(config.get('ckanext.datapackager.http_timeout',
+                                 DEFAULT_TIMEOUT)),
+    )
@@ -0,0 +1,231 @@
+'''Storage of the molecule and crystal structure images.
+
+Images are stored as ``<key>.png`` files (the key being an InChIKey, or a
+CIF data block name) under a root directory. To keep directories small, they
+can be sharded by the first bytes of the SHA-1 hash of their key, e.g. with
+a shard depth of 2::
+
+    <root>/3f/a2/UHOVQNZJYSORNB-UHFFFAOYSA-N.png
+
+The keys that have an image are kept in a SQLite index next to the images,
+so checking whether an image exists needs no ``stat`` call on the (possibly
+huge) image directories.
+
+'''
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_IMAGES_DIR = '/var/lib/ckan/default/storage/images'
+INDEX_FILENAME = '.image-index.sqlite3'
+EXTENSION = '.png'
+
+
+class ImageStore(object):
+    '''A directory of images, addressed by key.
+
+    :param root: the directory the images are stored in
+    :type root: string
+    :param shard_depth: the number of levels of hash-prefix directories (0
+        stores all images directly in ``root``)
+    :type shard_depth: int
+
+    '''
+
+    def __init__(self, root=DEFAULT_IMAGES_DIR, shard_depth=0):
+        self.root = root
+        self.shard_depth = shard_depth
+        self._index = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # The index (and its SQLite connection) is not shared with the
+        # processes a store is sent to; they open their own.
+        return {'root': self.root, 'shard_depth': self.shard_depth}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def relative_path(self, key):
+        filename = str(key) + EXTENSION
+        if not self.shard_depth:
+            return filename
+        digest = hashlib.sha1(str(key).encode('utf-8')).hexdigest()
+        shards = [digest[2 * level:2 * level + 2]
+                  for level in range(self.shard_depth)]
+        return os.path.join(*(shards + [filename]))
+
+    def path_for(self, key, create_dirs=False):
+        '''Return the path of the image of ``key`` (whether it exists or
+        not), creating its shard directories if asked to.'''
+        path = os.path.join(self.root, self.relative_path(key))
+        if create_dirs:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+        return path
+
+    def contains(self, key):
+        '''Return whether the index has an image for ``key``.'''
+        return self._get_index().contains(key)
+
+    def add(self, keys):
+        '''Record that images have been stored for ``keys``.'''
+        self._get_index().add(keys)
+
+    def remove(self, keys):
+        '''Delete the images of ``keys``, and remove them from the index.
+        Returns the number of files deleted.'''
+        keys = list(keys)
+        removed = 0
+        for key in keys:
+            try:
+                os.remove(self.path_for(key))
+                removed += 1
+            except OSError:
+                pass
+        self._get_index().discard(keys)
+        return removed
+
+    def iter_keys(self):
+        '''Yield the keys of the images found on disk.'''
+        for directory, subdirectories, filenames in os.walk(self.root):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(EXTENSION):
+                    yield filename[:-len(EXTENSION)]
+
+    def rebuild_index(self):
+        '''Rebuild the index from the images found on disk. Returns the
+        number of images indexed.'''
+        index = self._get_index()
+        index.clear()
+        count = 0
+        batch = []
+        for key in self.iter_keys():
+            batch.append(key)
+            if len(batch) >= 1000:
+                index.add(batch)
+                count += len(batch)
+                batch = []
+        index.add(batch)
+        return count + len(batch)
+
+    def migrate(self, source, dry_run=False):
+        '''Move the images found directly in the ``source`` directory (e.g. an
+        old flat image directory) to their place in this store.
+
+        Returns the number of images moved.
+
+        '''
+        moved = 0
+        batch = []
+        for entry in os.scandir(source):
+            if not entry.is_file() or not entry.name.endswith(EXTENSION):
+                continue
+            key = entry.name[:-len(EXTENSION)]
+            target = self.path_for(key, create_dirs=not dry_run)
+            if os.path.abspath(target) == os.path.abspath(entry.path):
+                batch.append(key)
+                continue
+            moved += 1
+            if dry_run:
+                continue
+            shutil.move(entry.path, target)
+            batch.append(key)
+            if len(batch) >= 1000:
+                self.add(batch)
+                batch = []
+        if not dry_run:
+            self.add(batch)
+        return moved
+
+    def _get_index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    if not os.path.isdir(self.root):
+                        os.makedirs(self.root, exist_ok=True)
+                    self._index = _SQLiteIndex(
+                        os.path.join(self.root, INDEX_FILENAME))
+        return self._index
+
+
+class _SQLiteIndex(object):
+    '''The set of stored keys, kept in a SQLite file and cached in memory.
+
+    The in-memory copy is loaded on first use, so keys added by other
+    processes afterwards are only seen by this one after ``reload()``.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._keys = None
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30,
+                                           check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS images (key TEXT PRIMARY KEY)')
+
+    def reload(self):
+        with self._lock:
+            self._keys = set(row[0] for row in self._connection.execute(
+                'SELECT key FROM images'))
+
+    def contains(self, key):
+        if self._keys is None:
+            self.reload()
+        return key in self._keys
+
+    def add(self, keys):
+        keys = [key for key in keys if key]
+        if not keys:
+            return
+        if self._keys is None:
+            self.reload()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO images (key) VALUES (?)',
+                [(key,) for key in keys])
+            self._keys.update(keys)
+
+    def discard(self, keys):
+        keys = list(keys)
+        if self._keys is None:
+            self.reload()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'DELETE FROM images WHERE key = ?', [(key,) for key in keys])
+            self._keys.difference_update(keys)
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM images')
+            self._keys = set()
+
+
+_store = None
+
+
+def get_image_store():
+    '''Return the image store configured with
+    ``ckanext.datapackager.images_dir`` and
+    ``ckanext.datapackager.image_store_shard_depth``.'''
+    global _store
+    if _store is None:
+        import ckan.plugins.toolkit as toolkit
+        config = toolkit.config
+        _store = ImageStore(
+            root=config.get('ckanext.datapackager.images_dir',
+                            DEFAULT_IMAGES_DIR),
+            shard_depth=toolkit.asint(config.get(
+                'ckanext.datapackager.image_store_shard_depth', 0)),
+        )
+    return _store
@@ -0,0 +1,215 @@
+'''Rendering of molecule images, as a separate stage of the import.
+
+Imports hand the molecules of their datasets to a
+:py:class:`MoleculeImageRenderer`, which renders each distinct InChIKey once,
+either in a pool of worker processes while the import goes on, in a
+background job, or inline.
+
+This module must not import CKAN (or RDKit) at module level, as it is
+imported again by every worker process of the pool.
+
+'''
+import logging
+import multiprocessing
+import os
+
+from ckanext.datapackager.lib.image_store import ImageStore
+
+log = logging.getLogger(__name__)
+
+POOL = 'pool'
+JOB = 'job'
+INLINE = 'inline'
+
+# Batches of fewer images than this are rendered inline rather than by
+# starting a pool of worker processes (which each import RDKit).
+DEFAULT_INLINE_THRESHOLD = 8
+
+
+def molecule_image_item(package):
+    '''Return the ``(inchi_key, inchi)`` to render for a dataset dict, or
+    ``None`` if it has no (standard) InChI.
+
+    ``inchi_key`` is ``None`` when the dataset has none; it is then computed
+    from the InChI when rendering.
+
+    '''
+    standard_inchi = package.get('inchi')
+    if not standard_inchi or not standard_inchi.startswith('InChI'):
+        return None
+    return (package.get('inchi_key') or None, standard_inchi)
+
+
+def render_molecule_image(item):
+    '''Render one molecule image. Returns the InChIKey and whether an image
+    was written (``None`` if it failed).
+
+    :param item: ``(inchi_key, inchi, store)``, ``store`` being the
+        :py:class:`~ckanext.datapackager.lib.image_store.ImageStore` to
+        write the image to
+    :type item: tuple
+
+    '''
+    inchi_key, standard_inchi, store = item
+    try:
+        from rdkit.Chem import inchi
+        from rdkit.Chem import Draw
+
+        if not inchi_key:
+            inchi_key = inchi.InchiToInchiKey(standard_inchi)
+        filepath = store.path_for(inchi_key, create_dirs=True)
+        if os.path.isfile(filepath):
+            return inchi_key, False
+
+        molecule = inchi.MolFromInchi(standard_inchi)
+        Draw.MolToFile(molecule, filepath)
+        return inchi_key, True
+    except Exception as e:
+        log.error(f'Molecule image for {inchi_key or standard_inchi} not possible: {e}')
+        return inchi_key, None
+
+
+def render_molecule_images(items, store):
+    '''Render the images of ``(inchi_key, inchi)`` items one after the other,
+    and add them to the index of ``store``. Returns the number of images
+    written.'''
+    rendered = 0
+    stored = []
+    for inchi_key, standard_inchi in items:
+        if inchi_key and store.contains(inchi_key):
+            continue
+        inchi_key, written = render_molecule_image(
+            (inchi_key, standard_inchi, store))
+        if written is not None:
+            stored.append(inchi_key)
+        if written:
+            rendered += 1
+    store.add(stored)
+    return rendered
+
+
+class MoleculeImageRenderer(object):
+    '''Renders the molecule images of an import, each InChIKey only once.
+
+    Use it as a context manager: leaving the context waits for the pending
+    images (in ``pool`` mode) and shuts the pool down.
+
+    :param mode: ``'pool'`` to render in worker processes while the import
+        goes on, ``'job'`` to queue a background job per submitted batch or
+        ``'inline'`` to render right away in the current process
+    :type mode: string
+    :param store: the store the images are written to
+    :type store: :py:class:`~ckanext.datapackager.lib.image_store.ImageStore`
+    :param processes: the maximum number of worker processes (default: the
+        number of CPUs); the pool is never larger than the first batch it
+        renders
+    :type processes: int
+    :param inline_threshold: in ``pool`` mode, batches of fewer images are
+        rendered inline as long as no pool has been started
+    :type inline_threshold: int
+    :param maxtasksperchild: the number of images a worker process renders
+        before it is replaced, which keeps the memory growth of RDKit and
+        Cairo in check
+    :type maxtasksperchild: int
+
+    '''
+
+    def __init__(self, mode=POOL, store=None, processes=None,
+                 maxtasksperchild=100,
+                 inline_threshold=DEFAULT_INLINE_THRESHOLD):
+        if mode not in (POOL, JOB, INLINE):
+            raise ValueError(f'Unknown image rendering mode: {mode}')
+        self.mode = mode
+        self.store = store if store is not None else ImageStore()
+        self.processes = processes
+        self.maxtasksperchild = maxtasksperchild
+        self.inline_threshold = inline_threshold
+        self.submitted = 0
+        self.rendered = 0
+        self.failed = 0
+        self._seen = set()
+        self._pool = None
+        self._pool_processes = 0
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, packages):
+        '''Render the images of the molecules of the given dataset dicts
+        that have not been submitted yet, and are not in the store.'''
+        items = []
+        for package in packages:
+            item = molecule_image_item(package)
+            if item is None:
+                continue
+            key = item[0] or item[1]
+            if key in self._seen:
+                continue
+            self._seen.add(key)
+            if item[0] and self.store.contains(item[0]):
+                continue
+            items.append(item)
+        if not items:
+            return
+        self.submitted += len(items)
+
+        if self.mode == INLINE or (self.mode == POOL and self._pool is None
+                                   and len(items) < self.inline_threshold):
+            self._collect(render_molecule_image((inchi_key, inchi, self.store))
+                          for inchi_key, inchi in items)
+        elif self.mode == JOB:
+            import ckan.lib.jobs as jobs
+            from ckanext.datapackager.jobs import render_molecule_images_job
+            jobs.enqueue(render_molecule_images_job, [items],
+                         title=f'Render {len(items)} molecule images')
+        else:
+            pool = self._get_pool(len(items))
+            self._pending.append(pool.map_async(
+                render_molecule_image,
+                [(inchi_key, inchi, self.store)
+                 for inchi_key, inchi in items],
+                chunksize=max(1, len(items) // (4 * self._pool_processes))))
+
+    def close(self):
+        '''Wait for the pending images and shut the worker pool down.'''
+        for result in self._pending:
+            try:
+                self._collect(result.get())
+            except Exception as e:
+                log.error(f'Rendering molecule images failed: {e}')
+        self._pending = []
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        log.debug(f'Molecule images: {self.submitted} submitted, '
+                  f'{self.rendered} rendered, {self.failed} failed')
+
+    def _collect(self, results):
+        stored = []
+        for inchi_key, rendered in results:
+            if rendered is None:
+                self.failed += 1
+                continue
+            if rendered:
+                self.rendered += 1
+            stored.append(inchi_key)
+        self.store.add(stored)
+
+    def _pool_size(self, items):
+        return max(1, min(self.processes or os.cpu_count() or 1, items))
+
+    def _get_pool(self, items):
+        if self._pool is None:
+            # Worker processes are spawned rather than forked, so they don't
+            # share the database connections and other state of the CKAN
+            # process.
+            context = multiprocessing.get_context('spawn')
+            self._pool_processes = self._pool_size(items)
+            self._pool = context.Pool(self._pool_processes,
+                                      maxtasksperchild=self.maxtasksperchild)
+        return self._pool
@@ -0,0 +1,160 @@
+'''Ingestion of resource files that are already on the server.
+
+Resources of imported Data Packages may have a ``path`` to a local file.
+Instead of going through the uploader, which copies the file into the
+FileStore a chunk at a time in Python, the files under the directories
+listed in ``ckanext.datapackager.local_resource_dirs`` are put in place
+with a hard link, a reflink (a copy-on-write clone, on filesystems that
+support them) or a copy made by the kernel, so that even very large files
+are ingested in about the time of a ``stat``.
+
+A hard link shares the file with its source, so changes made to the source
+afterwards show in the resource too. Set
+``ckanext.datapackager.local_resource_hardlink`` to false to only use
+reflinks and copies.
+
+'''
+import errno
+import logging
+import mimetypes
+import os
+import shutil
+import uuid
+
+log = logging.getLogger(__name__)
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY = 'copy'
+
+# The ioctl cloning a file into another (Linux, on Btrfs, XFS, ...).
+_FICLONE = 0x40049409
+
+
+def local_resource_dirs():
+    '''Return the directories whose files may be linked into the resource
+    storage (``ckanext.datapackager.local_resource_dirs``).'''
+    import ckan.plugins.toolkit as toolkit
+    return toolkit.aslist(toolkit.config.get(
+        'ckanext.datapackager.local_resource_dirs'))
+
+
+def is_under(path, directories):
+    '''Return whether ``path`` (once symbolic links are resolved) is in one
+    of ``directories``.'''
+    path = os.path.realpath(path)
+    for directory in directories:
+        directory = os.path.realpath(directory)
+        try:
+            if os.path.commonpath([path, directory]) == directory:
+                return True
+        except ValueError:
+            # On different drives.
+            continue
+    return False
+
+
+def can_link(path):
+    '''Return whether the file at ``path`` can be ingested by linking it
+    into the resource storage: it must be in one of the
+    :py:func:`local_resource_dirs`, and resources must be stored by CKAN's
+    own (local filesystem) uploader.'''
+    directories = local_resource_dirs()
+    if not directories or not is_under(path, directories):
+        return False
+    return uses_local_storage()
+
+
+def uses_local_storage():
+    '''Return whether resource files are stored by CKAN's own uploader, on
+    the local filesystem.'''
+    import ckan.lib.uploader as uploader
+    resource_uploader = _resource_uploader({})
+    return (type(resource_uploader) is uploader.ResourceUpload and
+            bool(resource_uploader.storage_path))
+
+
+def prepare_resource(resource, path):
+    '''Turn ``resource`` into an uploaded resource for the file at ``path``,
+    without an upload: its file is put in place with
+    :py:func:`store_file` once the resource is created. The resource is
+    given its id up front for that.
+
+    :raises OSError: if there is no such file
+
+    '''
+    size = os.path.getsize(path)
+    resource.setdefault('id', str(uuid.uuid4()))
+    resource['url'] = os.path.basename(path)
+    resource['url_type'] = 'upload'
+    resource['size'] = size
+    if not resource.get('mimetype'):
+        resource['mimetype'] = mimetypes.guess_type(path)[0]
+    return resource
+
+
+def store_file(resource_id, path, hardlink=None):
+    '''Put the file at ``path`` in place as the file of the resource
+    ``resource_id``. Returns the way it was stored (:py:data:`HARDLINK`,
+    :py:data:`REFLINK` or :py:data:`COPY`).
+
+    ``hardlink`` defaults to ``ckanext.datapackager.local_resource_hardlink``.
+
+    '''
+    import ckan.plugins.toolkit as toolkit
+    if hardlink is None:
+        hardlink = toolkit.asbool(toolkit.config.get(
+            'ckanext.datapackager.local_resource_hardlink', True))
+    uploader = _resource_uploader({'id': resource_id})
+    return link_file(path, uploader.get_path(resource_id), hardlink=hardlink)
+
+
+def link_file(source, target, hardlink=True):
+    '''Make ``target`` a copy of the file ``source``, without reading it
+    through Python: with a hard link (if ``hardlink``), or else a reflink,
+    or else a copy done by the kernel (``shutil.copyfile`` uses
+    ``sendfile`` on Linux).
+
+    ``target`` is replaced atomically, and its directory is created if
+    needed. Returns the way the file was stored.
+
+    '''
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    temporary = '{0}.{1}.tmp'.format(target, uuid.uuid4().hex)
+
+    methods = [(REFLINK, _reflink), (COPY, shutil.copyfile)]
+    if hardlink:
+        methods.insert(0, (HARDLINK, os.link))
+    for i, (method, function) in enumerate(methods):
+        try:
+            function(source, temporary)
+            os.replace(temporary, target)
+            return method
+        except OSError as e:
+            _remove(temporary)
+            if i == len(methods) - 1:
+                raise
+            log.debug(f'Could not {method} {source} to {target}: {e}')
+
+
+def _reflink(source, target):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported')
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _resource_uploader(resource):
+    import ckan.lib.uploader as uploader
+    return uploader.get_resource_uploader(dict(resource))
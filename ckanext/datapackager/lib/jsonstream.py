@@ -0,0 +1,140 @@
+'''Incremental parsing of large JSON uploads.
+
+'''
+import codecs
+import json
+
+import six
+
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def iter_json_records(fileobj, chunk_size=64 * 1024, encoding='utf-8'):
+    '''Yield the records of a JSON document one at a time.
+
+    The document may either be a JSON array, in which case each of its
+    elements is yielded as soon as it has been read completely, or a single
+    JSON value, which is yielded once. Only the record that is currently
+    being parsed (plus at most one read chunk) is held in memory, so this can
+    be used on uploads that are much larger than the available memory.
+
+    :param fileobj: the file-like object to read from, opened either in
+        binary or in text mode
+    :type fileobj: file-like object with a ``read()`` method
+    :param chunk_size: number of bytes (or characters) read at a time
+    :type chunk_size: int
+    :param encoding: the encoding used to decode binary input
+    :type encoding: string
+
+    :raises json.JSONDecodeError: if the document is not valid JSON
+
+    '''
+    reader = _ChunkReader(fileobj, chunk_size, encoding)
+
+    buf = reader.skip_whitespace('')
+    if not buf:
+        return
+
+    if buf[0] != '[':
+        # Not an array: the whole document is a single record.
+        while not reader.eof:
+            buf += reader.read()
+        value, end = _DECODER.raw_decode(buf)
+        if buf[end:].strip(_WHITESPACE):
+            raise json.JSONDecodeError('Extra data', buf, end)
+        yield value
+        return
+
+    buf = reader.skip_whitespace(buf[1:])
+    if buf.startswith(']'):
+        _check_trailing(reader, buf[1:])
+        return
+
+    while True:
+        value, buf = _decode_next(reader, buf)
+        yield value
+
+        buf = reader.skip_whitespace(buf)
+        if buf.startswith(','):
+            buf = reader.skip_whitespace(buf[1:])
+        elif buf.startswith(']'):
+            _check_trailing(reader, buf[1:])
+            return
+        else:
+            raise json.JSONDecodeError(
+                'Expecting \',\' delimiter or \']\'', buf, 0)
+
+
+def _decode_next(reader, buf):
+    '''Decode the next JSON value from the start of ``buf``, reading more
+    input as needed. Returns the value and the unconsumed rest of ``buf``.
+
+    '''
+    size = reader.chunk_size
+    while True:
+        try:
+            value, end = _DECODER.raw_decode(buf)
+        except json.JSONDecodeError:
+            if reader.eof:
+                raise
+            buf += reader.read(size)
+            # Grow the reads for records spanning many chunks, so they are
+            # not re-parsed from the start once per small chunk.
+            size = min(size * 2, _MAX_CHUNK_SIZE)
+            continue
+
+        # A scalar at the very end of the buffer (e.g. ``12`` out of
+        # ``123``) may still be incomplete.
+        if end == len(buf) and not reader.eof:
+            buf += reader.read(size)
+            continue
+
+        return value, buf[end:]
+
+
+def _check_trailing(reader, buf):
+    while True:
+        if buf.strip(_WHITESPACE):
+            raise json.JSONDecodeError('Extra data', buf, 0)
+        if reader.eof:
+            return
+        buf = reader.read()
+
+
+class _ChunkReader(object):
+    '''Read text chunks from a binary or text file object.'''
+
+    def __init__(self, fileobj, chunk_size, encoding):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.eof = False
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._first = True
+
+    def read(self, size=None):
+        if self.eof:
+            return ''
+
+        data = self.fileobj.read(size or self.chunk_size)
+
+        if isinstance(data, six.binary_type):
+            text = self._decoder.decode(data, final=not data)
+        else:
+            text = data or ''
+        if not data:
+            self.eof = True
+
+        if self._first and text:
+            self._first = False
+            # Drop a UTF-8 byte order mark, like ``utf-8-sig`` would.
+            text = text.lstrip(u'\ufeff')
+        return text
+
+    def skip_whitespace(self, buf):
+        buf = buf.lstrip(_WHITESPACE)
+        while not buf and not self.eof:
+            buf = self.read().lstrip(_WHITESPACE)
+        return buf
@@ -0,0 +1,103 @@
+'''Resolution of license ids from the license values found in imports.
+
+'''
+import threading
+
+import six
+
+
+class LicenseIndex(object):
+    '''Maps license ids, URLs and titles to license ids.
+
+    :param licenses: the licenses to index, as dicts with (at least) the
+        ``id``, ``url`` and ``title`` keys, like the ones returned by the
+        ``license_list`` action
+    :type licenses: iterable of dicts
+
+    '''
+
+    def __init__(self, licenses):
+        self.by_id = {}
+        self.by_url = {}
+        self.by_title = {}
+        for license_dict in licenses:
+            license_id = license_dict.get('id')
+            if not license_id:
+                continue
+            self.by_id.setdefault(license_id, license_id)
+            url = normalize_url(license_dict.get('url'))
+            if url:
+                self.by_url.setdefault(url, license_id)
+            title = license_dict.get('title')
+            if title:
+                self.by_title.setdefault(title.strip(), license_id)
+
+    def resolve(self, value):
+        '''Return the id of the license whose id, URL or title is ``value``
+        (in this order of precedence), or ``None`` if there is none.
+
+        URLs are compared ignoring case, the scheme, a leading ``www.`` and
+        a trailing slash.
+
+        '''
+        if not isinstance(value, six.string_types):
+            return None
+        value = value.strip()
+        if not value:
+            return None
+        return (self.by_id.get(value) or
+                self.by_url.get(normalize_url(value)) or
+                self.by_title.get(value))
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+def normalize_url(url):
+    '''Normalize a license URL so that trivially different spellings of it
+    (``https://www.example.com/`` and ``http://example.com``) compare equal.
+
+    '''
+    if not isinstance(url, six.string_types):
+        return None
+    url = url.strip().lower()
+    for scheme in ('https://', 'http://'):
+        if url.startswith(scheme):
+            url = url[len(scheme):]
+            break
+    if url.startswith('www.'):
+        url = url[len('www.'):]
+    return url.rstrip('/') or None
+
+
+_lock = threading.Lock()
+_index = None
+_index_key = None
+
+
+def get_license_index():
+    '''Return the process-wide :py:class:`LicenseIndex` of CKAN's license
+    register.
+
+    The index is built on first use and rebuilt whenever the register
+    changes (e.g. it is reloaded, or licenses are added to or removed from
+    it), so it is shared by every import that runs in the process.
+
+    '''
+    global _index, _index_key
+
+    # Imported here so that LicenseIndex can be used without CKAN's model.
+    from ckan import model
+
+    register = model.Package.get_license_register()
+    key = (id(register), tuple(register.keys()))
+    index = _index
+    if index is not None and _index_key == key:
+        return index
+
+    with _lock:
+        if _index is None or _index_key != key:
+            _index = LicenseIndex(
+                license.license_dictize() for license in register.values())
+            _index_key = key
+        return _index
@@ -0,0 +1,469 @@
+'''Timings and counters of the import pipeline.
+
+Each import collects the time spent in each of its stages (parsing,
+conversion, ``package_create``, resource uploads, molecule registration,
+image rendering...) and counters (records, bytes read, database round-trips,
+images rendered, cache hits) in an :py:class:`ImportMetrics`. The import
+being run by the current thread is found with :py:func:`current`, so the
+functions of the pipeline record into it without it being passed around:
+
+    with metrics.track_import('json') as import_metrics:
+        with metrics.stage('parse'):
+            ...
+        metrics.count('records', len(chunk))
+
+Stages nest (a stage pulling records from an upstream generator runs the
+upstream stage within its own), so the time of a stage excludes that of the
+stages it calls, and the stage totals add up to the time spent in all of
+them.
+
+When an import ends, its metrics are added to the totals of the process
+(:py:data:`process_metrics`) and to those of all the processes, web workers
+and background jobs workers alike, kept in Redis (:py:data:`shared_metrics`),
+which the ``datapackager_metrics`` action and the ``/datapackager/metrics``
+endpoint (in the Prometheus text format) report on.
+
+'''
+import collections
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# The number of finished imports whose metrics are kept, for the
+# datapackager_metrics action.
+RECENT_IMPORTS = 20
+
+_local = threading.local()
+
+
+class ImportMetrics(object):
+    '''The stage timings and counters of a single import.
+
+    An instance is meant to be used by a single thread.
+
+    :param kind: the kind of import (e.g. ``json`` or ``cif``)
+    :type kind: string
+
+    '''
+
+    def __init__(self, kind='json'):
+        self.kind = kind
+        self.started_at = time.time()
+        self.finished_at = None
+        self.error = None
+        self.stages = collections.defaultdict(lambda: [0, 0.0])
+        self.counters = collections.Counter()
+        self._start = time.perf_counter()
+        self._duration = None
+        self._stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Time the enclosed block as a call to the stage ``name``.'''
+        start = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            totals = self.stages[name]
+            totals[0] += 1
+            totals[1] += elapsed - nested
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def finish(self, error=None):
+        self.finished_at = time.time()
+        self._duration = time.perf_counter() - self._start
+        self.error = error
+
+    @property
+    def duration(self):
+        if self._duration is not None:
+            return self._duration
+        return time.perf_counter() - self._start
+
+    def as_dict(self):
+        '''Return the metrics as a dict, with the time spent outside of the
+        stages as the ``other`` stage.'''
+        duration = self.duration
+        stages = {name: {'calls': calls, 'seconds': seconds}
+                  for name, (calls, seconds) in self.stages.items()}
+        staged = sum(seconds for calls, seconds in self.stages.values())
+        stages['other'] = {'calls': 0,
+                           'seconds': max(0.0, duration - staged)}
+        return {
+            'kind': self.kind,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'duration': duration,
+            'error': self.error,
+            'stages': stages,
+            'counters': dict(self.counters),
+        }
+
+
+class ProcessMetrics(object):
+    '''The metrics of all the imports run by the process, and of the last
+    :py:data:`RECENT_IMPORTS` of them.'''
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.imports = collections.Counter()
+        self.import_seconds = 0.0
+        self.stages = collections.defaultdict(lambda: [0, 0.0])
+        self.counters = collections.Counter()
+        self.recent = collections.deque(maxlen=RECENT_IMPORTS)
+
+    def add(self, import_metrics):
+        '''Add the metrics of a finished import to the totals.'''
+        summary = import_metrics.as_dict()
+        with self._lock:
+            status = 'failed' if import_metrics.error else 'finished'
+            self.imports[(import_metrics.kind, status)] += 1
+            self.import_seconds += summary['duration']
+            for name, stage in summary['stages'].items():
+                totals = self.stages[name]
+                totals[0] += stage['calls']
+                totals[1] += stage['seconds']
+            self.counters.update(import_metrics.counters)
+            self.recent.append(summary)
+
+    def snapshot(self):
+        '''Return the totals (and the recent imports) as a dict.'''
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'imports': [{'kind': kind, 'status': status, 'count': count}
+                            for (kind, status), count
+                            in sorted(self.imports.items())],
+                'import_seconds': self.import_seconds,
+                'stages': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds)
+                           in self.stages.items()},
+                'counters': dict(self.counters),
+                'recent_imports': list(self.recent),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+
+# The metrics of the imports of the process.
+process_metrics = ProcessMetrics()
+
+
+def _redis_key(name):
+    return 'ckanext-datapackager:metrics:{0}'.format(name)
+
+
+def _connect():
+    # Imported here so that this module can be used without a CKAN config.
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class SharedMetrics(object):
+    '''The metrics of the imports run by all the processes (CKAN and
+    background jobs workers), added up in Redis.
+
+    The snapshots have the same layout as those of :py:class:`ProcessMetrics`,
+    with ``started_at`` the time of the first import recorded.
+
+    '''
+
+    _HASHES = ('totals', 'imports', 'stage_calls', 'stage_seconds',
+               'counters')
+
+    def add(self, import_metrics):
+        '''Add the metrics of a finished import to the totals.'''
+        summary = import_metrics.as_dict()
+        status = 'failed' if import_metrics.error else 'finished'
+        pipeline = _connect().pipeline()
+        pipeline.hsetnx(_redis_key('totals'), 'started_at',
+                        summary['started_at'])
+        pipeline.hincrbyfloat(_redis_key('totals'), 'import_seconds',
+                              summary['duration'])
+        pipeline.hincrby(_redis_key('imports'),
+                         f'{import_metrics.kind}:{status}', 1)
+        for name, stage in summary['stages'].items():
+            pipeline.hincrby(_redis_key('stage_calls'), name, stage['calls'])
+            pipeline.hincrbyfloat(_redis_key('stage_seconds'), name,
+                                  stage['seconds'])
+        for name, value in summary['counters'].items():
+            pipeline.hincrby(_redis_key('counters'), name, value)
+        pipeline.lpush(_redis_key('recent'), json.dumps(summary))
+        pipeline.ltrim(_redis_key('recent'), 0, RECENT_IMPORTS - 1)
+        pipeline.execute()
+
+    def snapshot(self):
+        '''Return the totals (and the recent imports) as a dict.'''
+        pipeline = _connect().pipeline()
+        for name in self._HASHES:
+            pipeline.hgetall(_redis_key(name))
+        pipeline.lrange(_redis_key('recent'), 0, -1)
+        values = pipeline.execute()
+        totals, imports, stage_calls, stage_seconds, counters = [
+            {_text(key): _text(value) for key, value in hash_.items()}
+            for hash_ in values[:-1]]
+
+        rows = []
+        for field, count in sorted(imports.items()):
+            kind, _, status = field.rpartition(':')
+            rows.append({'kind': kind, 'status': status, 'count': int(count)})
+        started_at = totals.get('started_at')
+        return {
+            'started_at': float(started_at) if started_at else None,
+            'imports': rows,
+            'import_seconds': float(totals.get('import_seconds', 0.0)),
+            'stages': {name: {'calls': int(stage_calls.get(name, 0)),
+                              'seconds': float(seconds)}
+                       for name, seconds in stage_seconds.items()},
+            'counters': {name: int(value)
+                         for name, value in counters.items()},
+            # Pushed newest first.
+            'recent_imports': [json.loads(_text(summary))
+                               for summary in reversed(values[-1])],
+        }
+
+    def reset(self):
+        _connect().delete(*[_redis_key(name)
+                            for name in self._HASHES + ('recent',)])
+
+
+# The metrics of the imports of all the processes.
+shared_metrics = SharedMetrics()
+
+
+def current():
+    '''Return the metrics of the import run by the current thread, or
+    ``None``.'''
+    return getattr(_local, 'metrics', None)
+
+
+@contextlib.contextmanager
+def track_import(kind='json'):
+    '''Collect the metrics of the import run within the block (as the
+    :py:func:`current` one), and add them to :py:data:`process_metrics` and
+    :py:data:`shared_metrics` when it ends.
+
+    Imports nested in another one (e.g. a background job calling the
+    import action) are part of the outer one.
+
+    '''
+    outer = current()
+    if outer is not None:
+        yield outer
+        return
+
+    import_metrics = ImportMetrics(kind)
+    _local.metrics = import_metrics
+    _install_statement_counter()
+    try:
+        yield import_metrics
+    except BaseException as e:
+        import_metrics.finish(error=str(e) or e.__class__.__name__)
+        raise
+    else:
+        import_metrics.finish()
+    finally:
+        _local.metrics = None
+        process_metrics.add(import_metrics)
+        try:
+            shared_metrics.add(import_metrics)
+        except Exception as e:
+            # Never let the metrics break the import itself.
+            log.error(f'Could not save the import metrics: {e}')
+        log.info(f'Import metrics: {_format_summary(import_metrics)}')
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''Time the enclosed block as a stage of the current import (if any).'''
+    import_metrics = current()
+    if import_metrics is None:
+        yield
+        return
+    with import_metrics.stage(name):
+        yield
+
+
+def count(name, value=1):
+    '''Add ``value`` to the counter ``name`` of the current import (if
+    any).'''
+    import_metrics = current()
+    if import_metrics is not None:
+        import_metrics.count(name, value)
+
+
+def timed(name):
+    '''Decorate a function to time its calls as the stage ``name``.'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def iterate(name, iterable):
+    '''Yield the items of ``iterable``, timing the production of each of
+    them as the stage ``name``.'''
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class CountingReader(object):
+    '''A file-like object counting the bytes (or characters) read from
+    ``fileobj`` as the counter ``name`` of the current import.'''
+
+    def __init__(self, fileobj, name='bytes_read'):
+        self.fileobj = fileobj
+        self.name = name
+
+    def read(self, *args):
+        data = self.fileobj.read(*args)
+        count(self.name, len(data))
+        return data
+
+    def __getattr__(self, attribute):
+        return getattr(self.fileobj, attribute)
+
+
+class CountingCursor(object):
+    '''A DB-API cursor counting the statements it runs (``execute`` and
+    ``copy_expert``) as ``db_round_trips`` of the current import.'''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        count('db_round_trips')
+        return self.cursor.execute(*args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        count('db_round_trips')
+        return self.cursor.copy_expert(*args, **kwargs)
+
+    def __getattr__(self, attribute):
+        return getattr(self.cursor, attribute)
+
+
+_statement_counter_installed = False
+
+
+def _install_statement_counter():
+    '''Count the SQL statements run through SQLAlchemy by the thread of an
+    import as its ``db_round_trips``.'''
+    global _statement_counter_installed
+    if _statement_counter_installed:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _count_statement(*args, **kwargs):
+        count('db_round_trips')
+
+    _statement_counter_installed = True
+
+
+def _format_summary(import_metrics):
+    summary = import_metrics.as_dict()
+    stages = ', '.join(
+        f"{name} {stage['seconds']:.3f}s"
+        for name, stage in sorted(summary['stages'].items(),
+                                  key=lambda item: -item[1]['seconds']))
+    counters = ', '.join(f'{name} {value}' for name, value
+                         in sorted(summary['counters'].items()))
+    return f"{summary['duration']:.3f}s ({stages}; {counters})"
+
+
+def cache_stats(snapshot):
+    '''Return the hits and misses of the molecule id and HTTP caches, by
+    cache name, from the counters of a snapshot.'''
+    counters = snapshot['counters']
+    return {
+        cache: {'hits': counters.get(f'{prefix}_cache_hits', 0),
+                'misses': counters.get(f'{prefix}_cache_misses', 0)}
+        for cache, prefix in (('molecule_id', 'molecule'), ('http', 'http'))
+    }
+
+
+def prometheus_text(snapshot):
+    '''Format a :py:meth:`SharedMetrics.snapshot` (or a
+    :py:meth:`ProcessMetrics.snapshot`) in the Prometheus text exposition
+    format.'''
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP datapackager_{name} {help_text}')
+        lines.append(f'# TYPE datapackager_{name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(
+                f'{key}="{_escape_label(value)}"'
+                for key, value in labels.items())
+            lines.append(f'datapackager_{name}'
+                         f'{{{label_text}}} {value}' if label_text else
+                         f'datapackager_{name} {value}')
+
+    metric('imports_total', 'counter', 'Imports run.',
+           [({'kind': row['kind'], 'status': row['status']}, row['count'])
+            for row in snapshot['imports']])
+    metric('import_seconds_total', 'counter',
+           'Time spent in imports, in seconds.',
+           [({}, _float(snapshot['import_seconds']))])
+    stages = sorted(snapshot['stages'].items())
+    metric('import_stage_seconds_total', 'counter',
+           'Time spent in each stage of the imports, in seconds.',
+           [({'stage': name}, _float(stage['seconds']))
+            for name, stage in stages])
+    metric('import_stage_calls_total', 'counter',
+           'Calls to each stage of the imports.',
+           [({'stage': name}, stage['calls']) for name, stage in stages])
+    for name, value in sorted(snapshot['counters'].items()):
+        metric(f'import_{name}_total', 'counter',
+               f'{name.replace("_", " ").capitalize()} by the imports.',
+               [({}, value)])
+    caches = sorted(cache_stats(snapshot).items())
+    metric('cache_hits_total', 'counter', 'Cache hits by the imports.',
+           [({'cache': cache}, stats['hits']) for cache, stats in caches])
+    metric('cache_misses_total', 'counter', 'Cache misses by the imports.',
+           [({'cache': cache}, stats['misses']) for cache, stats in caches])
+    return '\n'.join(lines) + '\n'
+
+
+def _float(value):
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
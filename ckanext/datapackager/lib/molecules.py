@@ -0,0 +1,465 @@
+'''Set-based registration of the molecules of imported datasets.
+
+Molecules and their relations to datasets live in the ``Molecules`` and
+``MolecularRelationData`` tables of ckanext-rdkit_visuals. Instead of a
+handful of queries per dataset, :py:func:`upsert_molecules` writes a whole
+chunk of them with a ``COPY`` into a staging table followed by two
+``INSERT ... SELECT ... ON CONFLICT DO NOTHING`` statements.
+
+'''
+import collections
+import io
+import logging
+import threading
+
+from ckan import model
+
+from ckanext.datapackager.lib import metrics
+
+log = logging.getLogger(__name__)
+
+# The fields of a molecule row, in the order they are given to
+# upsert_molecules, and the names their columns may have in the molecules
+# table.
+FIELDS = ('standard_inchi', 'inchi_key', 'smiles', 'exactmass',
+          'mol_formula', 'package_id')
+_MOLECULE_COLUMNS = {
+    'standard_inchi': ('standard_inchi', 'inchi'),
+    'inchi_key': ('inchi_key',),
+    'smiles': ('smiles',),
+    'exactmass': ('exactmass', 'exact_mass'),
+    'mol_formula': ('mol_formula',),
+}
+
+_STAGING_TABLE = 'datapackager_molecule_staging'
+
+_schema = None
+
+
+class MoleculeIdCache(object):
+    '''A bounded, thread-safe LRU mapping of InChIKeys to molecule ids.
+
+    Many records of an import share the same molecule, so the molecule ids
+    seen by a worker process are kept here to spare the database a lookup
+    for every one of them.
+
+    :param maxsize: the maximum number of InChIKeys kept
+    :type maxsize: int
+
+    '''
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, inchi_key):
+        '''Return the cached molecule id of ``inchi_key``, or ``None``.'''
+        with self._lock:
+            molecule_id = self._data.get(inchi_key)
+            if molecule_id is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(inchi_key)
+            self.hits += 1
+            return molecule_id
+
+    def set(self, inchi_key, molecule_id):
+        if not inchi_key or molecule_id is None:
+            return
+        with self._lock:
+            self._data[inchi_key] = molecule_id
+            self._data.move_to_end(inchi_key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, molecule_ids):
+        for inchi_key, molecule_id in molecule_ids.items():
+            self.set(inchi_key, molecule_id)
+
+    def invalidate(self, molecule_ids=None):
+        '''Forget the given molecule ids, or everything if ``None``.'''
+        with self._lock:
+            if molecule_ids is None:
+                self._data.clear()
+                return
+            molecule_ids = set(molecule_ids)
+            for inchi_key in [key for key, molecule_id in self._data.items()
+                              if molecule_id in molecule_ids]:
+                del self._data[inchi_key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+
+# The cache shared by all imports of the process.
+molecule_id_cache = MoleculeIdCache()
+
+
+def models():
+    '''Return the ``Molecules`` and ``MolecularRelationData`` models of
+    ckanext-rdkit_visuals.
+
+    They are imported on first use rather than with this module, which is
+    loaded with the plugin.
+
+    '''
+    from ckanext.rdkit_visuals.models.molecule_tab import Molecules
+    from ckanext.rdkit_visuals.models.molecule_rel import MolecularRelationData
+    return Molecules, MolecularRelationData
+
+
+def molecule_row(package):
+    '''Return the molecule row of a dataset dict for
+    :py:func:`upsert_molecules`, or ``None`` if the dataset has no molecule.
+
+    '''
+    inchi_key = package.get('inchi_key')
+    if not inchi_key or not package.get('id'):
+        return None
+    return (package.get('inchi'), inchi_key, package.get('smiles'),
+            package.get('exactmass'), package.get('mol_formula'),
+            package['id'])
+
+
+def upsert_molecules(rows, session=None):
+    '''Register the molecules of a chunk of datasets.
+
+    Molecules whose InChIKey is not registered yet are inserted, and every
+    dataset that has no molecule relation yet is related to the molecule of
+    its InChIKey. The statements run in the current transaction of
+    ``session``, which is left for the caller to commit.
+
+    InChIKeys found in :py:data:`molecule_id_cache` are known to be
+    registered, so when all of them are the molecules are not inserted nor
+    looked up again. The ids of the others are added to the cache. As
+    molecules may have been deleted since they were cached (see
+    :py:func:`purge_orphans`), possibly by another process, the cached ids
+    are checked with one primary key lookup first.
+
+    :param rows: ``(standard_inchi, inchi_key, smiles, exactmass,
+        mol_formula, package_id)`` tuples
+    :type rows: iterable of tuples
+    :param session: the SQLAlchemy session to use (optional, default:
+        ``ckan.model.Session``)
+
+    :returns: the molecule id of each InChIKey in ``rows``
+    :rtype: dict
+
+    '''
+    from psycopg2 import sql
+
+    session = session or model.Session
+    schema = _get_schema()
+    rows = _clean_rows(rows, schema)
+    if not rows:
+        return {}
+
+    molecule_ids = {}
+    for row in rows:
+        molecule_id = molecule_id_cache.get(row[1])
+        if molecule_id is not None:
+            molecule_ids[row[1]] = molecule_id
+    uncached_keys = set(row[1] for row in rows) - set(molecule_ids)
+    metrics.count('molecule_cache_hits', len(molecule_ids))
+    metrics.count('molecule_cache_misses', len(uncached_keys))
+
+    cursor = metrics.CountingCursor(session.connection().connection.cursor())
+    try:
+        if molecule_ids:
+            stale_keys = _stale_molecule_keys(cursor, schema, molecule_ids)
+            if stale_keys:
+                molecule_id_cache.invalidate(
+                    [molecule_ids[key] for key in stale_keys])
+                for key in stale_keys:
+                    del molecule_ids[key]
+                uncached_keys.update(stale_keys)
+
+        cursor.execute(sql.SQL(
+            'CREATE TEMP TABLE IF NOT EXISTS {staging} ('
+            'standard_inchi text, inchi_key text, smiles text, '
+            'exactmass text, mol_formula text, package_id text'
+            ') ON COMMIT DROP'
+        ).format(staging=sql.Identifier(_STAGING_TABLE)))
+        cursor.execute(sql.SQL('TRUNCATE {staging}').format(
+            staging=sql.Identifier(_STAGING_TABLE)))
+        cursor.copy_expert(
+            sql.SQL('COPY {staging} ({fields}) FROM STDIN').format(
+                staging=sql.Identifier(_STAGING_TABLE),
+                fields=sql.SQL(', ').join(map(sql.Identifier, FIELDS)),
+            ).as_string(cursor.cursor),
+            _copy_buffer(rows))
+
+        if uncached_keys:
+            cursor.execute(_insert_molecules_statement(schema))
+            log.debug(f'{cursor.rowcount} new molecules registered')
+        cursor.execute(_insert_relations_statement(schema))
+        log.debug(f'{cursor.rowcount} new molecule relations registered')
+
+        if uncached_keys:
+            cursor.execute(sql.SQL(
+                'SELECT m.{key}, m.{id} FROM {molecules} m '
+                'WHERE m.{key} = ANY(%s)'
+            ).format(
+                molecules=sql.Identifier(schema['molecules']),
+                key=sql.Identifier(schema['columns']['inchi_key']),
+                id=sql.Identifier(schema['molecule_id']),
+            ), (list(uncached_keys),))
+            found = dict(cursor.fetchall())
+            molecule_id_cache.update(found)
+            molecule_ids.update(found)
+        return molecule_ids
+    finally:
+        cursor.close()
+
+
+def _stale_molecule_keys(cursor, schema, molecule_ids):
+    '''Return the InChIKeys of ``molecule_ids`` (a mapping of InChIKeys to
+    cached molecule ids) whose molecule no longer exists.'''
+    from psycopg2 import sql
+
+    cursor.execute(sql.SQL(
+        'SELECT m.{id} FROM {molecules} m WHERE m.{id} = ANY(%s)'
+    ).format(
+        molecules=sql.Identifier(schema['molecules']),
+        id=sql.Identifier(schema['molecule_id']),
+    ), (list(set(molecule_ids.values())),))
+    existing = set(row[0] for row in cursor.fetchall())
+    return [key for key, molecule_id in molecule_ids.items()
+            if molecule_id not in existing]
+
+
+def purge_orphans(after=None, batch_size=1000, dry_run=False, session=None):
+    '''Delete the molecules of one batch that no dataset is related to any
+    more.
+
+    The batch is made of the (up to) ``batch_size`` molecules following the
+    molecule id ``after``, in id order, and its orphans are found with one
+    anti-join against the relations table and deleted by the same
+    statement. The statement runs in the current transaction of
+    ``session``, which is left for the caller to commit.
+
+    :param after: the id of the last molecule of the previous batch
+        (optional, default: start with the first molecule)
+    :param batch_size: the number of molecules of the batch
+    :type batch_size: int
+    :param dry_run: only find the orphans, don't delete them
+    :type dry_run: bool
+    :param session: the SQLAlchemy session to use (optional, default:
+        ``ckan.model.Session``)
+
+    :returns: the id of the last molecule of the batch (``None`` if there
+        are no molecules after ``after``), the number of molecules of the
+        batch and the ids and InChIKeys of its orphans
+    :rtype: tuple
+
+    '''
+    from psycopg2 import sql
+
+    session = session or model.Session
+    schema = _get_schema()
+    if dry_run:
+        orphans = sql.SQL(
+            'SELECT s.id, s.inchi_key FROM scanned s WHERE NOT EXISTS ('
+            'SELECT 1 FROM {relations} r WHERE r.{molecule_fk} = s.id)')
+    else:
+        # A molecule related to a dataset since the batch was read makes the
+        # DELETE fail on the foreign key, and the batch be rolled back.
+        orphans = sql.SQL(
+            'DELETE FROM {molecules} m USING scanned s '
+            'WHERE m.{id} = s.id AND NOT EXISTS ('
+            'SELECT 1 FROM {relations} r WHERE r.{molecule_fk} = s.id) '
+            'RETURNING m.{id}, m.{key}')
+    names = {
+        'molecules': sql.Identifier(schema['molecules']),
+        'relations': sql.Identifier(schema['relations']),
+        'molecule_fk': sql.Identifier(schema['molecule_fk']),
+        'id': sql.Identifier(schema['molecule_id']),
+        'key': sql.Identifier(schema['columns']['inchi_key']),
+    }
+    where = sql.SQL('WHERE m.{id} > %(after)s').format(**names) \
+        if after is not None else sql.SQL('')
+    # One row with the extent of the batch, or one per orphan.
+    statement = sql.SQL(
+        'WITH scanned AS ('
+        'SELECT m.{id} AS id, m.{key} AS inchi_key FROM {molecules} m '
+        '{where} ORDER BY m.{id} LIMIT %(batch_size)s'
+        '), orphans AS ({orphans}) '
+        'SELECT (SELECT max(id) FROM scanned), (SELECT count(*) FROM scanned), '
+        'o.* FROM (SELECT 1) one LEFT JOIN orphans o ON true'
+    ).format(where=where, orphans=orphans.format(**names), **names)
+    cursor = metrics.CountingCursor(session.connection().connection.cursor())
+    try:
+        cursor.execute(statement, {'after': after, 'batch_size': batch_size})
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    last_id, scanned = rows[0][0], rows[0][1]
+    orphans = [(row[2], row[3]) for row in rows if row[2] is not None]
+    return last_id, scanned, orphans
+
+
+def _insert_molecules_statement(schema):
+    from psycopg2 import sql
+
+    columns = schema['columns']
+    fields = [field for field in FIELDS if field in columns]
+    values = [
+        sql.SQL('CAST(NULLIF(s.{field}, {empty}) AS {type})').format(
+            field=sql.Identifier(field),
+            empty=sql.Literal(''),
+            type=sql.SQL(schema['types'][field]),
+        ) for field in fields
+    ]
+    # DISTINCT ON keeps one row per InChIKey of the chunk, NOT EXISTS skips
+    # already registered molecules and ON CONFLICT covers concurrent imports
+    # (when inchi_key has a unique constraint).
+    return sql.SQL(
+        'INSERT INTO {molecules} ({columns}) '
+        'SELECT DISTINCT ON (s.inchi_key) {values} FROM {staging} s '
+        'WHERE NOT EXISTS ('
+        'SELECT 1 FROM {molecules} m WHERE m.{key} = s.inchi_key) '
+        'ORDER BY s.inchi_key '
+        'ON CONFLICT DO NOTHING'
+    ).format(
+        molecules=sql.Identifier(schema['molecules']),
+        columns=sql.SQL(', ').join(
+            sql.Identifier(columns[field]) for field in fields),
+        values=sql.SQL(', ').join(values),
+        staging=sql.Identifier(_STAGING_TABLE),
+        key=sql.Identifier(columns['inchi_key']),
+    )
+
+
+def _insert_relations_statement(schema):
+    from psycopg2 import sql
+
+    return sql.SQL(
+        'INSERT INTO {relations} ({molecule_fk}, {package_fk}) '
+        'SELECT DISTINCT ON (s.package_id) m.{id}, s.package_id '
+        'FROM {staging} s JOIN {molecules} m ON m.{key} = s.inchi_key '
+        'WHERE NOT EXISTS ('
+        'SELECT 1 FROM {relations} r WHERE r.{package_fk} = s.package_id) '
+        'ORDER BY s.package_id, m.{id} '
+        'ON CONFLICT DO NOTHING'
+    ).format(
+        relations=sql.Identifier(schema['relations']),
+        molecule_fk=sql.Identifier(schema['molecule_fk']),
+        package_fk=sql.Identifier(schema['package_fk']),
+        id=sql.Identifier(schema['molecule_id']),
+        staging=sql.Identifier(_STAGING_TABLE),
+        molecules=sql.Identifier(schema['molecules']),
+        key=sql.Identifier(schema['columns']['inchi_key']),
+    )
+
+
+def _get_schema():
+    '''Read the table and column names of the molecule tables from their
+    SQLAlchemy mappings (once per process).'''
+    global _schema
+    if _schema is not None:
+        return _schema
+
+    from sqlalchemy.dialects import postgresql
+    dialect = postgresql.dialect()
+
+    molecules, mol_rel_data = models()
+    molecules_table = molecules.__table__
+    relations_table = mol_rel_data.__table__
+
+    columns = {}
+    types = {}
+    for field, candidates in _MOLECULE_COLUMNS.items():
+        for name in candidates:
+            if name in molecules_table.c:
+                columns[field] = name
+                types[field] = molecules_table.c[name].type.compile(
+                    dialect=dialect)
+                break
+    if 'inchi_key' not in columns:
+        raise RuntimeError('The molecules table has no inchi_key column')
+
+    molecule_fk = _molecule_fk_column().name
+
+    _schema = {
+        'molecules': molecules_table.name,
+        'molecule_id': list(molecules_table.primary_key.columns)[0].name,
+        'relations': relations_table.name,
+        'molecule_fk': molecule_fk,
+        'package_fk': mol_rel_data.package_id.property.columns[0].name,
+        'columns': columns,
+        'types': types,
+    }
+    return _schema
+
+
+def _clean_rows(rows, schema):
+    numeric_exactmass = any(
+        name in schema['types'].get('exactmass', '')
+        for name in ('FLOAT', 'DOUBLE', 'NUMERIC', 'REAL', 'INTEGER'))
+    cleaned = []
+    for row in rows:
+        if not row or not row[1]:
+            continue
+        if numeric_exactmass:
+            row = row[:3] + (_to_float(row[3]),) + row[4:]
+        cleaned.append(row)
+    return cleaned
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def molecule_fk_attribute():
+    '''Return the name of the ``MolecularRelationData`` attribute that holds
+    the id of the related molecule.'''
+    from sqlalchemy import inspect
+    molecules, mol_rel_data = models()
+    return inspect(mol_rel_data).get_property_by_column(
+        _molecule_fk_column()).key
+
+
+def _molecule_fk_column():
+    molecules, mol_rel_data = models()
+    molecules_table = molecules.__table__
+    for column in mol_rel_data.__table__.columns:
+        if any(fk.column.table is molecules_table
+               for fk in column.foreign_keys):
+            return column
+    raise RuntimeError(
+        'The molecule relations table has no foreign key to molecules')
+
+
+def _copy_buffer(rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(_copy_value(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+
+def _copy_value(value):
+    '''Format a value for the text format of ``COPY``.'''
+    if value is None:
+        return '\\N'
+    value = value if isinstance(value, str) else str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
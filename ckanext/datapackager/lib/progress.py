@@ -0,0 +1,129 @@
+'''Progress reporting for Data Package imports.
+
+Background imports publish an :py:class:`ImportProgress` snapshot to Redis
+so that the ``datapackage_import_status`` action can report on them while
+the job is still running.
+
+'''
+import json
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# How long the status of an import is kept after its last update.
+STATUS_TTL = 7 * 24 * 60 * 60
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+
+def _redis_key(job_id):
+    return 'ckanext-datapackager:import:{0}'.format(job_id)
+
+
+def _connect():
+    # Imported here so that this module can be used without a CKAN config.
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def get_status(job_id):
+    '''Return the last published status of an import, or ``None`` if there
+    is no import with the given id (or its status has expired).
+
+    '''
+    value = _connect().get(_redis_key(job_id))
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return json.loads(value)
+
+
+class ImportProgress(object):
+    '''Counts the records handled by a single import.
+
+    :param job_id: the id of the background import; when given, the counts
+        are published for ``datapackage_import_status``, at most once every
+        ``save_interval`` seconds while the import is running
+    :type job_id: string
+
+    '''
+
+    def __init__(self, job_id=None, save_interval=2.0, queued_at=None,
+                 **extra):
+        self.job_id = job_id
+        self.save_interval = save_interval
+        self.extra = extra
+        self.state = QUEUED
+        self.processed = 0
+        self.created = 0
+        self.skipped = 0
+        self.failed = 0
+        self.error = None
+        self.queued_at = queued_at or time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._last_saved = 0
+
+    def start(self):
+        self.state = RUNNING
+        self.started_at = time.time()
+        self.save()
+
+    def record(self, outcome):
+        '''Count one more processed record.
+
+        :param outcome: ``'created'``, ``'skipped'`` or ``'failed'``
+        :type outcome: string
+
+        '''
+        self.processed += 1
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        if time.time() - self._last_saved >= self.save_interval:
+            self.save()
+
+    def finish(self, error=None):
+        self.state = FAILED if error else FINISHED
+        self.error = error
+        self.finished_at = time.time()
+        self.save()
+
+    @property
+    def throughput(self):
+        '''Processed records per second since the import started.'''
+        if not self.started_at:
+            return 0.0
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        status = dict(self.extra)
+        status.update({
+            'id': self.job_id,
+            'state': self.state,
+            'processed': self.processed,
+            'created': self.created,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'throughput': round(self.throughput, 2),
+            'error': self.error,
+            'queued_at': self.queued_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        })
+        return status
+
+    def save(self):
+        self._last_saved = time.time()
+        if not self.job_id:
+            return
+        try:
+            _connect().setex(_redis_key(self.job_id), STATUS_TTL,
+                             json.dumps(self.as_dict()))
+        except Exception as e:
+            # Never let progress reporting break the import itself.
+            log.error(f'Could not save status of import {self.job_id}: {e}')
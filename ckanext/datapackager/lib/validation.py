@@ -0,0 +1,126 @@
+'''Loading and validation of the Data Package descriptors of an import.
+
+Building a ``datapackage.DataPackage`` per record loads the profile
+registry, loads and compiles the profile's JSON Schema, checks it against
+its metaschema and copies the descriptor three times, all for every record
+of an upload. Here the profiles are compiled once per process and the
+records are normalized the way ``DataPackage`` does it (dereferenced
+``schema`` and ``dialect``, ``url`` turned into ``path`` and defaults
+applied), in place, a batch at a time.
+
+Like ``DataPackage`` (which isn't strict), validation errors are logged,
+not raised: invalid records are still imported.
+
+For trusted sources, ``ckanext.datapackager.validation`` can be set to
+``structural``: records are then only checked for the shape the importer
+relies on (an object, whose ``resources``, if any, are a list of objects),
+which normalizing them does anyway, and not validated against their
+profile.
+
+'''
+import functools
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
+
+FULL = 'full'
+STRUCTURAL = 'structural'
+MODES = (FULL, STRUCTURAL)
+
+
+@functools.lru_cache(maxsize=32)
+def get_profile(name):
+    '''Return the (compiled) ``datapackage.profile.Profile`` named ``name``
+    (a profile of the registry, or the path or URL of one), loading it on
+    first use only.'''
+    from datapackage.profile import Profile
+    return Profile(name)
+
+
+def normalize(descriptor, base_path='.'):
+    '''Normalize a descriptor like ``datapackage.DataPackage`` does, in
+    place, and return it.
+
+    :raises datapackage.exceptions.DataPackageException: if the descriptor
+        is not an object, its ``resources`` not a list of objects, or its
+        references can't be resolved
+
+    '''
+    from datapackage import exceptions, helpers
+
+    if not isinstance(descriptor, dict):
+        raise exceptions.DataPackageException(
+            "Data must be a 'dict', but was a '{0}'".format(
+                type(descriptor).__name__))
+    resources = descriptor.get('resources', [])
+    if not isinstance(resources, list) or not all(
+            isinstance(resource, dict) for resource in resources):
+        raise exceptions.DataPackageException(
+            'The resources of a Data Package must be a list of objects')
+    helpers.dereference_package_descriptor(descriptor, base_path)
+    for resource in descriptor.get('resources', []):
+        url = resource.pop('url', None)
+        if url is not None:
+            resource['path'] = [url]
+    return helpers.expand_package_descriptor(descriptor)
+
+
+def validate(descriptor, mode=FULL):
+    '''Return the validation errors (messages) of a normalized descriptor
+    (none in ``structural`` mode, normalizing it checked its structure).'''
+    if mode == STRUCTURAL:
+        return []
+
+    from datapackage import exceptions
+
+    # A profile that can't be loaded raises, as with DataPackage.
+    profile = descriptor.get('profile')
+    if isinstance(profile, str):
+        profile = get_profile(profile)
+    else:
+        # An inline profile (a JSON Schema), which can't be cached by name.
+        from datapackage.profile import Profile
+        profile = Profile(profile)
+    try:
+        profile.validate(descriptor)
+    except exceptions.ValidationError as e:
+        return [str(error) for error in (e.errors or [e])]
+    return []
+
+
+def validate_batch(descriptors, mode=FULL):
+    '''Return the validation errors of each of the ``descriptors``.'''
+    return [validate(descriptor, mode) for descriptor in descriptors]
+
+
+def iter_validated(descriptors, mode=FULL, base_path='.', batch_size=500):
+    '''Normalize and validate ``descriptors`` a batch at a time, and yield
+    them.'''
+    descriptors = iter(descriptors)
+    while True:
+        batch = [normalize(descriptor, base_path) for descriptor in
+                 itertools.islice(descriptors, batch_size)]
+        if not batch:
+            return
+        invalid = 0
+        for descriptor, errors in zip(batch, validate_batch(batch, mode)):
+            if errors:
+                invalid += 1
+                log.debug(f"Descriptor {descriptor.get('name') or descriptor.get('identifier')} "
+                          f"is not valid: {errors}")
+        if invalid:
+            log.debug(f'{invalid} of {len(batch)} descriptors are not valid')
+        for descriptor in batch:
+            yield descriptor
+
+
+def validation_mode():
+    '''Return the configured validation mode
+    (``ckanext.datapackager.validation``).'''
+    import ckan.plugins.toolkit as toolkit
+    mode = toolkit.config.get('ckanext.datapackager.validation', FULL)
+    if mode not in MODES:
+        raise ValueError(f'Unknown validation mode: {mode}')
+    return mode
+
@@ -0,0 +1,83 @@
+'''Streaming of zip archives.
+
+:py:func:`iter_zip` writes a zip archive to an iterator of byte strings,
+as its members are added, so that it can be sent as a streamed response
+without being built in memory or on disk first.
+
+'''
+import time
+import zipfile
+
+# The size of the pieces members given as file objects are read in.
+CHUNK_SIZE = 64 * 1024
+
+
+class _Sink(object):
+    '''A write-only, unseekable file object collecting what is written to
+    it until it is drained. zipfile writes data descriptors after each
+    member when its output can't be seeked back into.'''
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(members, compression=zipfile.ZIP_DEFLATED):
+    '''Yield the bytes of a zip archive of ``members``.
+
+    :param members: ``(name, content)`` or ``(name, content,
+        compress_type)`` tuples, ``content`` being a byte string, an iterable
+        of byte strings or a readable binary file object (read, and streamed,
+        a chunk at a time), and ``compress_type`` overriding
+        ``compression`` for the member (e.g. ``zipfile.ZIP_STORED`` for
+        files that wouldn't gain from being compressed)
+    :type members: iterable
+
+    '''
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression=compression,
+                         allowZip64=True) as archive:
+        for member in members:
+            name, content = member[:2]
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = member[2] if len(member) > 2 else compression
+            info.external_attr = 0o644 << 16
+            if isinstance(content, bytes):
+                archive.writestr(info, content)
+            else:
+                # force_zip64 as the size of the content isn't known ahead.
+                with archive.open(info, 'w', force_zip64=True) as stream:
+                    for chunk in _chunks(content):
+                        stream.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def _chunks(content):
+    if hasattr(content, 'read'):
+        while True:
+            chunk = content.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in content:
+            yield chunk
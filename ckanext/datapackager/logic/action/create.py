@@ -2,41 +2,47 @@ import random
 import cgi
 import json
 import tempfile
+import contextlib
 import io
 import six
+import mimetypes
 import os.path
 import time
 import traceback
 
+import ckan.lib.jobs as jobs
 import ckan.plugins.toolkit as toolkit
 from ckanext.datapackager.logic.action import schema4chem_ckan_mapper as converter
+from ckanext.datapackager.lib import cif
+from ckanext.datapackager.lib import blobs
+from ckanext.datapackager.lib import http_cache
+from ckanext.datapackager.lib import images
+from ckanext.datapackager.lib import ingest
+from ckanext.datapackager.lib.image_store import get_image_store
+from ckanext.datapackager.lib import jsonstream
+from ckanext.datapackager.lib import licenses
+from ckanext.datapackager.lib import metrics
+from ckanext.datapackager.lib.progress import ImportProgress
+from ckanext.datapackager.lib import validation
+from ckanext.datapackager.jobs import import_datapackage_job
 from werkzeug.datastructures import FileStorage
+from six.moves.urllib.parse import urlparse
 
-from ckanext.rdkit_visuals.models.molecule_tab import Molecules as molecules
-from ckanext.rdkit_visuals.models.molecule_rel import MolecularRelationData as mol_rel_data
-
-from rdkit.Chem import inchi
-from rdkit.Chem import rdmolfiles
-from rdkit.Chem import Draw
-from rdkit.Chem import Descriptors
-
-import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+# The chemistry stack (RDKit, ASE, matplotlib, psycopg2 and the models of
+# ckanext-rdkit_visuals) and datapackage-py are imported where they are
+# used, not when CKAN loads the plugin.
+from ckanext.datapackager.lib import molecules as molecule_registry
 
 from ckan import model
-from ckan.model import Session, Package, PACKAGE_NAME_MAX_LENGTH
+from ckan.model import Session, Package, PackageExtra, Resource, PACKAGE_NAME_MAX_LENGTH
 
-from ckan.lib.munge import munge_title_to_name
+from ckan.lib.munge import munge_filename, munge_title_to_name
 
 import logging
 
-import datapackage
+import sqlalchemy as sqla
 
-# Adding for CIF File integration
 import uuid
-from ase.io import read as ase_read
-from ase.visualize.plot import plot_atoms
-import matplotlib.pyplot as plt
 
 log = logging.getLogger(__name__)
 
@@ -50,15 +56,86 @@ log = logging.getLogger(__name__)
 def package_create_from_datapackage_or_cif(context, data_dict):
     upload = data_dict.get('upload')
 
-    if upload and _is_cif_file(upload.filename):
+    if toolkit.asbool(data_dict.get('background')):
+        return _enqueue_import(context, data_dict)
+
+    filename = getattr(upload, 'filename', None) or ''
+    if upload and cif.is_cif_upload(_upload_stream(upload), filename):
         log.debug("Processing CIF file upload...")
         return _process_cif_and_create_package(context, data_dict)
     else:
         return package_create_from_datapackage(context, data_dict)
 
 
-def _is_cif_file(filename):
-    return filename.lower().endswith('.cif')
+def _enqueue_import(context, data_dict):
+    '''Spool the upload and import it in a background job.
+
+    Returns the id of the import right away. Its progress can be followed
+    with the ``datapackage_import_status`` action.
+
+    '''
+    toolkit.check_access('package_create', context)
+
+    url = data_dict.get('url')
+    upload = data_dict.get('upload')
+    if not url and not _upload_attribute_is_valid(upload):
+        msg = {'url': ['you must define either a url or upload attribute']}
+        raise toolkit.ValidationError(msg)
+
+    job_id = str(uuid.uuid4())
+    job_data_dict = dict((key, value) for key, value in data_dict.items()
+                         if key not in ('upload', 'background'))
+    spool_path = filename = None
+    if _upload_attribute_is_valid(upload):
+        filename = os.path.basename(
+            getattr(upload, 'filename', None) or 'datapackage.json')
+        spool_path = _spool_upload(job_id, filename, upload)
+
+    progress = ImportProgress(job_id, user=context.get('user'),
+                              filename=filename)
+    progress.save()
+
+    jobs.enqueue(
+        import_datapackage_job,
+        kwargs={
+            'job_id': job_id,
+            'data_dict': job_data_dict,
+            'user': context.get('user'),
+            'spool_path': spool_path,
+            'filename': filename,
+            'queued_at': progress.queued_at,
+        },
+        title=f'Data Package import {job_id}',
+        rq_kwargs={
+            'job_id': job_id,
+            'timeout': toolkit.asint(toolkit.config.get(
+                'ckanext.datapackager.import_job_timeout', 6 * 60 * 60)),
+        },
+    )
+    log.info(f'Queued Data Package import {job_id}')
+    return progress.as_dict()
+
+
+def _spool_upload(job_id, filename, upload):
+    spool_dir = toolkit.config.get('ckanext.datapackager.import_spool_dir')
+    if not spool_dir:
+        storage_path = toolkit.config.get('ckan.storage_path') or \
+            tempfile.gettempdir()
+        spool_dir = os.path.join(storage_path, 'datapackager', 'imports')
+    if not os.path.isdir(spool_dir):
+        os.makedirs(spool_dir)
+
+    spool_path = os.path.join(spool_dir, f'{job_id}-{filename}')
+    source = _upload_stream(upload)
+    with open(spool_path, 'wb') as f:
+        while True:
+            chunk = source.read(1024 * 1024)
+            if not chunk:
+                break
+            if isinstance(chunk, six.text_type):
+                chunk = chunk.encode('utf-8')
+            f.write(chunk)
+    return spool_path
 
 
 def package_create_from_datapackage(context, data_dict):
@@ -81,306 +158,363 @@ def package_create_from_datapackage(context, data_dict):
         :py:func:`~ckan.logic.action.get.organization_list_for_user` for
         available values (optional)
    :type owner_org: string
+    :param background: import in a background job instead of within the
+        request; the id of the import is returned right away and its
+        progress can be followed with ``datapackage_import_status``
+        (optional, default: ``False``)
+    :type background: bool
     '''
     updated_datasets = []
     url = data_dict.get('url')
     upload = data_dict.get('upload')
 
-    res = {}
-    res_to_send = []
     if not url and not _upload_attribute_is_valid(upload):
         msg = {'url': ['you must define either a url or upload attribute']}
         raise toolkit.ValidationError(msg)
 
-    dp = _load_and_validate_datapackage(url=url, upload=upload)
+    with metrics.track_import('json'):
+        # Records are parsed and validated a chunk at a time as the upload is
+        # read, so each chunk is fully processed before the next one is
+        # loaded.
+        dp = metrics.iterate('parse', _load_and_validate_datapackage(
+            url=url, upload=upload))
+
+        # considering each JSON file has one dataset and Chemcial Substance
+
+        progress = context.get('import_progress') or ImportProgress()
+        iteration_count = 0  # Initialize counter
+        # The converter works through the records as a batch.
+        records = metrics.iterate('convert', (
+            _dataset_dict_from_datapackage(dataset_dict, data_dict)
+            for dataset_dict in converter.packages(dp)))
+        # Molecule images are rendered as a separate stage, in parallel with
+        # the creation of the datasets.
+        renderer = _molecule_image_renderer(
+            background=context.get('background_import', False))
+        try:
+            for chunk in _chunked(records, _import_chunk_size()):
+                iteration_count += len(chunk)
+                metrics.count('records', len(chunk))
+                imported = _import_chunk(chunk, progress)
+                with metrics.stage('images'):
+                    renderer.submit(imported)
+                updated_datasets.extend(imported)
+        finally:
+            _close_image_renderer(renderer)
+    log.debug(f'Number of records imported {iteration_count}')
+    log.debug(f'Molecule id cache: {molecule_registry.molecule_id_cache.stats()}')
+    return updated_datasets
 
-    # considering each JSON file has one dataset and Chemcial Substance
 
-    for each_dp in dp:
-        send_dp_to_convert = each_dp.to_dict()
-        dataset_dict = converter.package(send_dp_to_convert)
-        # log.debug(f'{dataset_dict}')
+def _import_chunk(chunk, progress):
+    '''Create the datasets of a chunk of dataset dicts (or skip the existing
+    ones), and register their molecules.
 
-        owner_org = data_dict.get('owner_org')
+    Returns the imported datasets.
 
-        if owner_org:
-            dataset_dict['owner_org'] = owner_org
+    '''
+    # One query per chunk tells which datasets already exist, so that
+    # those that are skipped never need a full package_show.
+    with metrics.stage('lookup'):
+        existing_packages = _find_existing_packages(chunk)
+    imported = []
+
+    for dataset_dict in chunk:
+        # The dataset is written once, with its resources and as active:
+        # either created by a single package_create call or, if it already
+        # exists and needs changes, by a single package_update call.
+        with contextlib.ExitStack() as open_files:
+            try:
+                res, created = _package_create_with_unique_name(
+                    _action_context(), dataset_dict,
+                    existing_packages.get(dataset_dict['id']), open_files)
+            except toolkit.ValidationError as e:
+                log.debug(f"Error creating dataset {dataset_dict.get('identifier')}: {e.error_dict}")
+                res, created = None, False
+            except Exception as e:
+                log.debug(f"Unhandled error for dataset {dataset_dict.get('identifier')}: {e}")
+                res, created = None, False
 
-        private = data_dict.get('private')
+        if not res:
+            progress.record('failed')
+            continue
 
-        if private:
-            dataset_dict['private'] = toolkit.asbool(private)
+        if created:
+            # Later records of the chunk with the same id are existing
+            # datasets by now.
+            existing_packages[dataset_dict['id']] = _existing_package_summary(res)
 
-        name = dataset_dict['identifier']
-        name = name.lower()
+        log.debug(f"Imported dataset: {res['id']}")
+        imported.append(res)
+        progress.record('created' if created else 'skipped')
 
-        resources = dataset_dict.get('resources', [])
+    with metrics.stage('molecules'):
+        _send_chunk_to_db(imported)
+    return imported
 
-        # Create as draft by default so if there's any issue on creating the
-        # resources and we're unable to purge the dataset, at least it's not shown.
-        dataset_dict['state'] = 'draft'
-        package_show_context = {'model': model, 'session': Session,
-                                'ignore_auth': True}
-        res = _package_create_with_unique_name(package_show_context, dataset_dict)
 
-        dataset_id = res['id']
+def _dataset_dict_from_datapackage(dataset_dict, data_dict):
+    owner_org = data_dict.get('owner_org')
 
-        resources_data = res['resources']
+    if owner_org:
+        dataset_dict['owner_org'] = owner_org
 
-        if not resources_data:
-            log.debug(f'{resource_data} is not present')
-            try:
-                _create_resources(dataset_id, context, resources)
-            except Exception as e:
-                log.error(e)
-                try:
-                    toolkit.get_action('package_delete')(
-                        context, {'id': dataset_id})
-                except Exception as e2:
-                    six.raise_from(e, e2)
+    private = data_dict.get('private')
 
-        res['state'] = 'active'
+    if private:
+        dataset_dict['private'] = toolkit.asbool(private)
 
-        _send_to_db(package=res)
-        _import_molecule_images(package=res)
+    _set_name_and_id(dataset_dict)
+    return dataset_dict
 
-        log.debug(f'dataset {res["id"]} will be updated')
-        res_final = remove_extras_if_duplicates_exist(res)
 
-        # log.debug(f'The final Res for dataset {res["id"]}: {res_final}')
-        res_to_send.append(res_final)
-        # log.debug(f'list of ress: {res_to_send}').
+def _set_name_and_id(dataset_dict):
+    dataset_dict['name'] = dataset_dict['identifier'].lower()
+    dataset_dict['id'] = munge_title_to_name(dataset_dict['name'])
 
-    package_show_context = {'model': model, 'session': Session,
-                            'ignore_auth': True}
-    iteration_count = 0  # Initialize counter
-    for dataset in res_to_send:
-        iteration_count += 1
-        try:
-            # Update the dataset
-            updated_dataset = toolkit.get_action('package_update')(package_show_context, dataset)
-            log.debug(f"Updated dataset: {updated_dataset['id']}")
-            updated_datasets.append(updated_dataset)
-        except toolkit.ValidationError as e:
-            log.debug(f"Error updating dataset {dataset['id']}: {e.error_dict}")
-        except Exception as e:
-            log.debug(f"Unhandled error for dataset {dataset['id']}: {e}")
-    log.debug(f'Number of dataset updated {iteration_count}')
-    return updated_datasets
+
+def _import_chunk_size():
+    return toolkit.asint(
+        toolkit.config.get('ckanext.datapackager.import_chunk_size', 500))
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def _process_cif_and_create_package(context, data_dict):
+    '''Create a dataset per structure (data block) of an uploaded CIF file,
+    or of the CIF files of an uploaded zip or tar archive.
+
+    The structures are parsed, and their masses computed and images
+    rendered, in a pool of worker processes (see
+    :py:class:`~ckanext.datapackager.lib.cif.CifProcessor`), while the
+    datasets of the previous batch of structures are being created.
+
+    '''
     updated_datasets = []
+    progress = context.get('import_progress') or ImportProgress()
     upload = data_dict.get('upload')
     if not upload:
         raise toolkit.ValidationError({'upload': ['No CIF file provided']})
 
-    try:
-        byte_data = upload.read()
-        cif_str = byte_data.decode('utf-8')
-        with tempfile.NamedTemporaryFile(mode='w+', suffix='.cif', delete=False) as tmp_cif:
-            tmp_cif.write(cif_str)
-            tmp_cif_path = tmp_cif.name
-
-        # Initialize metadata
-        identifier = "N/A"
-        citation_title = "N/A"
-        mol_formula = "N/A"
-        molecule_name = "N/A"
-        authors = []
-        extras = {}
-
-        is_author_section = False
-
-        with open(tmp_cif_path, 'r') as f:
-            lines = f.readlines()
-            i = 0
-            while i < len(lines):
-                line = lines[i].strip()
-
-                # Identifier
-                if line.startswith("data_"):
-                    identifier = line
-
-                # Citation title - multi-line block
-                elif "_citation_title" in line:
-                    i += 1
-                    citation_title_lines = []
-                    while i < len(lines) and not lines[i].strip().startswith(";"):
-                        i += 1  # skip until start of block
-                    i += 1  # skip the first ;
-                    while i < len(lines) and not lines[i].strip().startswith(";"):
-                        citation_title_lines.append(lines[i].strip())
-                        i += 1
-                    citation_title = " ".join(citation_title_lines).strip()
-
-                # Formula structural
-                elif "_chemical_formula_structural" in line:
-                    parts = line.split("'")
-                    if len(parts) > 1:
-                        mol_formula = parts[1].strip()
-                    else:
-                        mol_formula = line.split()[-1]
-
-                # Chemical name common
-                elif "_chemical_name_common" in line:
-                    parts = line.split("'")
-                    if len(parts) > 1:
-                        molecule_name = parts[1].strip()
-                    else:
-                        molecule_name = line.split()[-1]
-
-                # Authors
-                elif "_citation_author_name" in line:
-                    is_author_section = True
-                elif is_author_section and line.startswith("primary"):
-                    parts = line.split("'")
-                    if len(parts) > 1:
-                        authors.append(parts[1].strip())
-                elif is_author_section and not line.startswith("primary"):
-                    is_author_section = False
-
-                # Space group extras
-                elif "_space_group_name_H-M_alt" in line:
-                    parts = line.split("'")
-                    if len(parts) > 1:
-                        extras["space_group_name_H-M"] = parts[1].strip()
-                    else:
-                        extras["space_group_name_H-M"] = line.split()[-1]
-                elif "_space_group_IT_number" in line:
-                    extras["space_group_IT_number"] = line.split()[-1]
-
-                i += 1
-
-        # Format authors for CKAN field
-        author_str = '; '.join(authors) if authors else 'N/A'
-
-        # Build dataset_dict
-        dataset_dict = {
-            'identifier': identifier,
-            'name': identifier.lower().replace(' ', '_'),
-            'title': citation_title or 'N/A',
-            'notes': f'Molecule name: {molecule_name}',
-            'mol_formula': mol_formula or 'N/A',
-            'smiles': 'N/A',
-            'inchi': 'N/A',
-            'inchi_key': '',
-            'exactmass': 'N/A',  # Will compute below
-            'author': author_str,
-            'license_id': data_dict.get('license_id', 'N/A'),
-            'owner_org': data_dict.get('owner_org', 'N/A'),
-            'language': 'english',
-            'state': 'draft',
-            'extras': [{'key': k, 'value': v} for k, v in extras.items()]
-        }
-
-        # Compute exactmass
-        from ase.io import read as ase_read
-        from ase.visualize.plot import plot_atoms
-        import matplotlib.pyplot as plt
-
-        atoms = ase_read(tmp_cif_path)
-        exact_mass = atoms.get_masses().sum() if atoms else 'N/A'
-        dataset_dict['exactmass'] = str(exact_mass) if exact_mass else 'N/A'
-
-        # Save 3D PNG image (300x300 px, 300 DPI)
-        img_filename = f'/var/lib/ckan/default/storage/images/{identifier}.png'
-        fig, ax = plt.subplots(figsize=(1, 1), dpi=100)
-        plot_atoms(atoms, ax, rotation=('45x,45y,0z'), radii=0.4, scale=0.8, show_unit_cell=0)
-        plt.axis('off')
-        plt.savefig(img_filename, dpi=300, transparent=True)
-        plt.close()
-        log.debug(f"3D CIF image saved: {img_filename}")
-
-        # Create dataset in CKAN
-        package_show_context = {'model': model, 'session': Session, 'ignore_auth': True}
-        res = _package_create_with_unique_name(package_show_context, dataset_dict)
-
-        _create_resources(dataset_id=dataset_dict['identifier'],context=context, resources=upload)
-        # Remove extras duplicates
-        res = remove_extras_if_duplicates_exist(res)
+    filename = getattr(upload, 'filename', None) or 'structure.cif'
+    with metrics.track_import('cif'):
+        files = cif.iter_cif_files(
+            metrics.CountingReader(_upload_stream(upload)), filename)
+        try:
+            with _cif_processor(
+                    background=context.get('background_import', False)
+            ) as processor:
+                # Parsing includes the wait for the worker processes.
+                for batch in metrics.iterate('parse', processor.process(files)):
+                    metrics.count('records', len(batch))
+                    chunk = []
+                    for structure, resource in batch:
+                        if structure.get('error'):
+                            log.error(f"Error processing CIF structure {structure['identifier']}: {structure['error']}")
+                            progress.record('failed')
+                            continue
+                        chunk.append(_cif_dataset_dict(structure, resource, data_dict))
+                    updated_datasets.extend(_import_chunk(chunk, progress))
+        except ValueError as e:
+            log.error(f'Error processing CIF file: {e}')
+            raise toolkit.ValidationError({'upload': ['Failed to process CIF file']})
+
+    if not updated_datasets:
+        raise toolkit.ValidationError({'upload': ['Failed to process CIF file']})
+    return updated_datasets
 
-        res['state'] = 'active'
-        _send_to_db(package=res)
-        updated_dataset = toolkit.get_action('package_update')(package_show_context, res)
-        updated_datasets.append(updated_dataset)
 
-    except Exception as e:
-        log.error(f'Error processing CIF file: {e}')
-        raise toolkit.ValidationError({'upload': ['Failed to process CIF file']})
+def _cif_dataset_dict(structure, resource, data_dict):
+    # Format authors for CKAN field
+    authors = structure['authors']
+    author_str = '; '.join(authors) if authors else 'N/A'
+
+    identifier = structure['identifier']
+    dataset_dict = {
+        'identifier': identifier,
+        'name': identifier.lower().replace(' ', '_'),
+        'title': structure['citation_title'] or 'N/A',
+        'notes': f"Molecule name: {structure['molecule_name']}",
+        'mol_formula': structure['mol_formula'] or 'N/A',
+        'smiles': 'N/A',
+        'inchi': 'N/A',
+        'inchi_key': '',
+        'exactmass': structure['exactmass'],
+        'author': author_str,
+        'license_id': _resolve_cif_license_id(data_dict.get('license_id')),
+        'owner_org': data_dict.get('owner_org', 'N/A'),
+        'language': 'english',
+        'extras': [{'key': k, 'value': v} for k, v in structure['extras'].items()],
+        # The CIF file itself is uploaded as the dataset's resource.
+        'resources': [_cif_resource(*resource)],
+    }
+    _set_name_and_id(dataset_dict)
+    return dataset_dict
 
-    finally:
-        if tmp_cif_path and os.path.exists(tmp_cif_path):
-            os.remove(tmp_cif_path)
 
-    return updated_datasets
+def _cif_processor(background=False):
+    '''Return the CIF processor of an import. Unless
+    ``ckanext.datapackager.cif_processes`` is set, structures are processed
+    by a pool of worker processes in background imports, and within the
+    importing process in web requests.'''
+    config = toolkit.config
+    processes = config.get('ckanext.datapackager.cif_processes')
+    if processes not in (None, ''):
+        processes = toolkit.asint(processes)
+    else:
+        processes = None if background else 0
+    return cif.CifProcessor(
+        store=get_image_store(),
+        processes=processes,
+        batch_size=_import_chunk_size(),
+        maxtasksperchild=toolkit.asint(config.get(
+            'ckanext.datapackager.image_maxtasksperchild', 100)),
+    )
+
+
+def _resolve_cif_license_id(license_id):
+    # The license of a CIF import may also be given by its URL or title.
+    if not license_id:
+        return 'N/A'
+    return licenses.get_license_index().resolve(license_id) or license_id
+
+
+def _cif_resource(filename, byte_data):
+    return {
+        'name': filename,
+        'format': 'CIF',
+        'url': filename,
+        'url_type': 'upload',
+        'upload': FileStorage(io.BytesIO(byte_data), filename, 'upload'),
+    }
+
+
+def _package_create_with_unique_name(context, dataset_dict, existing, open_files):
+    '''Create the dataset unless it already exists.
+
+    ``existing`` is the summary of the existing dataset, as returned by
+    :py:func:`_find_existing_packages`, or ``None``. Files uploaded as
+    resources are registered on ``open_files``, and local files linked into
+    the resource storage once the dataset has been written.
+
+    Returns the dataset dict (falsy if it could not be created) and whether
+    a new dataset was created. If the local files could not be stored, the
+    resources just written are deleted (so that importing the record again
+    adds them back) and the dataset counts as not created.
 
-def _package_create_with_unique_name(context, dataset_dict):
-    dataset_dict['name'] = dataset_dict['identifier'].lower()
-    dataset_dict['id'] = munge_title_to_name(dataset_dict['name'])
+    '''
+    linked_files = []
+    if existing:
+        res = _handle_existing_package(context, dataset_dict, existing, open_files, linked_files)
+        created = False
+    else:
+        _prepare_resources(dataset_dict.get('resources', []), open_files, linked_files)
+        res = _create_new_package(context, dataset_dict)
+        created = True
+    if res and linked_files:
+        try:
+            with metrics.stage('resources'):
+                _store_linked_files(linked_files)
+        except OSError as e:
+            log.error(f"Could not store the resource files of dataset {res['id']}: {e}")
+            _delete_resources(res)
+            return None, False
+    return res, created
 
-    package_show_context = {'model': model, 'session': Session,
-                            'ignore_auth': True}
 
-    existing_package_dict = _find_existing_package(dataset_dict, package_show_context)
+def _action_context():
+    # A fresh context for every action call, as CKAN actions store state
+    # (e.g. the package object) in the context they are given.
+    return {'model': model, 'session': Session, 'ignore_auth': True}
 
-    if existing_package_dict:
-        return _handle_existing_package(context, dataset_dict)
-    else:
-        return _create_new_package(package_show_context, dataset_dict)
 
+def _handle_existing_package(context, dataset_dict, existing, open_files, linked_files=None):
+    '''Complete an existing dataset with the license, molecular formula and
+    resources it lacks.
+
+    Whether anything is missing is decided from ``existing`` alone; only
+    datasets that need changes are loaded with ``package_show`` and written
+    (with a single ``package_update``). Skipped datasets are returned as
+    described in :py:func:`_skipped_package_dict`.
+
+    '''
+    log.debug(f'Handle existing package {existing["id"]}')
+
+    license_id = None
+    add_mol_formula = False
+    if not existing['license_id']:
+        if dataset_dict.get('license'):
+            license_id = _extract_license_id(context, dataset_dict)
+        add_mol_formula = bool(not existing['mol_formula'] and dataset_dict.get('mol_formula'))
+    add_resources = bool(not existing['has_resources'] and dataset_dict.get('resources'))
+
+    if not (license_id or add_mol_formula or add_resources or
+            existing['state'] != 'active'):
+        log.info(f'Package with GUID {existing["id"]} exists and is skipped')
+        return _skipped_package_dict(dataset_dict, existing)
 
-def _handle_existing_package(context, dataset_dict):
-    log.debug(f'Handle existing package {dataset_dict}')
-    resError = None
     try:
-        log.info(f'Package with GUID {dataset_dict["id"]} exists and is skipped')
-        res = toolkit.get_action('package_show')(context, {'id': dataset_dict['id']})
-        log.debug(f'Package with GUID {res}')
+        with metrics.stage('package_show'):
+            res = toolkit.get_action('package_show')(context, {'id': existing['id']})
 
-        if not res['license_title']:
+        if license_id:
             log.debug(f'Updating license...')
-            res['license_id'] = _extract_license_id(context, dataset_dict)
-            log.debug("Updated license")
-        else:
-            return res
-        try:
-            if not res['mol_formula']:
-                log.debug(f'Updating mol formula...')
-                res['mol_formula'] = dataset_dict['mol_formula']
-                log.debug(f'added Molecular formula ')
-
-            elif res['license_id'] and res['mol_formula']:
-                resError = res
-                log.debug(f'Nothing to update.Both Licenses and Molecular formula exits')
-            else:
-                return res
-
-        except Exception as e:
-            log.error(f"line 172 {e}")
-            pass
+            res['license_id'] = license_id
+        if add_mol_formula:
+            log.debug(f'Updating mol formula...')
+            res['mol_formula'] = dataset_dict['mol_formula']
+        if add_resources:
+            res['resources'] = _prepare_resources(dataset_dict['resources'], open_files, linked_files)
+        res['state'] = 'active'
 
-        return remove_extras_if_duplicates_exist(res)
+        with metrics.stage('package_update'):
+            return toolkit.get_action('package_update')(
+                _action_context(), remove_extras_if_duplicates_exist(res))
     except toolkit.ValidationError as e:
-        log.error(f'Validation error at package Create #line177 {e}')
-        return resError  # Or a more appropriate error handling
+        log.error(f'Validation error updating package {existing["id"]}: {e}')
+        return None
+
+
+def _skipped_package_dict(dataset_dict, existing):
+    '''Return the result of a skipped dataset: the imported ``dataset_dict``
+    (whose molecule is still registered) with the id, name, state, license
+    and molecular formula of the existing dataset, and without the
+    resources, which were not imported (and may hold uploads, which can't
+    be serialized).'''
+    package_dict = {key: value for key, value in dataset_dict.items()
+                    if key != 'resources'}
+    package_dict.update((key, existing[key]) for key in
+                        ('id', 'name', 'state', 'license_id', 'mol_formula')
+                        if existing.get(key) is not None)
+    return package_dict
 
 
 def _create_new_package(context, dataset_dict):
     log.debug(f'Create a new package')
     context.pop('__auth_audit', None)
+
+    if dataset_dict.get('license'):
+        dataset_dict['license_id'] = _extract_license_id(context, dataset_dict)
+    dataset_dict['state'] = 'active'
+    dataset_dict = remove_extras_if_duplicates_exist(dataset_dict)
+
     try:
         log.debug('NEW package is being created')
-        res = toolkit.get_action('package_create')(context, dataset_dict)
-
-        if dataset_dict.get('license'):
-            res['license_id'] = _extract_license_id(context, dataset_dict)
-        # log.debug(f"Result created {res}")
-        return remove_extras_if_duplicates_exist(res)
+        with metrics.stage('package_create'):
+            return toolkit.get_action('package_create')(context, dataset_dict)
 
     except toolkit.ValidationError as e:
-        log.error(f'Exception during package creation #line 194: {e}')
-        return _handle_package_creation_exception(context, dataset_dict, e)
+        log.error(f'Exception during package creation: {e}')
+        return _handle_package_creation_exception(_action_context(), dataset_dict, e)
 
 
 def _handle_package_creation_exception(context, dataset_dict, e):
@@ -392,12 +526,9 @@ def _handle_package_creation_exception(context, dataset_dict, e):
         dataset_dict['id'] = _generate_random_id(dataset_dict)
 
     try:
-        res = toolkit.get_action('package_create')(context, dataset_dict)
-        if dataset_dict.get('license'):
-            res['license_id'] = _extract_license_id(context, dataset_dict)
-        return remove_extras_if_duplicates_exist(res)
+        return toolkit.get_action('package_create')(context, dataset_dict)
     except toolkit.ValidationError as e:
-        log.error(f'Failed to create package with exception #line 212: {e}')
+        log.error(f'Failed to create package with exception: {e}')
         return 0  # Or a more appropriate error handling
 
 
@@ -412,28 +543,35 @@ def _generate_random_id(dataset_dict):
 
 
 def _load_and_validate_datapackage(url=None, upload=None):
-    dp_list = []
-    try:
-        if _upload_attribute_is_valid(upload):
-            # You will get bytes values here. Convert them to decided values.
+    '''Yield the validated Data Package descriptor (a dict) of each uploaded
+    record.
 
-            byte_data = upload.read()
-            decoded_upload = byte_data.decode('utf-8')
-            try:
-                json_data_upload_list = json.loads(decoded_upload)
-                if toolkit.check_ckan_version(min_version="2.9"):
-                    for json_data_upload in json_data_upload_list:
-                        # Converted JSON to CKAN Dict
-                        dp = datapackage.DataPackage(json_data_upload)
-                        dp_list.append(dp)
-                else:
-                    dp = datapackage.DataPackage(upload.file)
-
-            except json.JSONDecodeError:
-                log.error(f'Invalid JSON file # line 245')
+    An upload is parsed incrementally (see
+    :py:func:`~ckanext.datapackager.lib.jsonstream.iter_json_records`), and
+    validated a chunk of records at a time (see
+    :py:mod:`~ckanext.datapackager.lib.validation`), so only the chunk being
+    imported is kept in memory. A ``url`` yields a single Data Package,
+    whose descriptor is fetched through the HTTP cache (see
+    :py:mod:`~ckanext.datapackager.lib.http_cache`).
+
+    '''
+    import datapackage
 
+    try:
+        if _upload_attribute_is_valid(upload):
+            descriptors = _iter_upload_records(upload)
+            base_path = '.'
+        elif urlparse(url).path.endswith('.zip'):
+            yield datapackage.DataPackage(url).to_dict()
+            return
         else:
-            dp = datapackage.DataPackage(url)
+            descriptors = [_fetch_descriptor(url)]
+            base_path = url.rsplit('/', 1)[0]
+
+        for descriptor in validation.iter_validated(
+                descriptors, mode=validation.validation_mode(),
+                base_path=base_path, batch_size=_import_chunk_size()):
+            yield descriptor
 
     except (datapackage.exceptions.DataPackageException,
             datapackage.exceptions.SchemaError,
@@ -447,7 +585,32 @@ def _load_and_validate_datapackage(url=None, upload=None):
     #    msg = {'datapackage': ['the Data Package has unsafe attributes']}
     #    raise toolkit.ValidationError(msg)
 
-    return dp_list
+
+def _iter_upload_records(upload):
+    try:
+        for json_data_upload in jsonstream.iter_json_records(
+                metrics.CountingReader(_upload_stream(upload))):
+            yield json_data_upload
+    except json.JSONDecodeError as e:
+        log.error(f'Invalid JSON file: {e}')
+
+
+def _fetch_descriptor(url):
+    import requests
+
+    try:
+        response = http_cache.get_http_cache().fetch(url)
+        metrics.count('bytes_read', len(response.content))
+        metrics.count('http_cache_hits' if response.from_cache
+                      else 'http_cache_misses')
+        return response.json()
+    except requests.RequestException as e:
+        log.error(f'Could not fetch {url}: {e}')
+        raise toolkit.ValidationError(
+            {'url': [f'Could not fetch the Data Package: {e}']})
+    except ValueError as e:
+        raise toolkit.ValidationError(
+            {'url': [f'The Data Package is not valid JSON: {e}']})
 
 
 def remove_extras_if_duplicates_exist(dataset_dict):
@@ -468,94 +631,164 @@ def remove_extras_if_duplicates_exist(dataset_dict):
     return dataset_dict
 
 
-def _create_resources(dataset_id, context, resources):
+@metrics.timed('resources')
+def _prepare_resources(resources, open_files, linked_files=None):
+    '''Turn resources with inline ``data`` or a local ``path`` into uploads,
+    so that they can be created together with their dataset in a single
+    ``package_create`` (or ``package_update``) call.
+
+    The files being uploaded are registered on ``open_files`` (a
+    ``contextlib.ExitStack``), which must be kept open until the dataset has
+    been written.
+
+    Local files that can be linked into the resource storage (see
+    :py:mod:`~ckanext.datapackager.lib.ingest`) are not uploaded; their
+    ``(resource_id, path, hardlink)`` are appended to ``linked_files``
+    instead, for :py:func:`_store_linked_files` (if ``linked_files`` is
+    given). When resources are deduplicated, uploads are stored as blobs
+    (see :py:mod:`~ckanext.datapackager.lib.blobs`) and linked the same way.
+
+    '''
+    deduplicate = linked_files is not None and resources and \
+        blobs.deduplication_enabled() and ingest.uses_local_storage()
     for resource in resources:
-        resource['package_id'] = dataset_id
         if resource.get('data'):
             log.debug(f'Creates Resources through inlines')
-            _create_and_upload_resource_with_inline_data(context, resource)
+            _create_and_upload_resource_with_inline_data(resource, open_files)
         elif resource.get('path'):
             log.debug(f'uploading Resource locally')
-            _create_and_upload_local_resource(context, resource)
-
-        else:
+            _create_and_upload_local_resource(resource, open_files, linked_files)
+        elif isinstance(resource.get('url'), list):
             # TODO: Investigate why in test_controller the resource['url'] is a list
-            if type(resource['url']) is list:
-                resource['url'] = resource['url'][0]
-                log.debug("RESOURCING")
-
-                try:
-                    toolkit.get_action('resource_create')(context, resource)
-                    log.debug("Create a new resource")
-                except Exception as e:
-                    # if 'There is a schema field with the same name' in e.error_dict.get('extras', []):
-                    if e is True:
-                        toolkit.get_action('resource_update')(context, resource)
-                    else:
-                        pass
-            # log.debug('Resource created')
-
-
-def _create_and_upload_resource_with_inline_data(context, resource):
-    prefix = resource.get('name', 'tmp')
-    data = resource['data']
-
-    del resource['data']
+            resource['url'] = resource['url'][0]
+        if deduplicate and resource.get('upload'):
+            _store_upload_as_blob(resource, linked_files)
+    return resources
+
+
+def _create_and_upload_resource_with_inline_data(resource, open_files):
+    '''Upload the inline ``data`` of a resource as its file.
+
+    The data is spooled in memory, and only written to a temporary file on
+    disk if it is larger than ``ckanext.datapackager.inline_data_spool_size``
+    bytes. Data that isn't a string is serialized as compact JSON.
+
+    '''
+    filename = resource.get('name') or 'data'
+    data = resource.pop('data')
     if not isinstance(data, six.string_types):
-        data = json.dumps(data, indent=2)
+        data = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+
+    f = open_files.enter_context(
+        tempfile.SpooledTemporaryFile(max_size=_inline_data_spool_size()))
+    f.write(data)
+    f.seek(0)
+
+    _create_and_upload_resource(resource, f, filename)
 
-    with tempfile.NamedTemporaryFile(prefix=prefix) as f:
-        if six.PY3:
-            f.write(six.binary_type(data, 'utf-8'))
-        else:
-            f.write(six.binary_type(data))
-        f.seek(0)
 
-        _create_and_upload_resource(context, resource, f)
+def _inline_data_spool_size():
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.inline_data_spool_size', 1024 * 1024))
 
 
-def _create_and_upload_local_resource(context, resource):
+def _create_and_upload_local_resource(resource, open_files, linked_files=None):
     path = resource['path']
     del resource['path']
     if isinstance(path, list):
         path = path[0]
     try:
-        with open(path, 'r') as f:
-            _create_and_upload_resource(context, resource, f)
+        if linked_files is not None and ingest.can_link(path):
+            ingest.prepare_resource(resource, path)
+            resource['url'] = munge_filename(resource['url'])
+            linked_files.append((resource['id'], path, None))
+            return
+        f = open_files.enter_context(open(path, 'rb'))
     except IOError:
         msg = {'datapackage': [(
             "Couldn't create some of the resources."
             " Please make sure that all resources' files are accessible."
         )]}
         raise toolkit.ValidationError(msg)
+    _create_and_upload_resource(resource, f)
+
+
+def _store_upload_as_blob(resource, linked_files):
+    '''Store the upload of a resource in the blob store (once per distinct
+    content), to be linked as the file of the resource instead of being
+    uploaded, and set its ``hash`` to the SHA-256 of the content.'''
+    upload = resource.pop('upload')
+    stream = getattr(upload, 'stream', None) or getattr(upload, 'file', None) or upload
+    digest, size, path, created = blobs.get_blob_store().add(stream)
+    log.debug(f'Resource file {digest} {"stored" if created else "already stored"}')
+
+    filename = os.path.basename(getattr(upload, 'filename', None) or '') or digest
+    ingest.prepare_resource(resource, path)
+    resource['url'] = munge_filename(filename)
+    resource['hash'] = digest
+    if not resource.get('mimetype'):
+        resource['mimetype'] = mimetypes.guess_type(filename)[0]
+    linked_files.append((resource['id'], path, True))
+
 
+def _store_linked_files(linked_files):
+    '''Link (or reflink, or copy) local files into the resource storage as
+    the files of the resources they were prepared for.
 
-def _create_and_upload_resource(context, resource, the_file):
+    :raises OSError: if a file could not be stored
+
+    '''
+    for resource_id, path, hardlink in linked_files:
+        method = ingest.store_file(resource_id, path, hardlink)
+        log.debug(f'Stored {path} as the file of resource {resource_id} ({method})')
+
+
+def _delete_resources(dataset_dict):
+    '''Delete the resources of a dataset whose files could not be stored.
+
+    Datasets only get their resources from an import if they have none, so
+    these are all the resources written by the import.
+
+    '''
+    for resource in dataset_dict.get('resources', []):
+        toolkit.get_action('resource_delete')(
+            _action_context(), {'id': resource['id']})
+
+
+def _create_and_upload_resource(resource, the_file, filename=None):
+    '''Set ``the_file`` as the file to upload for ``resource``, under
+    ``filename`` (default: the name of the file). It is stored by the
+    uploader when the dataset is written.'''
     resource['url'] = 'url'
     resource['url_type'] = 'upload'
+    filename = filename or the_file.name
 
     if toolkit.check_ckan_version(min_version="2.9"):
-        resource['upload'] = FileStorage(the_file, the_file.name, the_file.name)
+        resource['upload'] = FileStorage(the_file, filename, filename)
     else:
-        resource['upload'] = _UploadLocalFileStorage(the_file)
-
-    toolkit.get_action('resource_create')(context, resource)
+        resource['upload'] = _UploadLocalFileStorage(the_file, filename)
 
 
 def _upload_attribute_is_valid(upload):
     return hasattr(upload, 'read') or hasattr(upload, 'file') and hasattr(upload.file, 'read')
 
 
+def _upload_stream(upload):
+    '''Return the readable file object behind an upload (a werkzeug
+    ``FileStorage``, a ``cgi.FieldStorage`` or a plain file).'''
+    if hasattr(upload, 'read'):
+        return upload
+    return upload.file
+
+
 def _extract_license_id(context, content):
+    '''Return the id of the license whose id, URL or title is the
+    ``license`` of ``content``, or ``None``.'''
     package_license = None
     try:
-        content_license = content['license']
-        license_list = toolkit.get_action('license_list')(context.copy(), {})
-
-        for license_name in license_list:
-            if content_license == license_name['id'] or content_license == license_name['url'] or content_license == \
-                    license_name['title']:
-                package_license = license_name['id']
+        package_license = licenses.get_license_index().resolve(content['license'])
     except Exception as e:
         log.error(f'Error extracting license: {e}')
         pass
@@ -563,17 +796,103 @@ def _extract_license_id(context, content):
     return package_license
 
 
-def _find_existing_package(package_dict, context):
-    """
-    Check if a package exists with same ID
-    """
-    data_dict = {'id': package_dict['id']}
-    try:
+def _existing_package_summary(package_dict):
+    return {
+        'id': package_dict['id'],
+        'name': package_dict['name'],
+        'state': package_dict.get('state'),
+        'license_id': package_dict.get('license_id'),
+        'mol_formula': package_dict.get('mol_formula'),
+        'has_resources': bool(package_dict.get('resources')),
+    }
 
-        return toolkit.get_action('package_show')(context, data_dict)
+
+def _find_existing_packages(dataset_dicts):
+    '''Look up which of the given datasets already exist, with a single
+    query.
+
+    Datasets are matched on their ``id`` against both the id and the name of
+    existing datasets (like ``package_show`` does). Returns a dict keyed by
+    the given ids, with the ``id``, ``name``, ``state``, ``license_id`` and
+    ``mol_formula`` of the matching datasets and whether they have any
+    ``resources`` (``has_resources``).
+
+    '''
+    ids = list(set(dataset_dict['id'] for dataset_dict in dataset_dicts))
+    if not ids:
+        return {}
+
+    has_resources = sqla.exists().where(sqla.and_(
+        Resource.package_id == Package.id,
+        Resource.state == 'active',
+    ))
+    query = Session.query(
+        Package.id, Package.name, Package.state, Package.license_id,
+        PackageExtra.value, has_resources.label('has_resources'),
+    ).outerjoin(PackageExtra, sqla.and_(
+        PackageExtra.package_id == Package.id,
+        PackageExtra.key == 'mol_formula',
+    )).filter(sqla.or_(
+        Package.id.in_(ids),
+        Package.name.in_(ids),
+    ))
+
+    existing = {}
+    for id_, name, state, license_id, mol_formula, has_resources in query:
+        summary = _existing_package_summary({
+            'id': id_,
+            'name': name,
+            'state': state,
+            'license_id': license_id,
+            'mol_formula': mol_formula,
+            'resources': has_resources,
+        })
+        # An id matching another dataset's name must not shadow the dataset
+        # that has it as its id.
+        existing[name] = existing.get(name) or summary
+        existing[id_] = summary
+    return existing
+
+
+def _send_chunk_to_db(packages):
+    '''Register the molecules of a chunk of imported datasets with a few
+    set-based statements (see
+    :py:func:`~ckanext.datapackager.lib.molecules.upsert_molecules`).
+
+    If that fails, the molecules are registered one dataset at a time with
+    :py:func:`_send_to_db`.
+
+    '''
+    rows = [molecule_registry.molecule_row(package) for package in packages]
+    if not any(rows):
+        return {}
+    try:
+        with Session.begin_nested():
+            molecule_ids = molecule_registry.upsert_molecules(rows)
+        Session.commit()
+        return molecule_ids
     except Exception as e:
-            log.error(f' find existing package error {e}')
-            return 0
+        log.error(f'Bulk molecule registration failed, registering them one by one: {e}')
+        Session.rollback()
+        for package in packages:
+            _send_to_db(package=package)
+        return {}
+
+
+def _get_molecule_id(inchi_key):
+    '''Look up the molecule of ``inchi_key``, in the molecule id cache
+    first. Returns a ``(molecule_id,)`` row like
+    ``Molecules._get_inchi_from_db``, or ``None``.'''
+    cache = molecule_registry.molecule_id_cache
+    molecule_id = cache.get(inchi_key)
+    if molecule_id is not None:
+        return (molecule_id,)
+
+    molecules, mol_rel_data = molecule_registry.models()
+    row = molecules._get_inchi_from_db(inchi_key)
+    if row:
+        cache.set(inchi_key, row[0])
+    return row
 
 
 def _send_to_db(package):
@@ -583,6 +902,7 @@ def _send_to_db(package):
     name_list = []
     package_id = package['id']
     log.debug(package)
+    molecules, mol_rel_data = molecule_registry.models()
 
     try:
         standard_inchi = package['inchi']
@@ -592,7 +912,7 @@ def _send_to_db(package):
         mol_formula = package['mol_formula']
 
         # Check if the row already exists, if not then INSERT
-        molecule_id = molecules._get_inchi_from_db(inchi_key)
+        molecule_id = _get_molecule_id(inchi_key)
         log.debug(f"Current molecule_d  {molecule_id}")
         relation_value = mol_rel_data.get_mol_formula_by_package_id(package_id)
         log.debug(f"Here is the relation {relation_value}")
@@ -601,7 +921,7 @@ def _send_to_db(package):
 
         if not molecule_id:  # if there is no molecule at all, it inserts rows into molecules and molecule_rel_data dt
             molecules.create(standard_inchi, smiles, inchi_key, exact_mass, mol_formula)
-            new_molecules_id = molecules._get_inchi_from_db(inchi_key)
+            new_molecules_id = _get_molecule_id(inchi_key)
             new_molecules_id = new_molecules_id[0]
             # Check if relaionship exists
             log.debug(f"New molecule {new_molecules_id}")
@@ -625,56 +945,35 @@ def _send_to_db(package):
     return 0
 
 
-def _import_molecule_images(package):
-    package_id = package['id']
-    try:
-        if package['inchi'] and package['inchi_key']:
-            standard_inchi = package['inchi']
-            inchi_key = package['inchi_key']
-
-            if standard_inchi.startswith('InChI'):
-                molecule = inchi.MolFromInchi(standard_inchi)
-                log.debug("Molecule generated")
-                try:
-                    filepath = '/var/lib/ckan/default/storage/images/' + str(inchi_key) + '.png'
-                    if os.path.isfile(filepath):
-                        log.debug("Image Already exists")
-                    else:
-                        Draw.MolToFile(molecule, filepath)
-                        log.debug("Molecule Image generated for %s", package_id)
-
-                except Exception as e:
-                    log.error(f"_import_molecule_images not possible: {e}")
-            return 0
-
-        elif package['inchi']:
-            standard_inchi = package['inchi']
-            if standard_inchi.startswith('InChI'):
-                molecule = inchi.MolFromInchi(standard_inchi)
-                inchi_key = inchi.InchiToInchiKey(standard_inchi)
-                try:
-                    filepath = '/var/lib/ckan/default/storage/images/' + str(inchi_key) + '.png'
-                    if os.path.isfile(filepath):
-                        log.debug("Image Already exists")
-                    else:
-                        Draw.MolToFile(molecule, filepath)
-                        log.debug("Molecule Image generated for %s", package_id)
-                except Exception as e:
-                    log.error(f"_import_molecule_images not possible: {e}")
-
-            return 0
-
-        else:
-            return 0
-
-    except Exception as e:
-        log.error(f"Exception occured # line 483{e}")
-        return 0
+def _close_image_renderer(renderer):
+    '''Wait for the molecule images of an import, and count them.'''
+    with metrics.stage('images'):
+        renderer.close()
+    metrics.count('images_rendered', renderer.rendered)
+    metrics.count('images_failed', renderer.failed)
+
+
+def _molecule_image_renderer(background=False):
+    '''Return the molecule image renderer of an import. Unless configured
+    otherwise, images are rendered by a pool of worker processes in
+    background imports, and queued as background jobs by imports run within
+    a web request, which don't wait for them.'''
+    config = toolkit.config
+    processes = config.get('ckanext.datapackager.image_processes')
+    mode = config.get('ckanext.datapackager.image_rendering') or (
+        images.POOL if background else images.JOB)
+    return images.MoleculeImageRenderer(
+        mode=mode,
+        store=get_image_store(),
+        processes=toolkit.asint(processes) if processes else None,
+        maxtasksperchild=toolkit.asint(config.get(
+            'ckanext.datapackager.image_maxtasksperchild', 100)),
+    )
 
 
 # Used only in CKAN < 2.9
 class _UploadLocalFileStorage(cgi.FieldStorage):
-    def __init__(self, fp, *args, **kwargs):
-        self.name = fp.name
-        self.filename = fp.name
+    def __init__(self, fp, filename=None, *args, **kwargs):
+        self.name = filename or fp.name
+        self.filename = filename or fp.name
         self.file = fp
@@ -13,12 +13,15 @@ import ckan.logic
 import ckan.logic.action
 import ckan.logic.schema
 import ckan.plugins as plugins
+import ckan.plugins.toolkit as toolkit
 import ckan.lib.api_token as api_token
 from ckan import authz
 from ckan.lib.navl.dictization_functions import validate
 from ckan.model.follower import ModelFollowingModel
-from ckanext.rdkit_visuals.models.molecule_rel import MolecularRelationData as mol_rel_data
 from ckanext.related_resources.models.related_resources import RelatedResources as related_resource_data
+from ckanext.datapackager.lib import export
+from ckanext.datapackager.lib.image_store import get_image_store
+from ckanext.datapackager.lib.molecules import molecule_id_cache, molecule_fk_attribute, purge_orphans, models as molecule_models
 from ckan.logic import check_access
 from ckan.logic import NotFound
 
@@ -33,6 +36,8 @@ ValidationError = ckan.logic.ValidationError
 _get_or_bust = ckan.logic.get_or_bust
 _get_action = ckan.logic.get_action
 
+_MOLECULE_GC_WATERMARK = 'ckanext.datapackager.molecule_gc_watermark'
+
 
 def purge_dataset_foreignkeys(context, data_dict):
     """
@@ -63,21 +68,246 @@ def purge_dataset_foreignkeys(context, data_dict):
         raise NotFound('Dataset not found')
 
     context['package'] = pkg
+    _purge_packages(context, [pkg.id])
 
-    molecule_id_members = model.Session.query(mol_rel_data).filter(mol_rel_data.package_id == pkg.id)
-    related_resources_members = model.Session.query(related_resource_data).filter(related_resource_data.package_id == pkg.id)
 
-    if molecule_id_members.count() > 0:
-        for row in molecule_id_members.all():
-            log.debug(f'Purging dataset id: {row.package_id}')
-            model.Session.delete(row)
+def purge_datasets_foreignkeys(context, data_dict):
+    """
+    Purge many datasets, along with their rows in the molecule_rel_data and
+    related resources tables, a chunk of datasets per transaction.
 
-    if related_resources_members.count() > 0:
-        for row in related_resources_members.all():
-            log.debug(f'Purging related resource... ')
-            model.Session.delete(row)
+    The relation rows of a chunk are deleted with one statement per table,
+    rather than one ORM object at a time. Progress is logged after each
+    chunk (and passed to ``context['purge_progress']``, a callable taking
+    the number of datasets done and the total, if given).
 
-    pkg = model.Package.get(id)
-    assert pkg
-    pkg.purge()
+     :param ids: the names or ids of the datasets (either ``ids`` or ``q``
+        must be given)
+     :type ids: list of strings
+     :param q: a Solr query matching the datasets to purge
+     :type q: string
+     :param chunk_size: the number of datasets purged per transaction
+        (optional, default: ``ckanext.datapackager.purge_chunk_size``)
+     :type chunk_size: int
+
+     :returns: the number of datasets purged and the given ids of the
+        datasets that were not found
+     :rtype: dictionary
+    """
+    try:
+        check_access('sysadmin', context, data_dict)
+    except NotFound:
+        raise NotFound('Only sysadmin can access this function.')
+
+    ids = data_dict.get('ids')
+    q = data_dict.get('q')
+    if isinstance(ids, str):
+        ids = [ids]
+    if not ids and not q:
+        raise ValidationError({'ids': [_('Missing value')]})
+    chunk_size = _purge_chunk_size(data_dict.get('chunk_size'))
+    if ids:
+        ids = list(dict.fromkeys(ids))
+    else:
+        ids = _search_package_ids(context, q)
+
+    total = len(ids)
+    progress = context.get('purge_progress')
+    purged = 0
+    not_found = []
+    for start in range(0, total, chunk_size):
+        chunk = ids[start:start + chunk_size]
+        package_ids, missing = _resolve_package_ids(context['model'], chunk)
+        not_found.extend(missing)
+        if package_ids:
+            _purge_packages(context, package_ids)
+        purged += len(package_ids)
+        done = min(start + chunk_size, total)
+        log.info(f'Purged {purged} datasets ({done} of {total} processed)')
+        if progress:
+            progress(done, total)
+
+    return {'purged': purged, 'not_found': not_found}
+
+
+def purge_orphaned_molecules(context, data_dict):
+    """
+    Delete the molecules that no dataset is related to any more (e.g. after
+    their datasets were purged), and optionally their images.
+
+    Molecules are scanned in id order, a batch at a time, each batch being
+    deleted in its own transaction. The id of the last molecule scanned is
+    kept as a watermark (in the ``system_info`` table), so that with
+    ``max_batches`` a run only scans part of the table and the next one
+    carries on from there. Once the end of the table is reached, the next
+    run starts over.
+
+     :param batch_size: the number of molecules scanned per batch
+        (optional, default: ``ckanext.datapackager.molecule_gc_batch_size``)
+     :type batch_size: int
+     :param max_batches: the maximum number of batches scanned (optional,
+        default: scan up to the end of the table)
+     :type max_batches: int
+     :param remove_images: also delete the images of the molecules from the
+        image store (optional, default: ``False``)
+     :type remove_images: bool
+     :param restart: ignore the watermark and scan from the first molecule
+        (optional, default: ``False``)
+     :type restart: bool
+     :param dry_run: only count the orphaned molecules (optional, default:
+        ``False``); the watermark is left as it is
+     :type dry_run: bool
+
+     :returns: the number of molecules scanned and purged (or that would be
+        purged), of images removed, the watermark and whether the end of
+        the table was reached
+     :rtype: dictionary
+    """
+    try:
+        check_access('sysadmin', context, data_dict)
+    except NotFound:
+        raise NotFound('Only sysadmin can access this function.')
+
+    model = context['model']
+    batch_size = _positive_int(data_dict, 'batch_size', toolkit.config.get(
+        'ckanext.datapackager.molecule_gc_batch_size', 1000))
+    max_batches = data_dict.get('max_batches')
+    if max_batches is not None:
+        max_batches = _positive_int(data_dict, 'max_batches')
+    remove_images = toolkit.asbool(data_dict.get('remove_images', False))
+    dry_run = toolkit.asbool(data_dict.get('dry_run', False))
+
+    after = None
+    if not toolkit.asbool(data_dict.get('restart', False)):
+        after = model.get_system_info(_MOLECULE_GC_WATERMARK) or None
+
+    result = {'scanned': 0, 'purged': 0, 'images_removed': 0,
+              'completed': False}
+    image_store = get_image_store() if remove_images and not dry_run \
+        else None
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        last_id, scanned, orphans = purge_orphans(
+            after=after, batch_size=batch_size, dry_run=dry_run)
+        batches += 1
+        result['scanned'] += scanned
+        result['purged'] += len(orphans)
+        completed = last_id is None or scanned < batch_size
+        after = None if completed else last_id
+        if dry_run:
+            model.Session.rollback()
+        else:
+            model.set_system_info(_MOLECULE_GC_WATERMARK,
+                                  '' if after is None else str(after))
+            # set_system_info doesn't commit when the value is unchanged.
+            model.Session.commit()
+            if orphans:
+                molecule_id_cache.invalidate(
+                    [molecule_id for molecule_id, inchi_key in orphans])
+            if image_store and orphans:
+                result['images_removed'] += image_store.remove(
+                    [inchi_key for molecule_id, inchi_key in orphans
+                     if inchi_key])
+        log.info(f"Scanned {result['scanned']} molecules, "
+                 f"{result['purged']} orphaned")
+        if completed:
+            result['completed'] = True
+            break
+
+    result['watermark'] = after
+    return result
+
+
+
+def _purge_packages(context, package_ids):
+    """Delete the relation rows of the datasets with one statement per table,
+    purge the datasets and commit."""
+    model = context['model']
+    session = model.Session
+
+    mol_rel_data = molecule_models()[1]
+    relations = mol_rel_data.__table__
+    purged_molecule_ids = [row[0] for row in session.execute(
+        sqla.delete(relations)
+        .where(relations.c.package_id.in_(package_ids))
+        .returning(relations.c[_molecule_fk_column_name()]))]
+    session.execute(
+        sqla.delete(related_resource_data.__table__)
+        .where(related_resource_data.__table__.c.package_id.in_(package_ids)))
+    # As dataset_purge does, the memberships of the datasets go with them.
+    session.execute(
+        sqla.delete(model.member_table)
+        .where(model.member_table.c.table_name == 'package')
+        .where(model.member_table.c.table_id.in_(package_ids)))
+
+    for pkg in session.query(model.Package).filter(
+            model.Package.id.in_(package_ids)):
+        log.debug(f'Purging dataset id: {pkg.id}')
+        pkg.purge()
     model.repo.commit_and_remove()
+
+    # The molecules may be removed along with their last relation.
+    if purged_molecule_ids:
+        molecule_id_cache.invalidate(purged_molecule_ids)
+
+
+def _resolve_package_ids(model, names_or_ids):
+    """Return the ids of the datasets with the given names or ids, and the
+    names or ids that match no dataset."""
+    rows = model.Session.query(model.Package.id, model.Package.name).filter(
+        sqla.or_(model.Package.id.in_(names_or_ids),
+                 model.Package.name.in_(names_or_ids))).all()
+    found = set()
+    package_ids = []
+    for package_id, name in rows:
+        found.update((package_id, name))
+        package_ids.append(package_id)
+    return package_ids, [value for value in names_or_ids
+                         if value not in found]
+
+
+def _search_package_ids(context, q):
+    """Return the ids of all the datasets matching a search, paging by
+    id."""
+    rows = export.page_size(1000)
+    ids = []
+    after = None
+    while True:
+        fq = '+id:{{"{0}" TO *]'.format(after) if after else ''
+        result = _get_action('package_search')(
+            {'model': context['model'], 'session': context['session'],
+             'user': context.get('user'), 'ignore_auth': True}, {
+                'q': q,
+                'fq': fq,
+                'fl': 'id',
+                'sort': 'id asc',
+                'rows': rows,
+                'include_private': True,
+                'include_drafts': True,
+            })
+        page = [package if isinstance(package, str) else package['id']
+                for package in result['results']]
+        ids.extend(page)
+        if len(page) < rows:
+            return ids
+        after = page[-1]
+
+
+def _purge_chunk_size(value=None):
+    return _positive_int({'chunk_size': value}, 'chunk_size', toolkit.config.get(
+        'ckanext.datapackager.purge_chunk_size', 500))
+
+
+def _positive_int(data_dict, key, default=None):
+    try:
+        value = toolkit.asint(data_dict.get(key) or default)
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise ValidationError({key: [_('Must be a positive integer')]})
+    return value
+
+
+def _molecule_fk_column_name():
+    molecules, mol_rel_data = molecule_models()
+    return getattr(mol_rel_data, molecule_fk_attribute()).property.columns[0].name
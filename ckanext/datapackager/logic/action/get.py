@@ -1,6 +1,14 @@
+import os
+import time
+
 import ckan.plugins.toolkit as toolkit
 from frictionless_ckan_mapper import ckan_to_frictionless as converter
 
+from ckanext.datapackager.lib import export
+from ckanext.datapackager.lib import metrics
+from ckanext.datapackager.lib import molecules
+from ckanext.datapackager.lib import progress
+
 
 @toolkit.side_effect_free
 def package_show_as_datapackage(context, data_dict):
@@ -27,3 +35,121 @@ def package_show_as_datapackage(context, data_dict):
                                                       {'id': dataset_id})
 
     return converter.dataset(dataset_dict)
+
+
+@toolkit.side_effect_free
+def package_search_as_datapackages(context, data_dict):
+    '''Return the datasets matching a search as Data Packages, a page at a
+    time.
+
+    Pages are ordered by dataset id. To get the next page, call the action
+    again with the ``after`` value returned. The whole result can also be
+    downloaded in one request, as NDJSON or as a zip of ``datapackage.json``
+    files, from ``/datapackage/export.ndjson`` or
+    ``/datapackage/export.zip``, which take the same ``q`` and
+    ``organization`` parameters.
+
+    :param q: the Solr query the datasets must match (optional, default:
+        all datasets)
+    :type q: string
+    :param organization: the name or id of the organization the datasets
+        must belong to (optional)
+    :type organization: string
+    :param rows: the number of datasets per page (optional, default:
+        ``ckanext.datapackager.export_page_size``, at most
+        ``ckan.search.rows_max``)
+    :type rows: int
+    :param after: the ``after`` value returned with the previous page
+        (optional)
+    :type after: string
+
+    :returns: the ``count`` of datasets matching the search from ``after``
+        on, the Data Packages of the page (``results``) and the ``after``
+        value of the next page (``None`` after the last page)
+    :rtype: dictionary
+
+    '''
+    toolkit.check_access('package_search', context, data_dict)
+
+    rows = data_dict.get('rows')
+    if rows is not None:
+        try:
+            rows = toolkit.asint(rows)
+        except ValueError:
+            raise toolkit.ValidationError({'rows': ['Must be an integer']})
+
+    count, datapackages, after = export.search_datapackages(
+        context,
+        q=data_dict.get('q'),
+        organization=export.organization_name(data_dict.get('organization')),
+        rows=rows,
+        after=data_dict.get('after'),
+    )
+    return {'count': count, 'results': datapackages, 'after': after}
+
+
+@toolkit.side_effect_free
+def datapackage_import_status(context, data_dict):
+    '''Return the progress of a background Data Package import.
+
+    Imports are run in the background when ``package_create_from_datapackage``
+    is called with ``background=True``. Only the user who started the import
+    and sysadmins can see its status.
+
+    :param id: the id of the import, as returned when it was queued
+    :type id: string
+
+    :returns: the ``state`` of the import (``queued``, ``running``,
+        ``finished`` or ``failed``), the number of records ``processed``,
+        ``created``, ``skipped`` and ``failed`` so far, the ``throughput`` in
+        records per second and, for failed imports, the ``error``
+    :rtype: dictionary
+
+    '''
+    try:
+        job_id = data_dict['id']
+    except KeyError:
+        raise toolkit.ValidationError({'id': 'missing id'})
+
+    toolkit.check_access('package_create', context)
+
+    status = progress.get_status(job_id)
+    if status is None:
+        raise toolkit.ObjectNotFound('Import not found')
+
+    if status.get('user') != context.get('user'):
+        toolkit.check_access('sysadmin', context)
+
+    if status['state'] == progress.RUNNING and status['started_at']:
+        elapsed = time.time() - status['started_at']
+        if elapsed > 0:
+            status['throughput'] = round(status['processed'] / elapsed, 2)
+
+    return status
+
+
+@toolkit.side_effect_free
+def datapackager_metrics(context, data_dict):
+    '''Return the timings and counters of the imports run by all the CKAN
+    and background jobs worker processes (added up in Redis), and the cache
+    statistics. Only sysadmins can see them.
+
+    :returns: the number of ``imports`` by kind and status, the total
+        ``import_seconds``, the calls to and time spent in each of the
+        ``stages`` of the imports, their ``counters`` (records, bytes read,
+        database round-trips, images rendered, cache hits...), the metrics
+        of the ``recent_imports``, the hits and misses of the molecule id
+        and HTTP ``caches``, and the ``process`` serving the request (its
+        ``pid`` and the ``size`` of its molecule id cache)
+    :rtype: dictionary
+
+    '''
+    toolkit.check_access('sysadmin', context)
+
+    result = metrics.shared_metrics.snapshot()
+    result['caches'] = metrics.cache_stats(result)
+    result['process'] = {
+        'pid': os.getpid(),
+        'molecule_id_cache': molecules.molecule_id_cache.stats(),
+    }
+    return result
@@ -61,7 +61,6 @@ ckan_package_keys = [
     'smiles',
     'mol_formula',
     'doi',
-    'version',
     'language',
     'metadata_published',
     'alternateNames'
@@ -71,6 +70,28 @@ frictionless_package_keys_to_exclude = [
     'extras'
 ]
 
+# The mapping plan, compiled once.
+
+# The keys of the input kept in the CKAN package.
+_KEPT_KEYS = frozenset(ckan_package_keys) | frozenset(
+    frictionless_package_keys_to_exclude)
+
+_COPY = object()
+
+# The chemical fields: (ckan key, input keys, default). The value is the
+# first truthy value of the input keys, or the default, or with _COPY the
+# value of the (single) input key as is. They are mapped in order, and a
+# missing input key ends the mapping of the chemical fields.
+_CHEMICAL_FIELDS = (
+    ('inchi', ('inChI',), ''),
+    ('inchi_key', ('inChIKey',), ''),
+    ('smiles', ('smiles',), ''),
+    ('mol_formula', ('molecularFormula', 'chemicalComposition'), '-'),
+    ('exactmass', ('monoisotopicMolecularWeight',), _COPY),
+)
+
+_AUTHOR_ROLES = (None, 'author')
+
 
 def _extract_resources(content):
     """
@@ -78,7 +99,7 @@ def _extract_resources(content):
     """
     resources = []
     url = content['url']
-    log.debug("URL of resource: %s" % url)
+    log.debug("URL of resource: %s", url)
     if url:
         try:
             resource_format = content["format"][0]
@@ -98,39 +119,14 @@ def _extract_resources(content):
 def package(fddict):
     """Convert a MassBank Import package to a CKAN package (dataset).
     """
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f"{fddict}")
 
-    outdict = dict(fddict)
-
-    log.debug(f"{fddict}")
-    try:
-        if fddict['inChI']:
-            outdict['inchi'] = fddict['inChI']
-        else:
-            outdict['inchi'] = ''
+    # Only the keys CKAN knows are kept, so those are the only ones copied.
+    outdict = dict((key, value) for key, value in fddict.items()
+                   if key in _KEPT_KEYS)
 
-        if fddict['inChIKey']:
-            outdict['inchi_key'] = fddict['inChIKey']
-        else:
-            outdict['inchi_key'] = ''
-
-        if fddict['smiles']:
-            outdict['smiles'] = fddict['smiles']
-        else:
-            outdict['smiles'] = ''
-
-        if fddict['molecularFormula']:
-            outdict['mol_formula'] = fddict['molecularFormula']
-
-        elif fddict['chemicalComposition']:
-            outdict['mol_formula'] = fddict['chemicalComposition']
-        else:
-            outdict['mol_formula'] = '-'
-
-        outdict['exactmass'] = fddict['monoisotopicMolecularWeight']
-
-    except Exception as e:
-        log.error(f'Missing Chemical Information and {e}')
-        pass
+    _map_chemical_fields(fddict, outdict)
 
     outdict['metadata_published'] = fddict['datePublished']
     # map resources inside dataset
@@ -138,9 +134,6 @@ def package(fddict):
     if 'url' in fddict:
         outdict['resources'] = _extract_resources(fddict)
 
-    if 'license' in fddict:
-        outdict['license'] = fddict['license']
-
     try:
         outdict['title'] = fddict['name']
         outdict['name'] = fddict['identifier'].lower()
@@ -151,71 +144,58 @@ def package(fddict):
             outdict['measurement_technique'] = measurement_technique[0]['name']
             outdict['measurement_technique_iri'] = measurement_technique[0]['url']
 
-        #if 'licenses' in outdict and outdict['licenses']:
-        #    outdict['license_id'] = outdict['licenses'][0].get('name')
-        #    outdict['license_title'] = outdict['licenses'][0].get('title')
-        #    outdict['license_url'] = outdict['licenses'][0].get('path')
-        #    # remove it so it won't get put in extras
-        #    if len(outdict['licenses']) == 1:
-        #        outdict.pop('licenses', None)
-
-        if outdict.get('contributors'):
-            for c in outdict['contributors']:
-                if c.get('role') in [None, 'author']:
-                    outdict['author'] = c.get('title')
-                    outdict['author_email'] = c.get('email')
-                    break
-
-            for c in outdict['contributors']:
-                if c.get('role') == 'maintainer':
-                    outdict['maintainer'] = c.get('title')
-                    outdict['maintainer_email'] = c.get('email')
-                    break
-
-            # we remove contributors where we have extracted everything into
-            # ckan core that way it won't end up in extras
-            # this helps ensure that round tripping with ckan is good
-            # when have we extracted everything?
-            # if contributors has length 1 and role in author or maintainer
-            # or contributors == 2 and no of authors and maintainer types <= 1
-            if (
-                    (len(outdict.get('contributors')) == 1 and
-                     outdict['contributors'][0].get('role') in [None, 'author',
-                                                                'maintainer'])
-                    or
-                    (len(outdict.get('contributors')) == 2 and
-                     [c.get('role') for c in outdict['contributors']]
-                     not in (
-                             [None, None],
-                             ['maintainer', 'maintainer'],
-                             ['author', 'author']))
-            ):
-                outdict.pop('contributors', None)
+        _map_contributors(fddict.get('contributors'), outdict)
 
     except KeyError as e:
         log.debug(e)
 
-    final_dict = dict(outdict)
+    return outdict
+
 
-    for key, value in outdict.items():
+def packages(fddicts):
+    """Convert MassBank Import packages to CKAN packages, one at a time.
 
-        if (
-                key not in ckan_package_keys and
-                key not in frictionless_package_keys_to_exclude
-        ):
+    :param fddicts: the packages to convert
+    :type fddicts: iterable of dicts
 
-            #if isinstance(value, (dict, list)):
-            #    value = json.dumps(value)
-            #if not final_dict.get('extras'):
-            #   final_dict['extras'] = []
-            #final_dict['extras'].append(
-            #    {'key': key, 'value': value}
-            #)
+    :rtype: iterator of dicts
+    """
+    convert = package
+    for fddict in fddicts:
+        yield convert(fddict)
 
-            del final_dict[key]
 
-    outdict = dict(final_dict)
+def _map_chemical_fields(fddict, outdict):
+    try:
+        for key, sources, default in _CHEMICAL_FIELDS:
+            if default is _COPY:
+                outdict[key] = fddict[sources[0]]
+                continue
+            for source in sources:
+                value = fddict[source]
+                if value:
+                    outdict[key] = value
+                    break
+            else:
+                outdict[key] = default
+    except Exception as e:
+        log.error(f'Missing Chemical Information and {e}')
 
-    return outdict
 
+def _map_contributors(contributors, outdict):
+    # The contributors themselves aren't kept (they have no CKAN key), only
+    # the author and maintainer found among them.
+    if not contributors:
+        return
+
+    for c in contributors:
+        if c.get('role') in _AUTHOR_ROLES:
+            outdict['author'] = c.get('title')
+            outdict['author_email'] = c.get('email')
+            break
 
+    for c in contributors:
+        if c.get('role') == 'maintainer':
+            outdict['maintainer'] = c.get('title')
+            outdict['maintainer_email'] = c.get('email')
+            break
@@ -1,8 +1,9 @@
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckanext.datapackager.logic.action.create import package_create_from_datapackage_or_cif
-from ckanext.datapackager.logic.action.get import package_show_as_datapackage
-from ckanext.datapackager.logic.action.delete import purge_dataset_foreignkeys
+from ckanext.datapackager.logic.action.get import package_show_as_datapackage, package_search_as_datapackages, datapackage_import_status, datapackager_metrics
+from ckanext.datapackager.logic.action.delete import purge_dataset_foreignkeys, purge_datasets_foreignkeys, purge_orphaned_molecules
+from ckanext.datapackager.lib import export_cache
 
 if toolkit.check_ckan_version(u'2.9'):
     from ckanext.datapackager.plugin.flask_plugin import MixinPlugin
@@ -17,6 +18,7 @@ class DataPackagerPlugin(MixinPlugin, plugins.SingletonPlugin):
     '''
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IPackageController, inherit=True)
 
     def update_config(self, config):
         toolkit.add_template_directory(config, '../templates')
@@ -25,5 +27,25 @@ class DataPackagerPlugin(MixinPlugin, plugins.SingletonPlugin):
         return {
             'package_create_from_datapackage': package_create_from_datapackage_or_cif,
             'package_show_as_datapackage': package_show_as_datapackage,
+            'package_search_as_datapackages': package_search_as_datapackages,
             'purge_dataset_foreignkeys' : purge_dataset_foreignkeys,
+            'purge_datasets_foreignkeys': purge_datasets_foreignkeys,
+            'purge_orphaned_molecules': purge_orphaned_molecules,
+            'datapackage_import_status': datapackage_import_status,
+            'datapackager_metrics': datapackager_metrics,
         }
+
+    # IPackageController
+
+    def after_dataset_update(self, context, pkg_dict):
+        export_cache.invalidate(pkg_dict['id'])
+
+    def after_dataset_delete(self, context, pkg_dict):
+        export_cache.invalidate(pkg_dict['id'])
+
+    # CKAN < 2.10
+    def after_update(self, context, pkg_dict):
+        self.after_dataset_update(context, pkg_dict)
+
+    def after_delete(self, context, pkg_dict):
+        self.after_dataset_delete(context, pkg_dict)
@@ -2,14 +2,22 @@ import ckan.plugins as plugins
 
 from flask import Blueprint
 import ckanext.datapackager.controllers.datapackage as datapackage
+import ckanext.datapackager.cli as cli
 
 class MixinPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IBlueprint)
-    
+    plugins.implements(plugins.IClick)
+
+    def get_commands(self):
+        return [cli.datapackager]
+
     def get_blueprint(self):
         blueprint = Blueprint('datapackager', __name__)
         # As long as the URL for import_datapackage_view and import_datapackage are the same, reverse lookups from import_datapackage will work
         blueprint.add_url_rule("/import_datapackage", view_func=datapackage.new, endpoint='import_datapackage', methods=['GET'])
         blueprint.add_url_rule("/import_datapackage", view_func=datapackage.import_datapackage, endpoint='import_datapackage_post', methods=['POST'])
         blueprint.add_url_rule("/dataset/<package_id>/datapackage.json", view_func=datapackage.export_datapackage, endpoint='export_datapackage', methods=['GET'])
+        blueprint.add_url_rule("/dataset/<package_id>/datapackage.zip", view_func=datapackage.export_datapackage_zip, endpoint='export_datapackage_zip', methods=['GET'])
+        blueprint.add_url_rule("/datapackage/export.<format>", view_func=datapackage.export_datapackages, endpoint='export_datapackages', methods=['GET'])
+        blueprint.add_url_rule("/datapackager/metrics", view_func=datapackage.metrics, endpoint='metrics', methods=['GET'])
         return blueprint
\ No newline at end of file
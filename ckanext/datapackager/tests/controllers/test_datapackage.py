@@ -1,11 +1,18 @@
 '''Functional tests for controllers/package.py.'''
+import io
 import json
+import zipfile
 import pytest
 import responses
 from bs4 import BeautifulSoup
 import re
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import ckanapi
+from werkzeug.datastructures import FileStorage
 import datapackage
 import ckan.tests.factories as factories
 import ckan.tests.helpers as helpers
@@ -82,6 +89,93 @@ class TestDataPackageController():
 
         assert uploaded_resource['url'] == resources[1].descriptor['path']
 
+    def test_download_sends_cache_validators(self, app):
+        dataset = factories.Dataset()
+        url = _url_for('datapackager.export_datapackage',
+                       package_id=dataset['name'])
+
+        response = app.get(url)
+
+        assert response.headers['ETag']
+        assert response.headers['Last-Modified']
+        assert json.loads(response.body)['name'] == dataset['name']
+
+    def test_download_answers_conditional_requests_with_304(self, app):
+        dataset = factories.Dataset()
+        url = _url_for('datapackager.export_datapackage',
+                       package_id=dataset['name'])
+        etag = app.get(url).headers['ETag']
+
+        with mock.patch.object(toolkit, 'get_action',
+                               wraps=toolkit.get_action) as get_action:
+            response = app.get(url, headers={'If-None-Match': etag},
+                               status=304)
+
+        assert response.headers['ETag'] == etag
+        assert mock.call('package_show_as_datapackage') not in \
+            get_action.call_args_list
+
+    def test_download_is_rendered_again_after_an_update(self, app):
+        dataset = factories.Dataset(title='Before')
+        url = _url_for('datapackager.export_datapackage',
+                       package_id=dataset['name'])
+        etag = app.get(url).headers['ETag']
+
+        helpers.call_action('package_patch', id=dataset['id'], title='After')
+
+        response = app.get(url, headers={'If-None-Match': etag})
+        assert response.headers['ETag'] != etag
+        assert json.loads(response.body)['title'] == 'After'
+
+    def test_download_datapackage_zip(self, app):
+        dataset = factories.Dataset()
+        linked_resource = factories.Resource(
+            package_id=dataset['id'], url='http://www.foo.com/data.csv')
+        csv_path = 'lahmans-baseball-database/AllstarFull.csv'
+        helpers.call_action('resource_create', {},
+            package_id=dataset['id'],
+            name='AllstarFull',
+            url='AllstarFull.csv',
+            upload=FileStorage(custom_helpers.get_csv_file(csv_path),
+                               'AllstarFull.csv'),
+        )
+
+        url = _url_for('datapackager.export_datapackage_zip',
+                       package_id=dataset['name'])
+        response = app.get(url)
+
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        assert archive.namelist() == ['datapackage.json',
+                                      'data/AllstarFull.csv']
+        descriptor = json.loads(archive.read('datapackage.json'))
+        assert descriptor['name'] == dataset['name']
+        assert descriptor['resources'][0]['path'] == linked_resource['url']
+        assert descriptor['resources'][1]['path'] == 'data/AllstarFull.csv'
+        with custom_helpers.get_csv_file(csv_path) as f:
+            assert archive.read('data/AllstarFull.csv') == f.read()
+
+    @pytest.mark.usefixtures('clean_index')
+    def test_export_datapackages_as_ndjson(self, app):
+        datasets = [factories.Dataset() for i in range(3)]
+
+        response = app.get('/datapackage/export.ndjson')
+
+        lines = response.body.strip().split('\n')
+        assert sorted(json.loads(line)['name'] for line in lines) == \
+            sorted(dataset['name'] for dataset in datasets)
+
+    @pytest.mark.usefixtures('clean_index')
+    def test_export_datapackages_as_zip(self, app):
+        dataset = factories.Dataset()
+
+        response = app.get('/datapackage/export.zip')
+
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        assert archive.namelist() == [
+            '{0}/datapackage.json'.format(dataset['name'])]
+        assert json.loads(archive.read(archive.namelist()[0]))['name'] == \
+            dataset['name']
+
     def test_that_download_button_is_on_page(self, app):
         '''Tests that the download button is shown on the dataset pages.'''
 
@@ -0,0 +1,86 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ckanext.datapackager.lib import blobs
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = blobs.BlobStore(os.path.join(self.directory, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_add_stores_the_content_under_its_sha256(self):
+        content = b'mz,intensity\n78.047,999\n'
+
+        digest, size, path, created = self.store.add(io.BytesIO(content))
+
+        assert digest == hashlib.sha256(content).hexdigest()
+        assert size == len(content)
+        assert created
+        assert path == os.path.join(self.store.root, digest[:2],
+                                    digest[2:4], digest)
+        with open(path, 'rb') as f:
+            assert f.read() == content
+
+    def test_add_stores_each_content_once(self):
+        first = self.store.add(io.BytesIO(b'spectrum'))
+        inode = os.stat(first[2]).st_ino
+
+        second = self.store.add(io.BytesIO(b'spectrum'))
+
+        assert second[:3] == first[:3]
+        assert not second[3]
+        # The existing blob (which resources may be linked to) is kept.
+        assert os.stat(second[2]).st_ino == inode
+        assert list(self.store.iter_blobs()) == [first[2]]
+
+    def test_add_reads_large_files_in_chunks(self):
+        content = os.urandom(blobs.CHUNK_SIZE * 2 + 10)
+
+        digest, size, path, created = self.store.add(io.BytesIO(content))
+
+        assert digest == hashlib.sha256(content).hexdigest()
+        assert size == len(content)
+
+    def _age(self, path, hours):
+        mtime = time.time() - hours * 60 * 60
+        os.utime(path, (mtime, mtime))
+
+    def test_prune_deletes_the_blobs_nothing_links_to(self):
+        used = self.store.add(io.BytesIO(b'used'))[2]
+        unused = self.store.add(io.BytesIO(b'unused'))[2]
+        os.link(used, os.path.join(self.directory, 'resource'))
+        self._age(used, blobs.DEFAULT_GRACE_HOURS + 1)
+        self._age(unused, blobs.DEFAULT_GRACE_HOURS + 1)
+
+        assert self.store.prune(dry_run=True) == (1, len(b'unused'))
+        assert os.path.exists(unused)
+
+        assert self.store.prune() == (1, len(b'unused'))
+        assert not os.path.exists(unused)
+        assert os.path.exists(used)
+
+    def test_prune_keeps_the_blobs_just_added(self):
+        # Added by an import which has not linked its resources to it yet.
+        fresh = self.store.add(io.BytesIO(b'fresh'))[2]
+
+        assert self.store.prune() == (0, 0)
+        assert os.path.exists(fresh)
+
+    def test_adding_a_blob_again_restarts_its_grace_period(self):
+        path = self.store.add(io.BytesIO(b'reused'))[2]
+        self._age(path, blobs.DEFAULT_GRACE_HOURS + 1)
+
+        assert not self.store.add(io.BytesIO(b'reused'))[3]
+
+        assert self.store.prune() == (0, 0)
+        assert os.path.exists(path)
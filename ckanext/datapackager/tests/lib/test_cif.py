@@ -0,0 +1,188 @@
+import io
+import tarfile
+import unittest
+import zipfile
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ckanext.datapackager.lib import cif
+
+MMCIF = '''# A trimmed down mmCIF file
+data_1ABC
+_citation.id primary
+_citation.title
+;Crystal structure of
+ a small molecule
+;
+loop_
+_citation_author.citation_id
+_citation_author.name
+primary 'Smith, J.'
+primary "O'Brien, K."
+1       'Someone, E.'
+_chemical_formula_structural 'C6 H6'
+_chemical_name_common benzene # trailing comment
+_space_group.name_H-M_alt 'P 21/c'
+_space_group.IT_number 14
+_cell.length_a 5.0
+loop_
+_atom_site.type_symbol
+_atom_site.fract_x
+C 0.1
+C 0.2
+'''
+
+CIF_1 = '''data_first
+_publ_section_title 'First structure'
+_symmetry_space_group_name_H-M 'P 1'
+loop_
+_publ_author_name
+'Doe, J.'
+data_second
+_chemical_formula_structural ?
+'''
+
+SINGLE_BLOCK = 'data_single\n_chemical_formula_structural C6H6\n'
+
+
+class TestCifParser(unittest.TestCase):
+
+    def test_it_parses_items_and_loops(self):
+        block, = cif.iter_cif_blocks(MMCIF)
+
+        assert block.name == '1ABC'
+        assert block.get('_cell_length_a') == '5.0'
+        assert block.get('_chemical_name_common') == 'benzene'
+        assert block.column('_atom_site_type_symbol') == ['C', 'C']
+        assert block.column('_atom_site.fract_x') == ['0.1', '0.2']
+        assert block.column('_unknown') == []
+
+    def test_metadata(self):
+        block, = cif.iter_cif_blocks(MMCIF)
+
+        assert cif.cif_metadata(block) == {
+            'identifier': 'data_1ABC',
+            'citation_title': 'Crystal structure of a small molecule',
+            'mol_formula': 'C6 H6',
+            'molecule_name': 'benzene',
+            'authors': ['Smith, J.', "O'Brien, K."],
+            'extras': {
+                'space_group_name_H-M': 'P 21/c',
+                'space_group_IT_number': '14',
+            },
+        }
+
+    def test_it_parses_every_block(self):
+        first, second = cif.iter_cif_blocks(CIF_1)
+
+        metadata = cif.cif_metadata(first)
+        assert metadata['citation_title'] == 'First structure'
+        assert metadata['authors'] == ['Doe, J.']
+        assert metadata['extras'] == {'space_group_name_H-M': 'P 1'}
+        assert cif.cif_metadata(second)['identifier'] == 'data_second'
+        assert cif.cif_metadata(second)['mol_formula'] == 'N/A'
+
+    def test_it_ignores_incomplete_loop_rows(self):
+        block, = cif.iter_cif_blocks(
+            'data_x\nloop_\n_a\n_b\n1 2\n3\n_c 4\n')
+
+        assert block.column('_a') == ['1']
+        assert block.get('_c') == '4'
+
+
+class TestCifFiles(unittest.TestCase):
+
+    def _zip(self, members):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as archive:
+            for name, data in members.items():
+                archive.writestr(name, data)
+        buf.seek(0)
+        return buf
+
+    def test_zip_archives(self):
+        archive = self._zip({
+            'structures/a.cif': b'data_a\n',
+            'structures/b.CIF': b'data_b\n',
+            'README': b'not a CIF',
+            '__MACOSX/structures/._a.cif': b'',
+        })
+
+        assert cif.is_cif_upload(archive, 'structures.zip')
+        assert archive.tell() == 0
+        assert list(cif.iter_cif_files(archive, 'structures.zip')) == [
+            ('a.cif', b'data_a\n'), ('b.CIF', b'data_b\n')]
+
+    def test_zipped_data_packages_are_not_cif_uploads(self):
+        archive = self._zip({'datapackage.json': b'{}'})
+
+        assert not cif.is_cif_upload(archive, 'datapackage.zip')
+        assert not cif.is_cif_upload(io.BytesIO(b'[]'), 'records.json')
+
+    def test_tar_archives(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+            info = tarfile.TarInfo('a.cif')
+            info.size = len(b'data_a\n')
+            archive.addfile(info, io.BytesIO(b'data_a\n'))
+        buf.seek(0)
+
+        assert list(cif.iter_cif_files(buf, 'structures.tar.gz')) == [
+            ('a.cif', b'data_a\n')]
+
+    def test_invalid_archives(self):
+        with pytest.raises(ValueError):
+            list(cif.iter_cif_files(io.BytesIO(b'junk'), 'structures.zip'))
+
+
+class TestCifProcessor(unittest.TestCase):
+
+    def test_it_processes_each_block(self):
+        files = [('single.cif', SINGLE_BLOCK.encode('utf-8')),
+                 ('multi.cif', CIF_1.encode('utf-8'))]
+
+        with mock.patch.object(cif, 'cif_atoms', return_value=None):
+            with cif.CifProcessor(processes=0, batch_size=2) as processor:
+                batches = list(processor.process(files))
+
+        assert [len(batch) for batch in batches] == [2, 1]
+        structures = [item for batch in batches for item in batch]
+        assert [structure['identifier'] for structure, resource
+                in structures] == ['data_single', 'data_first', 'data_second']
+        assert structures[0][0]['exactmass'] == 'N/A'
+        # A single block file is kept whole, the blocks of the others are
+        # split in files of their own.
+        assert structures[0][1] == files[0]
+        assert structures[1][1][0] == 'first.cif'
+        assert structures[1][1][1].startswith(b'data_first\n')
+        assert b'data_second' not in structures[1][1][1]
+        assert structures[2][1] == ('second.cif',
+                                    b'data_second\n_chemical_formula_structural ?\n')
+
+    def test_it_reports_failed_structures(self):
+        with mock.patch.object(cif, 'cif_atoms', side_effect=ValueError('x')):
+            with cif.CifProcessor(processes=0) as processor:
+                (structure, resource), = next(processor.process(
+                    [('single.cif', SINGLE_BLOCK.encode('utf-8'))]))
+
+        assert structure == {'identifier': 'data_single', 'error': 'x'}
+
+    def test_it_processes_small_uploads_inline(self):
+        with mock.patch.object(cif, 'cif_atoms', return_value=None):
+            with cif.CifProcessor() as processor:
+                batch, = processor.process(
+                    [('multi.cif', CIF_1.encode('utf-8'))])
+                assert processor._pool is None
+
+        assert len(batch) == 2
+
+    def test_the_pool_is_not_larger_than_the_batch(self):
+        processor = cif.CifProcessor(processes=8)
+
+        assert processor._pool_size(2) == 2
+        assert processor._pool_size(100) == 8
@@ -0,0 +1,146 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from ckanext.datapackager.lib import http_cache
+
+DESCRIPTOR = {'name': 'foo', 'resources': []}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''Serves ``server.body`` with the validators in ``server.headers``,
+    answering conditional requests with a 304 when they match.'''
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        etag = server.headers.get('ETag')
+        last_modified = server.headers.get('Last-Modified')
+        if (etag and self.headers.get('If-None-Match') == etag) or (
+                not etag and last_modified and
+                self.headers.get('If-Modified-Since') == last_modified):
+            self.send_response(304)
+            self.end_headers()
+            return
+        if server.status != 200:
+            self.send_response(server.status)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(server.body)))
+        for key, value in server.headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpCache(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.requests = []
+        self.server.status = 200
+        self.server.body = json.dumps(DESCRIPTOR).encode('utf-8')
+        self.server.headers = {'ETag': '"v1"'}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/datapackage.json'.format(
+            self.server.server_address[1])
+        self.directory = tempfile.mkdtemp()
+        self.cache = http_cache.HttpCache(self.directory)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_it_fetches_and_caches_a_response_with_an_etag(self):
+        response = self.cache.fetch(self.url)
+
+        assert response.json() == DESCRIPTOR
+        assert not response.from_cache
+        assert 'If-None-Match' not in self.server.requests[0]
+
+    def test_it_revalidates_with_the_etag(self):
+        self.cache.fetch(self.url)
+
+        response = self.cache.fetch(self.url)
+
+        assert response.from_cache
+        assert response.status_code == 304
+        assert response.json() == DESCRIPTOR
+        assert self.server.requests[1]['If-None-Match'] == '"v1"'
+
+    def test_it_revalidates_with_last_modified(self):
+        self.server.headers = {
+            'Last-Modified': 'Wed, 01 Jan 2025 00:00:00 GMT'}
+        self.cache.fetch(self.url)
+
+        response = self.cache.fetch(self.url)
+
+        assert response.from_cache
+        assert self.server.requests[1]['If-Modified-Since'] == \
+            'Wed, 01 Jan 2025 00:00:00 GMT'
+
+    def test_it_fetches_a_changed_response(self):
+        self.cache.fetch(self.url)
+        changed = dict(DESCRIPTOR, name='bar')
+        self.server.body = json.dumps(changed).encode('utf-8')
+        self.server.headers = {'ETag': '"v2"'}
+
+        response = self.cache.fetch(self.url)
+        assert not response.from_cache
+        assert response.json() == changed
+
+        assert self.cache.fetch(self.url).from_cache
+
+    def test_it_does_not_cache_responses_without_validators(self):
+        self.server.headers = {}
+        self.cache.fetch(self.url)
+
+        response = self.cache.fetch(self.url)
+
+        assert not response.from_cache
+        assert 'If-None-Match' not in self.server.requests[1]
+        assert 'If-Modified-Since' not in self.server.requests[1]
+
+    def test_it_fetches_again_if_the_cached_body_is_gone(self):
+        self.cache.fetch(self.url)
+        meta_path, body_path = self.cache._paths(self.url)
+        os.remove(body_path)
+
+        response = self.cache.fetch(self.url)
+
+        assert response.json() == DESCRIPTOR
+        assert not response.from_cache
+        assert len(self.server.requests) == 3
+
+    def test_it_raises_on_error_statuses(self):
+        self.server.headers = {}
+        self.server.status = 404
+
+        with self.assertRaises(requests.HTTPError):
+            self.cache.fetch(self.url)
+
+    def test_it_works_without_a_cache_directory(self):
+        cache = http_cache.HttpCache(None)
+        cache.fetch(self.url)
+
+        response = cache.fetch(self.url)
+
+        assert not response.from_cache
+        assert 'If-None-Match' not in self.server.requests[1]
+
+    def test_the_session_is_shared_within_a_thread(self):
+        assert http_cache.get_session() is http_cache.get_session()
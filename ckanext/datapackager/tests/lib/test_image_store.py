@@ -0,0 +1,97 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from ckanext.datapackager.lib.image_store import ImageStore
+
+KEY = 'UHOVQNZJYSORNB-UHFFFAOYSA-N'
+
+
+class TestImageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _touch(self, path):
+        open(path, 'wb').close()
+
+    def test_flat_layout(self):
+        store = ImageStore(self.root, shard_depth=0)
+
+        assert store.path_for(KEY) == os.path.join(self.root, KEY + '.png')
+
+    def test_sharded_layout(self):
+        store = ImageStore(self.root, shard_depth=2)
+
+        path = store.path_for(KEY, create_dirs=True)
+
+        relative = os.path.relpath(path, self.root).split(os.sep)
+        assert len(relative) == 3
+        assert all(len(shard) == 2 for shard in relative[:2])
+        assert relative[2] == KEY + '.png'
+        assert os.path.isdir(os.path.dirname(path))
+        # The same key always goes to the same shard.
+        assert ImageStore(self.root, shard_depth=2).path_for(KEY) == path
+
+    def test_index(self):
+        store = ImageStore(self.root, shard_depth=2)
+        assert not store.contains(KEY)
+
+        store.add([KEY])
+
+        assert store.contains(KEY)
+        # The index is persisted.
+        assert ImageStore(self.root, shard_depth=2).contains(KEY)
+
+    def test_remove(self):
+        store = ImageStore(self.root, shard_depth=2)
+        self._touch(store.path_for(KEY, create_dirs=True))
+        store.add([KEY])
+
+        assert store.remove([KEY, 'UNKNOWN']) == 1
+
+        assert not store.contains(KEY)
+        assert not os.path.exists(store.path_for(KEY))
+
+    def test_migrate_a_flat_directory(self):
+        keys = [KEY, 'CIF-BLOCK-1']
+        for key in keys:
+            self._touch(os.path.join(self.root, key + '.png'))
+        self._touch(os.path.join(self.root, 'README.txt'))
+        store = ImageStore(self.root, shard_depth=2)
+
+        assert store.migrate(self.root, dry_run=True) == 2
+        assert not store.contains(KEY)
+
+        assert store.migrate(self.root) == 2
+
+        for key in keys:
+            assert store.contains(key)
+            assert os.path.isfile(store.path_for(key))
+            assert not os.path.exists(os.path.join(self.root, key + '.png'))
+        assert os.path.exists(os.path.join(self.root, 'README.txt'))
+        assert store.migrate(self.root) == 0
+
+    def test_rebuild_index(self):
+        store = ImageStore(self.root, shard_depth=1)
+        self._touch(store.path_for(KEY, create_dirs=True))
+        store.add(['STALE'])
+
+        assert store.rebuild_index() == 1
+
+        assert store.contains(KEY)
+        assert not store.contains('STALE')
+
+    def test_it_can_be_sent_to_other_processes(self):
+        store = ImageStore(self.root, shard_depth=2)
+        store.add([KEY])
+
+        copy = pickle.loads(pickle.dumps(store))
+
+        assert copy.path_for(KEY) == store.path_for(KEY)
+        assert copy.contains(KEY)
@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ckanext.datapackager.lib import images
+from ckanext.datapackager.lib.image_store import ImageStore
+
+BENZENE = {
+    'id': 'msbnk-test-0001',
+    'inchi': 'InChI=1S/C6H6/c1-2-4-6-5-3-1/h1-6H',
+    'inchi_key': 'UHOVQNZJYSORNB-UHFFFAOYSA-N',
+}
+
+
+class TestMoleculeImageRenderer(unittest.TestCase):
+
+    def setUp(self):
+        self.images_dir = tempfile.mkdtemp()
+        self.store = ImageStore(self.images_dir, shard_depth=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.images_dir)
+
+    def test_molecule_image_item(self):
+        assert images.molecule_image_item(BENZENE) == (
+            BENZENE['inchi_key'], BENZENE['inchi'])
+        assert images.molecule_image_item({'inchi': 'N/A'}) is None
+        assert images.molecule_image_item({'inchi': BENZENE['inchi']}) == (
+            None, BENZENE['inchi'])
+
+    def test_it_renders_each_molecule_once(self):
+        other_spectrum = dict(BENZENE, id='msbnk-test-0002')
+
+        with images.MoleculeImageRenderer(
+                mode=images.INLINE, store=self.store) as renderer:
+            renderer.submit([BENZENE, other_spectrum])
+            renderer.submit([BENZENE])
+
+        assert renderer.submitted == 1
+        assert renderer.rendered == 1
+        assert os.path.isfile(self.store.path_for(BENZENE['inchi_key']))
+        assert self.store.contains(BENZENE['inchi_key'])
+
+    def test_it_does_not_render_existing_images(self):
+        path = self.store.path_for(BENZENE['inchi_key'], create_dirs=True)
+        open(path, 'wb').close()
+
+        with images.MoleculeImageRenderer(
+                mode=images.INLINE, store=self.store) as renderer:
+            renderer.submit([BENZENE])
+
+        assert renderer.rendered == 0
+        assert os.path.getsize(path) == 0
+
+    def test_it_renders_in_a_process_pool(self):
+        with images.MoleculeImageRenderer(
+                mode=images.POOL, store=self.store,
+                processes=2, inline_threshold=0) as renderer:
+            renderer.submit([BENZENE])
+            assert renderer._pool_processes == 1
+
+        assert renderer.rendered == 1
+        assert os.path.isfile(self.store.path_for(BENZENE['inchi_key']))
+
+    def test_it_renders_small_batches_inline(self):
+        with images.MoleculeImageRenderer(
+                mode=images.POOL, store=self.store) as renderer:
+            renderer.submit([BENZENE])
+            assert renderer._pool is None
+
+        assert renderer.rendered == 1
+
+    def test_the_pool_is_not_larger_than_the_batch(self):
+        renderer = images.MoleculeImageRenderer(processes=8)
+
+        assert renderer._pool_size(3) == 3
+        assert renderer._pool_size(100) == 8
+
+    def test_it_skips_indexed_images(self):
+        self.store.add([BENZENE['inchi_key']])
+
+        with images.MoleculeImageRenderer(
+                mode=images.INLINE, store=self.store) as renderer:
+            renderer.submit([BENZENE])
+
+        assert renderer.submitted == 0
+        assert not os.path.exists(self.store.path_for(BENZENE['inchi_key']))
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ckanext.datapackager.lib import ingest
+
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source', 'spectrum.csv')
+        os.makedirs(os.path.dirname(self.source))
+        with open(self.source, 'wb') as f:
+            f.write(b'mz,intensity\n78.047,999\n')
+        self.target = os.path.join(self.directory, 'resources', 'abc', 'def')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_is_under(self):
+        source_dir = os.path.join(self.directory, 'source')
+
+        assert ingest.is_under(self.source, [source_dir])
+        assert not ingest.is_under(self.source, [source_dir + '2'])
+        assert not ingest.is_under(
+            os.path.join(source_dir, '..', 'elsewhere'), [source_dir])
+
+    def test_is_under_resolves_symbolic_links(self):
+        source_dir = os.path.join(self.directory, 'source')
+        link = os.path.join(source_dir, 'link.csv')
+        os.symlink('/etc/hostname', link)
+
+        assert not ingest.is_under(link, [source_dir])
+
+    def test_link_file_hard_links_the_file(self):
+        method = ingest.link_file(self.source, self.target)
+
+        assert method == ingest.HARDLINK
+        assert os.path.samefile(self.source, self.target)
+        assert os.listdir(os.path.dirname(self.target)) == ['def']
+
+    def test_link_file_copies_the_file_without_hard_links(self):
+        method = ingest.link_file(self.source, self.target, hardlink=False)
+
+        assert method in (ingest.REFLINK, ingest.COPY)
+        assert not os.path.samefile(self.source, self.target)
+        with open(self.target, 'rb') as f:
+            assert f.read() == b'mz,intensity\n78.047,999\n'
+
+    def test_link_file_falls_back_to_a_copy(self):
+        with mock.patch.object(os, 'link', side_effect=OSError(18, 'EXDEV')), \
+                mock.patch.object(ingest, '_reflink',
+                                  side_effect=OSError(95, 'EOPNOTSUPP')):
+            method = ingest.link_file(self.source, self.target)
+
+        assert method == ingest.COPY
+        with open(self.target, 'rb') as f:
+            assert f.read() == b'mz,intensity\n78.047,999\n'
+
+    def test_link_file_replaces_the_target(self):
+        os.makedirs(os.path.dirname(self.target))
+        with open(self.target, 'wb') as f:
+            f.write(b'old')
+
+        ingest.link_file(self.source, self.target)
+
+        with open(self.target, 'rb') as f:
+            assert f.read() == b'mz,intensity\n78.047,999\n'
+
+    def test_link_file_raises_if_the_source_does_not_exist(self):
+        with self.assertRaises(OSError):
+            ingest.link_file(self.source + '.missing', self.target)
+
+        assert os.listdir(os.path.dirname(self.target)) == []
+
+    def test_prepare_resource(self):
+        resource = ingest.prepare_resource({'name': 'spectrum'}, self.source)
+
+        assert resource['id']
+        assert resource['url'] == 'spectrum.csv'
+        assert resource['url_type'] == 'upload'
+        assert resource['size'] == 24
+        assert resource['mimetype'] == 'text/csv'
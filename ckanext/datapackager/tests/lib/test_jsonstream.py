@@ -0,0 +1,58 @@
+import io
+import json
+import unittest
+
+from ckanext.datapackager.lib.jsonstream import iter_json_records
+
+
+class TestIterJsonRecords(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [
+            {'identifier': 'MSBNK-{0}'.format(i), 'name': u'é' * i}
+            for i in range(50)
+        ]
+
+    def test_it_yields_every_element_of_an_array(self):
+        body = json.dumps(self.records, ensure_ascii=False).encode('utf-8')
+
+        for chunk_size in (1, 7, 64 * 1024):
+            records = list(iter_json_records(io.BytesIO(body),
+                                             chunk_size=chunk_size))
+            assert records == self.records
+
+    def test_it_reads_text_streams(self):
+        body = json.dumps(self.records)
+
+        records = list(iter_json_records(io.StringIO(body), chunk_size=5))
+
+        assert records == self.records
+
+    def test_it_yields_a_single_object_once(self):
+        body = b' {"identifier": "MSBNK-1"} '
+
+        records = list(iter_json_records(io.BytesIO(body), chunk_size=2))
+
+        assert records == [{'identifier': 'MSBNK-1'}]
+
+    def test_it_yields_records_before_reading_the_whole_stream(self):
+        body = b'[{"a": 1}, {"a": 2}, ' + b' ' * 1024 + b'{"a": 3}]'
+        stream = io.BytesIO(body)
+
+        records = iter_json_records(stream, chunk_size=16)
+        assert next(records) == {'a': 1}
+
+        assert stream.tell() < len(body)
+
+    def test_it_skips_a_byte_order_mark(self):
+        body = b'\xef\xbb\xbf[1, 2]'
+
+        assert list(iter_json_records(io.BytesIO(body), chunk_size=1)) == [1, 2]
+
+    def test_empty_array(self):
+        assert list(iter_json_records(io.BytesIO(b'[ ]'))) == []
+
+    def test_it_raises_on_invalid_json(self):
+        for body in (b'[{"a": 1},', b'[1 2]', b'[1] x', b'{"a":', b'[1,]'):
+            with self.assertRaises(json.JSONDecodeError):
+                list(iter_json_records(io.BytesIO(body), chunk_size=1))
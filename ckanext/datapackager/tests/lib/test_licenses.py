@@ -0,0 +1,43 @@
+import unittest
+
+from ckanext.datapackager.lib.licenses import LicenseIndex, normalize_url
+
+
+class TestLicenseIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = LicenseIndex([
+            {'id': 'cc-by',
+             'url': 'http://www.opendefinition.org/licenses/cc-by',
+             'title': 'Creative Commons Attribution'},
+            {'id': 'CC-BY-4.0',
+             'url': 'https://creativecommons.org/licenses/by/4.0/',
+             'title': 'Creative Commons Attribution 4.0'},
+            {'id': 'notspecified', 'url': '', 'title': 'License not specified'},
+        ])
+
+    def test_resolve_by_id(self):
+        assert self.index.resolve('cc-by') == 'cc-by'
+
+    def test_resolve_by_title(self):
+        assert self.index.resolve(
+            'Creative Commons Attribution 4.0') == 'CC-BY-4.0'
+
+    def test_resolve_by_normalized_url(self):
+        for url in ('https://creativecommons.org/licenses/by/4.0/',
+                    'http://creativecommons.org/licenses/by/4.0',
+                    'https://www.CreativeCommons.org/licenses/by/4.0'):
+            assert self.index.resolve(url) == 'CC-BY-4.0'
+
+    def test_resolve_unknown_license(self):
+        assert self.index.resolve('https://example.com/license') is None
+        assert self.index.resolve('') is None
+        assert self.index.resolve(None) is None
+        assert self.index.resolve({'name': 'cc-by'}) is None
+
+    def test_licenses_without_url_are_not_matched_by_url(self):
+        assert self.index.resolve('http://') is None
+
+    def test_normalize_url(self):
+        assert normalize_url(' HTTPS://www.example.com/a/ ') == 'example.com/a'
+        assert normalize_url(None) is None
@@ -0,0 +1,219 @@
+import collections
+import io
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ckanext.datapackager.lib import metrics
+
+
+class TestImportMetrics(unittest.TestCase):
+
+    def test_nested_stages_are_timed_exclusively(self):
+        import_metrics = metrics.ImportMetrics()
+
+        with import_metrics.stage('convert'):
+            with import_metrics.stage('parse'):
+                time.sleep(0.02)
+        import_metrics.finish()
+
+        stages = import_metrics.as_dict()['stages']
+        assert stages['parse']['calls'] == 1
+        assert stages['parse']['seconds'] >= 0.02
+        assert stages['convert']['seconds'] < 0.02
+        total = sum(stage['seconds'] for stage in stages.values())
+        assert abs(total - import_metrics.duration) < 1e-6
+
+    def test_iterate_times_each_item(self):
+        import_metrics = metrics.ImportMetrics()
+        metrics._local.metrics = import_metrics
+        try:
+            items = list(metrics.iterate('parse', iter([1, 2, 3])))
+        finally:
+            metrics._local.metrics = None
+
+        assert items == [1, 2, 3]
+        # The last call finds the iterator exhausted.
+        assert import_metrics.stages['parse'][0] == 4
+
+    def test_counting_reader(self):
+        import_metrics = metrics.ImportMetrics()
+        metrics._local.metrics = import_metrics
+        try:
+            reader = metrics.CountingReader(io.BytesIO(b'[1, 2, 3]'))
+            reader.read(4)
+            reader.read()
+        finally:
+            metrics._local.metrics = None
+
+        assert import_metrics.counters['bytes_read'] == 9
+
+    def test_nothing_is_recorded_without_an_import(self):
+        with metrics.stage('parse'):
+            metrics.count('records')
+
+        assert metrics.current() is None
+
+
+class TestProcessMetrics(unittest.TestCase):
+
+    def test_it_adds_up_the_imports(self):
+        process_metrics = metrics.ProcessMetrics()
+        for error in (None, None, 'boom'):
+            import_metrics = metrics.ImportMetrics('json')
+            with import_metrics.stage('parse'):
+                import_metrics.count('records', 10)
+            import_metrics.finish(error=error)
+            process_metrics.add(import_metrics)
+
+        snapshot = process_metrics.snapshot()
+
+        assert snapshot['imports'] == [
+            {'kind': 'json', 'status': 'failed', 'count': 1},
+            {'kind': 'json', 'status': 'finished', 'count': 2},
+        ]
+        assert snapshot['stages']['parse']['calls'] == 3
+        assert snapshot['counters'] == {'records': 30}
+        assert len(snapshot['recent_imports']) == 3
+
+    def test_prometheus_text(self):
+        process_metrics = metrics.ProcessMetrics()
+        import_metrics = metrics.ImportMetrics('cif')
+        with import_metrics.stage('parse'):
+            import_metrics.count('records', 2)
+        import_metrics.count('molecule_cache_hits', 3)
+        import_metrics.count('http_cache_misses', 1)
+        import_metrics.finish()
+        process_metrics.add(import_metrics)
+
+        text = metrics.prometheus_text(process_metrics.snapshot())
+
+        lines = text.splitlines()
+        assert 'datapackager_imports_total{kind="cif",status="finished"} 1' in lines
+        assert 'datapackager_import_stage_calls_total{stage="parse"} 1' in lines
+        assert 'datapackager_import_records_total 2' in lines
+        assert 'datapackager_cache_hits_total{cache="molecule_id"} 3' in lines
+        assert 'datapackager_cache_misses_total{cache="http"} 1' in lines
+        assert lines.count('# TYPE datapackager_cache_hits_total counter') == 1
+
+
+class FakeRedis(object):
+    '''The few Redis commands used by :py:class:`SharedMetrics`, returning
+    bytes as redis-py does.'''
+
+    def __init__(self):
+        self.hashes = collections.defaultdict(dict)
+        self.lists = collections.defaultdict(list)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def hsetnx(self, key, field, value):
+        self.hashes[key].setdefault(field.encode(), str(value).encode())
+
+    def hincrby(self, key, field, value):
+        hash_ = self.hashes[key]
+        hash_[field.encode()] = str(
+            int(hash_.get(field.encode(), 0)) + value).encode()
+
+    def hincrbyfloat(self, key, field, value):
+        hash_ = self.hashes[key]
+        hash_[field.encode()] = repr(
+            float(hash_.get(field.encode(), 0)) + value).encode()
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def lpush(self, key, value):
+        self.lists[key].insert(0, value.encode())
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lists[key][start:end + 1]
+
+    def lrange(self, key, start, end):
+        return list(self.lists.get(key, []))
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+            self.lists.pop(key, None)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.results = []
+
+    def __getattr__(self, command):
+        def queue(*args):
+            self.results.append(getattr(self.redis, command)(*args))
+        return queue
+
+    def execute(self):
+        return self.results
+
+
+class TestSharedMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(metrics, '_connect',
+                                    return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _import(self, kind='json', error=None):
+        import_metrics = metrics.ImportMetrics(kind)
+        with import_metrics.stage('parse'):
+            import_metrics.count('records', 10)
+        import_metrics.finish(error=error)
+        return import_metrics
+
+    def test_it_adds_up_the_imports_of_all_the_processes(self):
+        # Each SharedMetrics stands for a different process.
+        for error in (None, None, 'boom'):
+            metrics.SharedMetrics().add(self._import(error=error))
+
+        snapshot = metrics.SharedMetrics().snapshot()
+
+        assert snapshot['imports'] == [
+            {'kind': 'json', 'status': 'failed', 'count': 1},
+            {'kind': 'json', 'status': 'finished', 'count': 2},
+        ]
+        assert snapshot['stages']['parse']['calls'] == 3
+        assert snapshot['counters'] == {'records': 30}
+        assert snapshot['import_seconds'] > 0
+        assert [summary['error'] for summary
+                in snapshot['recent_imports']] == [None, None, 'boom']
+
+    def test_it_keeps_the_last_imports(self):
+        shared_metrics = metrics.SharedMetrics()
+        for i in range(metrics.RECENT_IMPORTS + 2):
+            shared_metrics.add(self._import())
+
+        snapshot = shared_metrics.snapshot()
+
+        assert len(snapshot['recent_imports']) == metrics.RECENT_IMPORTS
+        assert snapshot['imports'][0]['count'] == metrics.RECENT_IMPORTS + 2
+
+    def test_track_import_adds_to_the_shared_metrics(self):
+        with mock.patch.object(metrics, '_install_statement_counter'):
+            with metrics.track_import('cif'):
+                metrics.count('records', 2)
+
+        snapshot = metrics.shared_metrics.snapshot()
+        assert snapshot['imports'] == [
+            {'kind': 'cif', 'status': 'finished', 'count': 1}]
+        assert snapshot['counters'] == {'records': 2}
+
+    def test_redis_errors_do_not_break_the_import(self):
+        with mock.patch.object(metrics, '_install_statement_counter'), \
+                mock.patch.object(metrics, '_connect',
+                                  side_effect=ConnectionError):
+            with metrics.track_import('json'):
+                metrics.count('records')
@@ -0,0 +1,89 @@
+import unittest
+
+from ckanext.datapackager.lib import molecules
+
+
+class TestMoleculeRows(unittest.TestCase):
+
+    def test_molecule_row(self):
+        package = {
+            'id': 'msbnk-test-0001',
+            'inchi': 'InChI=1S/C6H6/c1-2-4-6-5-3-1/h1-6H',
+            'inchi_key': 'UHOVQNZJYSORNB-UHFFFAOYSA-N',
+            'smiles': 'c1ccccc1',
+            'exactmass': '78.04695',
+            'mol_formula': 'C6H6',
+        }
+
+        assert molecules.molecule_row(package) == (
+            package['inchi'], package['inchi_key'], package['smiles'],
+            package['exactmass'], package['mol_formula'], package['id'])
+
+    def test_molecule_row_without_inchi_key(self):
+        assert molecules.molecule_row({'id': 'a', 'inchi_key': ''}) is None
+        assert molecules.molecule_row({'id': 'a'}) is None
+
+    def test_copy_buffer_escapes_values(self):
+        rows = [('a\tb', 'KEY', None, 1.5, 'back\\slash', 'line\nbreak')]
+
+        buf = molecules._copy_buffer(rows)
+
+        assert buf.read() == 'a\\tb\tKEY\t\\N\t1.5\tback\\\\slash\tline\\nbreak\n'
+
+    def test_clean_rows_converts_numeric_exact_masses(self):
+        schema = {'types': {'exactmass': 'FLOAT'}}
+        rows = [('i', 'KEY1', 's', '78.04', 'f', 'p1'),
+                ('i', 'KEY2', 's', 'N/A', 'f', 'p2'),
+                ('i', '', 's', '1', 'f', 'p3'),
+                None]
+
+        cleaned = molecules._clean_rows(rows, schema)
+
+        assert [row[3] for row in cleaned] == [78.04, None]
+
+
+class TestMoleculeIdCache(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = molecules.MoleculeIdCache()
+        cache.set('KEY1', 1)
+
+        assert cache.get('KEY1') == 1
+        assert cache.get('KEY2') is None
+
+    def test_it_evicts_the_least_recently_used_keys(self):
+        cache = molecules.MoleculeIdCache(maxsize=2)
+        cache.set('KEY1', 1)
+        cache.set('KEY2', 2)
+        cache.get('KEY1')
+        cache.set('KEY3', 3)
+
+        assert len(cache) == 2
+        assert cache.get('KEY2') is None
+        assert cache.get('KEY1') == 1
+        assert cache.get('KEY3') == 3
+
+    def test_invalidate(self):
+        cache = molecules.MoleculeIdCache()
+        cache.update({'KEY1': 1, 'KEY2': 2, 'KEY3': 3})
+
+        cache.invalidate([2])
+        assert cache.get('KEY2') is None
+        assert cache.get('KEY1') == 1
+
+        cache.invalidate()
+        assert len(cache) == 0
+
+    def test_stats(self):
+        cache = molecules.MoleculeIdCache(maxsize=10)
+        cache.set('KEY1', 1)
+        cache.get('KEY1')
+        cache.get('KEY1')
+        cache.get('KEY2')
+
+        stats = cache.stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 1
+        assert stats['size'] == 1
+        assert stats['maxsize'] == 10
+        assert round(stats['hit_rate'], 2) == 0.67
@@ -0,0 +1,41 @@
+import unittest
+
+from ckanext.datapackager.lib.progress import ImportProgress
+
+
+class TestImportProgress(unittest.TestCase):
+
+    def test_it_counts_outcomes(self):
+        progress = ImportProgress()
+        progress.start()
+
+        for outcome in ('created', 'created', 'skipped', 'failed'):
+            progress.record(outcome)
+
+        status = progress.as_dict()
+        assert status['state'] == 'running'
+        assert status['processed'] == 4
+        assert status['created'] == 2
+        assert status['skipped'] == 1
+        assert status['failed'] == 1
+
+    def test_throughput(self):
+        progress = ImportProgress()
+        assert progress.throughput == 0.0
+
+        progress.start()
+        progress.record('created')
+        progress.finish()
+        progress.started_at = progress.finished_at - 2
+
+        assert progress.throughput == 0.5
+
+    def test_finish_with_error(self):
+        progress = ImportProgress(filename='records.json')
+        progress.start()
+        progress.finish(error='Invalid JSON')
+
+        status = progress.as_dict()
+        assert status['state'] == 'failed'
+        assert status['error'] == 'Invalid JSON'
+        assert status['filename'] == 'records.json'
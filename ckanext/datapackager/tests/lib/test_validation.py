@@ -0,0 +1,83 @@
+import copy
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import datapackage
+import pytest
+
+from ckanext.datapackager.lib import validation
+
+DESCRIPTORS = [
+    {'name': 'no-resources'},
+    {
+        'name': 'with-resources',
+        'resources': [
+            {'name': 'a', 'path': 'a.csv'},
+            {'name': 'b', 'url': 'http://example.com/b.csv'},
+            {
+                'name': 'c',
+                'profile': 'tabular-data-resource',
+                'path': 'c.csv',
+                'schema': {'fields': [{'name': 'x'}]},
+                'dialect': {'delimiter': ';'},
+            },
+        ],
+    },
+    {'identifier': 'MSBNK-Test-0001', 'inChIKey': 'UHOVQNZJYSORNB-UHFFFAOYSA-N'},
+]
+
+
+class TestValidation(unittest.TestCase):
+
+    def test_normalize_matches_datapackage(self):
+        for descriptor in DESCRIPTORS:
+            expected = datapackage.DataPackage(copy.deepcopy(descriptor)).to_dict()
+
+            assert validation.normalize(copy.deepcopy(descriptor)) == expected
+
+    def test_normalize_rejects_what_is_not_a_data_package(self):
+        for descriptor in (['not', 'a', 'dict'], {'resources': 'a.csv'},
+                           {'resources': ['a.csv']}):
+            with pytest.raises(datapackage.exceptions.DataPackageException):
+                validation.normalize(descriptor)
+
+    def test_validate(self):
+        valid = validation.normalize({'name': 'foo', 'resources': [
+            {'name': 'a', 'path': 'a.csv'}]})
+        invalid = validation.normalize({'name': 'foo'})
+
+        assert validation.validate(valid) == []
+        errors = validation.validate(invalid)
+        assert errors
+        assert 'resources' in errors[0]
+
+    def test_profiles_are_loaded_once(self):
+        validation.get_profile.cache_clear()
+        with mock.patch('datapackage.profile.Profile',
+                        wraps=datapackage.profile.Profile) as profile:
+            validation.validate_batch(
+                [validation.normalize(copy.deepcopy(descriptor))
+                 for descriptor in DESCRIPTORS * 10])
+
+        assert profile.call_count == 1
+
+    def test_structural_validation_does_not_load_profiles(self):
+        with mock.patch.object(validation, 'get_profile') as get_profile:
+            errors = validation.validate_batch(
+                [validation.normalize({'name': 'foo'})],
+                mode=validation.STRUCTURAL)
+
+        assert errors == [[]]
+        assert not get_profile.called
+
+    def test_iter_validated_yields_every_descriptor_in_order(self):
+        descriptors = [{'name': 'dp-{0}'.format(i)} for i in range(7)]
+
+        names = [descriptor['name'] for descriptor in
+                 validation.iter_validated(descriptors, batch_size=3)]
+
+        assert names == ['dp-{0}'.format(i) for i in range(7)]
@@ -0,0 +1,28 @@
+import io
+import zipfile
+
+from ckanext.datapackager.lib import zipstream
+
+
+def test_iter_zip():
+    members = [
+        ('a/datapackage.json', b'{"name": "a"}'),
+        ('b/data.csv', io.BytesIO(b'x,y\n' * 50000)),
+        ('c/data.txt', [b'first ', b'second']),
+    ]
+
+    chunks = list(zipstream.iter_zip(members))
+
+    assert len(chunks) > 1
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+    assert archive.testzip() is None
+    assert archive.namelist() == [name for name, content in members]
+    assert archive.read('a/datapackage.json') == b'{"name": "a"}'
+    assert archive.read('b/data.csv') == b'x,y\n' * 50000
+    assert archive.read('c/data.txt') == b'first second'
+
+
+def test_iter_zip_without_members():
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(zipstream.iter_zip([]))))
+
+    assert archive.namelist() == []
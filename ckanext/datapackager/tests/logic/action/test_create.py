@@ -14,6 +14,14 @@ import ckan.tests.helpers as helpers
 import ckanext.datapackager.tests.helpers as custom_helpers
 import ckan.plugins.toolkit as toolkit
 import ckan.tests.factories as factories
+import contextlib
+from werkzeug.datastructures import FileStorage
+
+from ckanext.datapackager import jobs
+from ckanext.datapackager.lib import images
+from ckanext.datapackager.lib import ingest
+from ckanext.datapackager.lib.progress import ImportProgress
+from ckanext.datapackager.logic.action import create
 
 import re
 
@@ -305,6 +313,174 @@ class TestPackageCreateFromDataPackage():
             assert dataset['name'] == 'foo'
 
 
+    def test_it_writes_each_new_dataset_once(self):
+        record = {
+            'identifier': 'MSBNK-Test-0001',
+            'name': 'Test spectrum',
+            'description': 'A test spectrum',
+            'datePublished': '2020-01-01',
+            'url': 'http://example.com/MSBNK-Test-0001',
+        }
+        upload = BytesIO(six.binary_type(json.dumps([record]), 'utf-8'))
+
+        with mock.patch.object(toolkit, 'get_action',
+                               wraps=toolkit.get_action) as get_action:
+            datasets = helpers.call_action('package_create_from_datapackage',
+                                           upload=upload)
+
+        called_actions = [args[0] for args, kwargs in get_action.call_args_list]
+        assert called_actions.count('package_create') == 1
+        assert 'package_update' not in called_actions
+        assert 'resource_create' not in called_actions
+
+        assert datasets[0]['name'] == 'msbnk-test-0001'
+        assert datasets[0]['state'] == 'active'
+        assert datasets[0]['resources'][0]['url'] == record['url']
+
+    def test_it_skips_existing_datasets_without_loading_them(self):
+        record = {
+            'identifier': 'MSBNK-Test-0002',
+            'name': 'Test spectrum',
+            'description': 'A test spectrum',
+            'datePublished': '2020-01-01',
+            'url': 'http://example.com/MSBNK-Test-0002',
+            'molecularFormula': 'C6H6',
+        }
+        body = six.binary_type(json.dumps([record]), 'utf-8')
+        dataset = factories.Dataset(name='msbnk-test-0002',
+                                    license_id='cc-by')
+        factories.Resource(package_id=dataset['id'])
+
+        with mock.patch.object(toolkit, 'get_action',
+                               wraps=toolkit.get_action) as get_action:
+            datasets = helpers.call_action('package_create_from_datapackage',
+                                           upload=BytesIO(body))
+
+        called_actions = [args[0] for args, kwargs in get_action.call_args_list]
+        assert 'package_show' not in called_actions
+        assert 'package_create' not in called_actions
+        assert 'package_update' not in called_actions
+        assert datasets[0]['id'] == dataset['id']
+        assert 'resources' not in datasets[0]
+        json.dumps(datasets)
+
+    def test_reimporting_a_cif_file_returns_a_serializable_result(self):
+        body = b'data_reimport\n_chemical_formula_structural C6H6\n'
+
+        def import_cif():
+            return helpers.call_action(
+                'package_create_from_datapackage',
+                upload=FileStorage(BytesIO(body), 'structure.cif'))
+
+        created = import_cif()
+        skipped = import_cif()
+
+        assert skipped[0]['id'] == created[0]['id']
+        assert 'resources' not in skipped[0]
+        json.dumps(skipped)
+
+    def test_it_queues_molecule_images_by_default(self):
+        record = {
+            'identifier': 'MSBNK-Test-0003',
+            'name': 'Test spectrum',
+            'description': 'A test spectrum',
+            'datePublished': '2020-01-01',
+            'url': 'http://example.com/MSBNK-Test-0003',
+            'inChI': 'InChI=1S/C6H6/c1-2-4-6-5-3-1/h1-6H',
+            'inChIKey': 'UHOVQNZJYSORNB-UHFFFAOYSA-N',
+            'smiles': 'c1ccccc1',
+            'molecularFormula': 'C6H6',
+        }
+        body = six.binary_type(json.dumps([record]), 'utf-8')
+
+        with mock.patch('ckan.lib.jobs.enqueue') as enqueue, \
+                mock.patch.object(images, 'render_molecule_image') as render:
+            helpers.call_action('package_create_from_datapackage',
+                                upload=BytesIO(body))
+
+        render.assert_not_called()
+        (job, [items]), kwargs = enqueue.call_args
+        assert job is jobs.render_molecule_images_job
+        assert items == [(record['inChIKey'], record['inChI'])]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datapackager')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestLinkedResourceFiles(object):
+    def test_it_fails_the_dataset_if_a_file_cannot_be_stored(self, tmpdir):
+        path = tmpdir.join('spectrum.csv')
+        path.write('mz,intensity\n78.047,999\n')
+        dataset_dict = {
+            'id': 'msbnk-test-0004',
+            'name': 'msbnk-test-0004',
+            'resources': [{'name': 'spectrum', 'path': str(path)}],
+        }
+        progress = ImportProgress()
+
+        with mock.patch.object(ingest, 'can_link', return_value=True), \
+                mock.patch.object(ingest, 'store_file',
+                                  side_effect=OSError('No space left')):
+            imported = create._import_chunk([dataset_dict], progress)
+
+        assert imported == []
+        assert progress.failed == 1
+        assert progress.created == 0
+        dataset = helpers.call_action('package_show', id='msbnk-test-0004')
+        assert dataset['resources'] == []
+
+
+@pytest.mark.usefixtures('ckan_config')
+class TestInlineResourceData(object):
+    def _upload(self, data):
+        '''Upload inline data, and return the resource, the filename and
+        content of its upload, and whether a temporary file was created.'''
+        resource = {'name': 'the-resource', 'data': data}
+        with mock.patch.object(tempfile, 'TemporaryFile',
+                               wraps=tempfile.TemporaryFile) as temporary_file:
+            with contextlib.ExitStack() as open_files:
+                create._create_and_upload_resource_with_inline_data(
+                    resource, open_files)
+                upload = resource['upload']
+                return resource, upload.filename, upload.stream.read(), \
+                    temporary_file.called
+
+    def test_it_serializes_data_as_compact_json(self):
+        resource, filename, body, on_disk = self._upload({'foo': ['bar', 1]})
+
+        assert 'data' not in resource
+        assert resource['url_type'] == 'upload'
+        assert filename == 'the-resource'
+        assert body == b'{"foo":["bar",1]}'
+
+    def test_it_keeps_small_data_in_memory(self):
+        resource, filename, body, on_disk = self._upload(u'caf\xe9')
+
+        assert body == u'caf\xe9'.encode('utf-8')
+        assert not on_disk
+
+    @pytest.mark.ckan_config(
+        'ckanext.datapackager.inline_data_spool_size', '16')
+    def test_it_spools_large_data_to_disk(self):
+        resource, filename, body, on_disk = self._upload('x' * 17)
+
+        assert body == b'x' * 17
+        assert on_disk
+
+
+@pytest.mark.usefixtures('ckan_config')
+class TestCifProcessorSettings(object):
+    def test_web_request_imports_process_structures_in_process(self):
+        assert create._cif_processor().processes == 0
+
+    def test_background_imports_use_a_pool(self):
+        assert create._cif_processor(background=True).processes is None
+
+    @pytest.mark.ckan_config('ckanext.datapackager.cif_processes', '3')
+    def test_the_configured_number_of_processes_is_used(self):
+        assert create._cif_processor().processes == 3
+        assert create._cif_processor(background=True).processes == 3
+
+
 class _UploadFile(object):
     '''Mock the parts from cgi.FileStorage we use.'''
 
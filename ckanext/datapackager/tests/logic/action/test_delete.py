@@ -0,0 +1,97 @@
+import pytest
+
+import ckan.model as model
+import ckan.tests.helpers as helpers
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.factories as factories
+
+from ckanext.datapackager.lib import molecules
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datapackager')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestPurgeDatasetsForeignkeys():
+    def test_it_requires_ids_or_a_query(self):
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('purge_datasets_foreignkeys')
+
+    def test_it_purges_the_datasets_in_chunks(self):
+        datasets = [factories.Dataset() for i in range(5)]
+        kept = factories.Dataset()
+        done = []
+
+        result = helpers.call_action(
+            'purge_datasets_foreignkeys',
+            context={'purge_progress': lambda *args: done.append(args)},
+            ids=[dataset['name'] for dataset in datasets[:2]] +
+                [dataset['id'] for dataset in datasets[2:]],
+            chunk_size=2)
+
+        assert result == {'purged': 5, 'not_found': []}
+        assert done == [(2, 5), (4, 5), (5, 5)]
+        for dataset in datasets:
+            assert model.Package.get(dataset['id']) is None
+        assert model.Package.get(kept['id'])
+
+    def test_it_reports_the_datasets_not_found(self):
+        dataset = factories.Dataset()
+
+        result = helpers.call_action(
+            'purge_datasets_foreignkeys', ids=[dataset['id'], 'missing'])
+
+        assert result == {'purged': 1, 'not_found': ['missing']}
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datapackager')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestPurgeOrphanedMolecules():
+    def _register_molecule(self, dataset, inchi_key):
+        molecule_ids = molecules.upsert_molecules([
+            ('InChI=1S/' + inchi_key, inchi_key, 'C', '12.0', 'C',
+             dataset['id'])])
+        model.Session.commit()
+        return molecule_ids[inchi_key]
+
+    def _molecule_exists(self, molecule_id):
+        Molecules = molecules.models()[0]
+        return model.Session.query(Molecules).get(molecule_id) is not None
+
+    def test_it_deletes_the_molecules_of_purged_datasets(self):
+        purged = factories.Dataset()
+        kept = factories.Dataset()
+        orphan_id = self._register_molecule(purged, 'AAAAAAAAAAAAAA-AAAAAAAAAA-N')
+        kept_id = self._register_molecule(kept, 'BBBBBBBBBBBBBB-BBBBBBBBBB-N')
+        helpers.call_action('purge_dataset_foreignkeys', id=purged['id'])
+
+        result = helpers.call_action('purge_orphaned_molecules', batch_size=1)
+
+        assert result['purged'] == 1
+        assert result['completed']
+        assert not self._molecule_exists(orphan_id)
+        assert self._molecule_exists(kept_id)
+
+    def test_it_carries_on_from_the_watermark(self):
+        dataset = factories.Dataset()
+        self._register_molecule(dataset, 'AAAAAAAAAAAAAA-AAAAAAAAAA-N')
+        self._register_molecule(factories.Dataset(), 'BBBBBBBBBBBBBB-BBBBBBBBBB-N')
+        helpers.call_action('purge_dataset_foreignkeys', id=dataset['id'])
+
+        first = helpers.call_action('purge_orphaned_molecules',
+                                    batch_size=1, max_batches=1)
+        second = helpers.call_action('purge_orphaned_molecules',
+                                     batch_size=1)
+
+        assert not first['completed']
+        assert first['purged'] + second['purged'] == 1
+        assert first['scanned'] + second['scanned'] == 2
+        assert second['completed']
+
+    def test_dry_run(self):
+        dataset = factories.Dataset()
+        molecule_id = self._register_molecule(dataset, 'AAAAAAAAAAAAAA-AAAAAAAAAA-N')
+        helpers.call_action('purge_dataset_foreignkeys', id=dataset['id'])
+
+        result = helpers.call_action('purge_orphaned_molecules', dry_run=True)
+
+        assert result['purged'] == 1
+        assert self._molecule_exists(molecule_id)
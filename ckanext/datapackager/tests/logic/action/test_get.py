@@ -10,6 +10,7 @@ import ckan.tests.helpers as helpers
 
 from frictionless_ckan_mapper import ckan_to_frictionless as converter
 import ckan.plugins.toolkit as toolkit
+from ckanext.datapackager.lib.progress import ImportProgress
 
 @pytest.mark.ckan_config('ckan.plugins', 'datapackager')
 @pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
@@ -35,3 +36,66 @@ class TestGet(unittest.TestCase):
     def test_package_show_as_datapackage_with_missing_id(self):
         with self.assertRaises(toolkit.ValidationError):
             helpers.call_action('package_show_as_datapackage')
+
+    def test_datapackage_import_status(self):
+        user = factories.Sysadmin()
+        progress = ImportProgress('test-import-1', user=user['name'])
+        progress.start()
+        progress.record('created')
+        progress.record('skipped')
+        progress.save()
+
+        status = helpers.call_action('datapackage_import_status',
+                                     context={'user': user['name']},
+                                     id='test-import-1')
+
+        assert status['state'] == 'running'
+        assert status['processed'] == 2
+        assert status['created'] == 1
+        assert status['skipped'] == 1
+        assert status['failed'] == 0
+
+    def test_datapackage_import_status_with_unknown_id(self):
+        user = factories.Sysadmin()
+        with self.assertRaises(toolkit.ObjectNotFound):
+            helpers.call_action('datapackage_import_status',
+                                context={'user': user['name']},
+                                id='not-an-import')
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datapackager')
+@pytest.mark.usefixtures('clean_db', 'clean_index', 'with_plugins', 'with_request_context')
+class TestSearchAsDatapackages(unittest.TestCase):
+
+    def test_it_pages_through_all_datasets(self):
+        datasets = [factories.Dataset() for i in range(5)]
+
+        names = []
+        after = None
+        while True:
+            page = helpers.call_action('package_search_as_datapackages',
+                                       rows=2, after=after)
+            names.extend(datapackage['name'] for datapackage in page['results'])
+            after = page['after']
+            if after is None:
+                break
+
+        assert sorted(names) == sorted(dataset['name'] for dataset in datasets)
+        assert len(names) == len(set(names))
+
+    def test_it_filters_by_organization(self):
+        organization = factories.Organization()
+        dataset = factories.Dataset(owner_org=organization['id'])
+        factories.Dataset()
+
+        page = helpers.call_action('package_search_as_datapackages',
+                                   organization=organization['id'])
+
+        assert page['count'] == 1
+        assert page['results'][0]['name'] == dataset['name']
+        assert page['after'] is None
+
+    def test_it_fails_with_an_unknown_organization(self):
+        with self.assertRaises(toolkit.ObjectNotFound):
+            helpers.call_action('package_search_as_datapackages',
+                                organization='no-such-organization')
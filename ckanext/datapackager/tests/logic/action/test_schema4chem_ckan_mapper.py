@@ -0,0 +1,83 @@
+import unittest
+
+from ckanext.datapackager.logic.action import schema4chem_ckan_mapper as converter
+
+RECORD = {
+    'identifier': 'MSBNK-Test-0001',
+    'name': 'Benzene spectrum',
+    'description': 'A mass spectrum of benzene.',
+    'url': 'https://massbank.example.org/RecordDisplay?id=MSBNK-Test-0001',
+    'format': ['text/plain'],
+    'license': 'CC BY 4.0',
+    'datePublished': '2024-01-01',
+    'inChI': 'InChI=1S/C6H6/c1-2-4-6-5-3-1/h1-6H',
+    'inChIKey': 'UHOVQNZJYSORNB-UHFFFAOYSA-N',
+    'smiles': 'c1ccccc1',
+    'molecularFormula': '',
+    'chemicalComposition': 'C6H6',
+    'monoisotopicMolecularWeight': '78.0470',
+    'measurementTechnique': [
+        {'name': 'LC-ESI-QTOF', 'url': 'http://purl.obolibrary.org/obo/MS_1000075'}],
+    'contributors': [
+        {'title': 'Jane Doe', 'role': 'author', 'email': 'jane@example.org'},
+        {'title': 'John Doe', 'role': 'maintainer'}],
+    'peaks': [[78.047, 999]],
+}
+
+
+class TestSchema4ChemCkanMapper(unittest.TestCase):
+
+    def test_package(self):
+        assert converter.package(RECORD) == {
+            'identifier': 'MSBNK-Test-0001',
+            'name': 'msbnk-test-0001',
+            'title': 'Benzene spectrum',
+            'notes': 'A mass spectrum of benzene.',
+            'url': RECORD['url'],
+            'license': 'CC BY 4.0',
+            'smiles': 'c1ccccc1',
+            'metadata_published': '2024-01-01',
+            'inchi': RECORD['inChI'],
+            'inchi_key': RECORD['inChIKey'],
+            'mol_formula': 'C6H6',
+            'exactmass': '78.0470',
+            'resources': [{
+                'name': 'Benzene spectrum',
+                'resource_type': 'text/plain',
+                'format': 'text/plain',
+                'url': RECORD['url'],
+            }],
+            'measurement_technique': 'LC-ESI-QTOF',
+            'measurement_technique_iri': 'http://purl.obolibrary.org/obo/MS_1000075',
+            'author': 'Jane Doe',
+            'author_email': 'jane@example.org',
+            'maintainer': 'John Doe',
+            'maintainer_email': None,
+        }
+
+    def test_package_does_not_modify_its_input(self):
+        record = dict(RECORD)
+
+        converter.package(record)
+
+        assert record == RECORD
+
+    def test_a_missing_chemical_field_ends_the_chemical_mapping(self):
+        record = dict(RECORD)
+        del record['smiles']
+
+        dataset_dict = converter.package(record)
+
+        assert dataset_dict['inchi_key'] == RECORD['inChIKey']
+        assert 'mol_formula' not in dataset_dict
+        assert 'exactmass' not in dataset_dict
+
+    def test_packages(self):
+        records = [dict(RECORD, identifier='MSBNK-Test-{0:04d}'.format(i))
+                   for i in range(3)]
+
+        names = [dataset_dict['name']
+                 for dataset_dict in converter.packages(iter(records))]
+
+        assert names == ['msbnk-test-0000', 'msbnk-test-0001',
+                         'msbnk-test-0002']
@@ -0,0 +1,77 @@
+'''Guards the cost of loading the plugin, which every CKAN web worker, CLI
+command and background job pays.'''
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Imported where they are used, never when the plugin is loaded.
+HEAVY_MODULES = ('rdkit', 'ase', 'matplotlib', 'psycopg2', 'datapackage')
+
+# The time the plugin may take to import, on top of CKAN itself. Wall-clock
+# timings depend on the machine (and on its load), so the budget is only
+# checked when it is set, e.g. on a dedicated benchmark runner.
+IMPORT_BUDGET_MS = os.environ.get('DATAPACKAGER_IMPORT_BUDGET_MS')
+
+_SCRIPT = '''
+import json
+import sys
+import time
+
+# CKAN's own import time and modules are not the plugin's.
+import ckan.model
+import ckan.plugins.toolkit
+
+before = set(sys.modules)
+start = time.perf_counter()
+import ckanext.datapackager.plugin
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({
+    'elapsed_ms': elapsed,
+    'modules': sorted(set(sys.modules) - before),
+}))
+'''
+
+
+def _import_plugin():
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _SCRIPT],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def _slowest_imports(importtime_output, count=10):
+    '''Return the ``count`` imports with the largest cumulative time from
+    the output of ``python -X importtime``.'''
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            imports.append((int(fields[1]), fields[2].strip()))
+        except (IndexError, ValueError):
+            continue  # the header line
+    imports.sort(reverse=True)
+    return [f'{name}: {cumulative / 1000.0:.1f} ms'
+            for cumulative, name in imports[:count]]
+
+
+def test_loading_the_plugin_does_not_import_heavy_dependencies():
+    result, importtime_output = _import_plugin()
+
+    imported = set(module.split('.')[0] for module in result['modules'])
+    assert not imported.intersection(HEAVY_MODULES), \
+        _slowest_imports(importtime_output)
+
+
+@pytest.mark.skipif(not IMPORT_BUDGET_MS,
+                    reason='DATAPACKAGER_IMPORT_BUDGET_MS is not set')
+def test_loading_the_plugin_is_within_budget():
+    result, importtime_output = _import_plugin()
+
+    assert result['elapsed_ms'] < float(IMPORT_BUDGET_MS), \
+        _slowest_imports(importtime_output)